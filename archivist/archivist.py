@@ -1,5 +1,10 @@
+import cProfile
+
 from libs.arguments import args
 from libs.Archive import Archiver, Extractor
+from libs.logger import logger
+from libs.metrics import metrics
+from libs.Watcher import Watcher
 
 def main():
     if args.cmd == 'archive':
@@ -7,21 +12,81 @@ def main():
                         state_file=args.state_file,
                         name=args.name,
                         max=args.max_size,
+                        stream=args.stream,
+                        max_inflight_parts=args.max_inflight_parts,
+                        workers=args.workers,
+                        codec=args.codec,
+                        dedup=args.dedup,
+                        jobs=args.jobs,
                         key_id=args.key_id,
                         key_secret=args.key_secret,
                         endpoint_url=args.endpoint_url,
                         bucket=args.bucket,
-                        certificate_path=args.certificate_path) as archive:
+                        certificate_path=args.certificate_path,
+                        cache_dir=args.cache_dir,
+                        part_size=args.part_size,
+                        multipart_threshold=args.multipart_threshold,
+                        max_concurrency=args.max_concurrency,
+                        max_pool_connections=args.max_pool_connections,
+                        retries=args.retries,
+                        bandwidth_limit=args.bandwidth_limit) as archive:
             archive.create()
     elif args.cmd == 'extract':
         with Extractor(directory=args.directory,
+                        workers=args.workers,
+                        archive_cache_size=args.archive_cache_size,
                         state_file=args.state_file,
                         key_id=args.key_id,
                         key_secret=args.key_secret,
                         endpoint_url=args.endpoint_url,
                         bucket=args.bucket,
-                        certificate_path=args.certificate_path) as extractor:
+                        certificate_path=args.certificate_path,
+                        cache_dir=args.cache_dir,
+                        part_size=args.part_size,
+                        multipart_threshold=args.multipart_threshold,
+                        max_concurrency=args.max_concurrency,
+                        max_pool_connections=args.max_pool_connections,
+                        retries=args.retries,
+                        bandwidth_limit=args.bandwidth_limit) as extractor:
             extractor.extract()
+    elif args.cmd == 'watch':
+        with Watcher(directory=args.directory,
+                        state_file=args.state_file,
+                        name=args.name,
+                        max=args.max_size,
+                        stream=args.stream,
+                        max_inflight_parts=args.max_inflight_parts,
+                        workers=args.workers,
+                        codec=args.codec,
+                        dedup=args.dedup,
+                        jobs=args.jobs,
+                        batch_size=args.batch_size,
+                        batch_interval=args.batch_interval,
+                        rescan_interval=args.rescan_interval,
+                        archive_cache_size=args.archive_cache_size,
+                        key_id=args.key_id,
+                        key_secret=args.key_secret,
+                        endpoint_url=args.endpoint_url,
+                        bucket=args.bucket,
+                        certificate_path=args.certificate_path,
+                        cache_dir=args.cache_dir,
+                        part_size=args.part_size,
+                        multipart_threshold=args.multipart_threshold,
+                        max_concurrency=args.max_concurrency,
+                        max_pool_connections=args.max_pool_connections,
+                        retries=args.retries,
+                        bandwidth_limit=args.bandwidth_limit) as watcher:
+            watcher.run()
 
 if __name__ == "__main__":
-    main()
+    profile = cProfile.Profile() if args.profile else None
+    if profile:
+        profile.enable()
+    try:
+        main()
+    finally:
+        if profile:
+            profile.disable()
+            profile.dump_stats(args.profile)
+        logger.info('Run summary: %s', metrics.summary())
+        metrics.save()
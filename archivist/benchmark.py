@@ -0,0 +1,208 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+# The harness shared by the benchmarks of this repo lives at its root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import benchmark_harness
+
+# Benchmark archive and extract cycles of archivist.py against a local S3 emulator
+#
+# A synthetic tree is generated from a seed, archived, archived again without changes,
+# partly deleted and restored. Every run is a separate archivist.py process, whose
+# metrics file provides the S3 request counts and whose rusage provides the peak RSS.
+# The emulator runs in a process of its own and this script never imports boto3, as
+# the peak RSS of a child includes the memory of its parent at the time it was forked.
+
+ARCHIVIST = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archivist.py')
+BUCKET = 'benchmark'
+
+# Lower is better for these results, higher is better for every other one
+LOWER_IS_BETTER = ('seconds', 'peak_rss_mb', 's3_requests', 's3_retries')
+
+def lower_is_better(name):
+    return name in LOWER_IS_BETTER
+
+# Read command line args
+parser = argparse.ArgumentParser(description="Benchmark archive and extract throughput of archivist against a local S3 emulator")
+parser.add_argument("-f", "--files", type=int, help="Number of files of the synthetic tree. Default = 2000", default=2000, required=False)
+parser.add_argument("--files_per_dir", type=int, help="Number of files per directory, directories are nested 2 levels deep. Default = 100", default=100, required=False)
+parser.add_argument("--sizes", type=str, help="File size distribution in KB, one of 'fixed:<size>', 'uniform:<min>:<max>' or 'lognormal:<median>:<sigma>'. Default = lognormal:64:1.5", default="lognormal:64:1.5", required=False)
+parser.add_argument("--compressibility", type=float, help="Fraction of every file which is compressible text, the rest is random bytes. Default = 0.5", default=0.5, required=False)
+parser.add_argument("--duplicates", type=float, help="Fraction of files which are copies of another file. Default = 0", default=0, required=False)
+parser.add_argument("--restore", type=float, help="Fraction of files deleted and restored by the extract run. Default = 1", default=1, required=False)
+parser.add_argument("--seed", type=int, help="Seed of the synthetic tree. Default = 0", default=0, required=False)
+parser.add_argument("--archive_args", type=str, help="Extra arguments of the archive runs, quoted as a shell would, e.g. --archive_args='-z zstd --stream'. A single argument needs the '=' form, e.g. --archive_args=--dedup", default="", required=False)
+parser.add_argument("--extract_args", type=str, help="Extra arguments of the extract run, quoted as a shell would, e.g. --extract_args='-w 8'", default="", required=False)
+parser.add_argument("-u", "--endpoint_url", type=str, help="Endpoint of a running S3 emulator. Default = start a moto server on localhost", default=None, required=False)
+benchmark_harness.add_arguments(parser)
+
+# Draw a file size in bytes from the distribution
+def draw_size(rng, spec):
+    kind, *params = spec.split(':')
+    params = [float(x) for x in params]
+    if kind == 'fixed':
+        size = params[0]
+    elif kind == 'uniform':
+        size = rng.uniform(params[0], params[1])
+    elif kind == 'lognormal':
+        size = rng.lognormvariate(0, params[1]) * params[0]
+    else:
+        raise ValueError('Unknown size distribution \'{k}\''.format(k=kind))
+    return int(size * 1024)
+
+# Content of a file, 'compressibility' of which is repetitive text
+def make_content(rng, size, compressibility, words):
+    text_size = int(size * compressibility)
+    text = bytearray()
+    while len(text) < text_size:
+        text += rng.choice(words)
+    return bytes(text[:text_size]) + rng.randbytes(size - text_size)
+
+# Generate the synthetic tree, returns { relative path: md5 } and the total size in bytes
+# Only one file is held in memory at a time, which keeps the peak RSS of this process low
+def generate(directory, options):
+    rng = random.Random(options.seed)
+    words = [(' '.join(rng.choice(['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'archive', 'state', 'bucket']) for _ in range(12)) + '\n').encode() for _ in range(64)]
+    files = {}
+    originals = []
+    total = 0
+    for i in range(options.files):
+        relative_path = os.path.join('d{a:03d}'.format(a=i // (options.files_per_dir * 10)), 'd{b:03d}'.format(b=i // options.files_per_dir % 10), 'f{i:07d}.bin'.format(i=i))
+        path = os.path.join(directory, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if originals and rng.random() < options.duplicates:
+            original = rng.choice(originals)
+            shutil.copyfile(os.path.join(directory, original), path)
+            files[relative_path] = files[original]
+            total += os.path.getsize(path)
+            continue
+        content = make_content(rng, draw_size(rng, options.sizes), options.compressibility, words)
+        with open(path, 'wb') as f:
+            f.write(content)
+        originals.append(relative_path)
+        files[relative_path] = hashlib.md5(content).hexdigest()
+        total += len(content)
+    return files, total
+
+# Start moto's S3 server on a free localhost port, returns (process, endpoint url)
+def start_emulator():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    endpoint_url = 'http://127.0.0.1:{p}'.format(p=port)
+    server = subprocess.Popen([sys.executable, '-m', 'moto.server', '-H', '127.0.0.1', '-p', str(port)], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            sys.exit('moto is required to run a local S3 emulator, install it with \'pip install -r requirements-benchmark.txt\' or pass --endpoint_url\n' + server.stderr.read().decode())
+        try:
+            urllib.request.urlopen(endpoint_url, timeout=1)
+            return server, endpoint_url
+        except urllib.error.HTTPError:
+            return server, endpoint_url
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    sys.exit('moto server did not start on \'{e}\''.format(e=endpoint_url))
+
+# Create the bucket, from a separate process so boto3 is not loaded here
+def create_bucket(endpoint_url):
+    subprocess.run([sys.executable, '-c', (
+        'import boto3\n'
+        's3 = boto3.client("s3", endpoint_url={e!r}, aws_access_key_id="benchmark", aws_secret_access_key="benchmark", region_name="us-east-1")\n'
+        'try:\n'
+        '    s3.create_bucket(Bucket={b!r})\n'
+        'except s3.exceptions.BucketAlreadyOwnedByYou:\n'
+        '    pass\n').format(e=endpoint_url, b=BUCKET)], check=True)
+
+# Run archivist.py, returns its wall clock seconds, peak RSS in MB and metrics summary
+def run(action, directory, endpoint_url, cache_dir, state_file, extra_args):
+    metrics_file = os.path.join(cache_dir, action + '.metrics.json')
+    command = [sys.executable, ARCHIVIST, '--disable_logging', '--metrics_file', metrics_file, action,
+               '-d', directory, '-b', BUCKET, '-i', 'benchmark', '-k', 'benchmark', '-u', endpoint_url,
+               '-s', state_file, '--cache_dir', cache_dir] + shlex.split(extra_args)
+    seconds, peak_rss_mb = benchmark_harness.run(command)
+    with open(metrics_file) as f:
+        summary = json.load(f)
+    return seconds, peak_rss_mb, summary
+
+def result(seconds, files, size, peak_rss_mb, summary):
+    counters = summary['counters']
+    return {
+        'seconds': round(seconds, 3),
+        'files_per_second': round(files / seconds, 1),
+        'mb_per_second': round(size / (1024 ** 2) / seconds, 2),
+        'peak_rss_mb': round(peak_rss_mb, 1),
+        's3_requests': counters.get('s3_requests', 0),
+        's3_retries': counters.get('s3_retries', 0)
+    }
+
+def main(options):
+    server = None
+    endpoint_url = options.endpoint_url
+    if endpoint_url is None:
+        server, endpoint_url = start_emulator()
+    work_dir = options.work_dir or tempfile.mkdtemp(prefix='archivist-benchmark-')
+    directory = os.path.join(work_dir, 'tree')
+    cache_dir = os.path.join(work_dir, 'cache')
+    state_file = 'benchmark-{t}.state'.format(t=int(time.time()))
+    try:
+        shutil.rmtree(directory, ignore_errors=True)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.makedirs(cache_dir)
+        create_bucket(endpoint_url)
+        files, size = generate(directory, options)
+        phases = {}
+
+        # Archive the whole tree
+        seconds, rss, summary = run('archive', directory, endpoint_url, cache_dir, state_file, options.archive_args)
+        phases['archive'] = result(seconds, len(files), size, rss, summary)
+        phases['archive']['compression_ratio'] = summary.get('compression_ratio', 1)
+
+        # Archive again without changes
+        seconds, rss, summary = run('archive', directory, endpoint_url, cache_dir, state_file, options.archive_args)
+        phases['noop_archive'] = result(seconds, len(files), size, rss, summary)
+
+        # Delete files and restore them
+        rng = random.Random(options.seed)
+        deleted = rng.sample(sorted(files), int(len(files) * options.restore))
+        for relative_path in deleted:
+            os.remove(os.path.join(directory, relative_path))
+        seconds, rss, summary = run('extract', directory, endpoint_url, cache_dir, state_file, options.extract_args)
+        restored_size = 0
+        for relative_path in deleted:
+            path = os.path.join(directory, relative_path)
+            with open(path, 'rb') as f:
+                content = f.read()
+            if hashlib.md5(content).hexdigest() != files[relative_path]:
+                sys.exit('Restored file \'{p}\' differs from the original'.format(p=relative_path))
+            restored_size += len(content)
+        phases['extract'] = result(seconds, len(deleted), restored_size, rss, summary)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        if options.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {
+        'parameters': benchmark_harness.parameters(options, exclude=('endpoint_url',)),
+        'tree': { 'files': len(files), 'bytes': size },
+        'phases': phases
+    }
+    return benchmark_harness.report(results, options, lower_is_better)
+
+if __name__ == "__main__":
+    sys.exit(main(parser.parse_args()))
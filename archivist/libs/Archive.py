@@ -1,18 +1,43 @@
-import boto3
-import botocore
+import bisect
+import botocore.exceptions
+import collections
+import contextlib
+import copy
+import gzip
+import hashlib
 import json
+import math
 import os
+import shutil
+import stat
 import sys
 import tarfile
+import threading
+import time
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+from libs.Cache import ArchiveCache, TeeReader
+from libs.Codec import get_codec
+from libs.Compress import ParallelCompressor
+from libs.Digest import HashingReader, hash_file
 from libs.logger import logger
+from libs.Manifest import Manifest
+from libs.metrics import metrics
+from libs.Scanner import Scanner
+from libs.Stream import S3MultipartWriter
+from libs.Transfer import ThrottledReader, Transfer, throughput
 
 # Base class
 class ArchiveTemplate:
 
-    def __init__(self, directory, state_file, key_id, key_secret, bucket, certificate_path, endpoint_url=None):
+    # Name of the persisted scan index, one per subclass as each tracks changes since its own last run
+    scan_index = None
+
+    def __init__(self, directory, state_file, key_id, key_secret, bucket, certificate_path, endpoint_url=None, cache_dir=None,
+                 part_size=64, multipart_threshold=64, max_concurrency=10, max_pool_connections=None, retries=5, bandwidth_limit=0,
+                 max_inflight_parts=2, client=None, manifest=None, scanner=None, scan=True):
         self.directory = directory
         self.state_file = state_file
         self.key_id = key_id
@@ -20,59 +45,101 @@ class ArchiveTemplate:
         self.endpoint_url = endpoint_url
         self.bucket = bucket
         self.certificate_path = certificate_path
+        self.cache_dir = cache_dir
         self._state_file_path = os.path.join(self.directory, self.state_file)
+        # Multipart, concurrency, retry and bandwidth settings of every transfer
+        self.transfer = Transfer(multipart_threshold, part_size, max_concurrency, max_pool_connections, retries, bandwidth_limit, max_inflight_parts)
 
-        # Initialize S3 session
-        session = boto3.session.Session()
-        # Create client from session parameters
-        self.s3 = session.client(
-            's3',
-            endpoint_url=self.endpoint_url,
-            aws_access_key_id=self.key_id,
-            aws_secret_access_key=self.key_secret,
-            verify=self.certificate_path
-        )
+        # Long running callers share their client, state and scanner across instances
+        self._owns_client = client is None
+        self._client = client
+        self._client_lock = threading.Lock()
         # Check state file for discrepancies
-        self.state_data = self._get_archived_files()
+        self.manifest = manifest if manifest is not None else Manifest(self, self.state_file, cache_file=self._get_state_cache_file())
+        self.scanner = scanner if scanner is not None else Scanner(self.directory, index_file=self._get_index_file(), exclude=self._get_excluded_files())
+        # Whether to scan the directory, or to use the scan a caller sharing the scanner just ran
+        self._fresh_scan = scan
 
     def __enter__(self):
         return self
 
     def __exit__(self, *exc):
-        self.s3.close()
+        self.manifest.save()
+        if self._owns_client and self._client is not None:
+            self._client.close()
         if os.path.exists(self._state_file_path):
             self._remove_file(self._state_file_path)
 
+    # S3 client, created on first use unless a long running caller shares its own
+    @property
+    def s3(self):
+        with self._client_lock:
+            if self._client is None:
+                import boto3
+                # Initialize S3 session
+                session = boto3.session.Session()
+                # Create client from session parameters
+                self._client = session.client(
+                    's3',
+                    endpoint_url=self.endpoint_url,
+                    aws_access_key_id=self.key_id,
+                    aws_secret_access_key=self.key_secret,
+                    verify=self.certificate_path,
+                    config=self.transfer.client_config()
+                )
+                metrics.instrument(self._client)
+            return self._client
+
+    # Path of the local copy of the state kept in the cache directory, unique per endpoint, bucket and state file
+    def _get_state_cache_file(self):
+        if not self.cache_dir:
+            return None
+        key = hashlib.sha1(((self.endpoint_url or '') + '\0' + self.bucket + '\0' + self.state_file).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, key + '.state')
+
+    # Path of the scan index kept in the cache directory, unique per endpoint, bucket, state file and directory
+    def _get_index_file(self):
+        if not self.cache_dir or not self.scan_index:
+            return None
+        key = hashlib.sha1(((self.endpoint_url or '') + '\0' + self.bucket + '\0' + self.state_file + '\0' + os.path.abspath(self.directory)).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, key + '-' + self.scan_index + '.index')
+
+    # Paths relative to the directory which must never be tracked
+    def _get_excluded_files(self):
+        excluded = [self.state_file]
+        if self.cache_dir:
+            cache_dir = os.path.relpath(os.path.abspath(self.cache_dir), os.path.abspath(self.directory))
+            if not cache_dir.startswith(os.pardir):
+                excluded.append(cache_dir)
+        return excluded
+
+    # Scan the directory, unless the last scan of a shared scanner is reused
+    def _scan(self):
+        if not self._fresh_scan:
+            return
+        with metrics.stage('scan'):
+            self.scanner.scan()
+        metrics.count('files_scanned', len(self.scanner))
+
     # Get the list of files that have changed (new or missing)
     def _get_changed_files(self, type):
-        directory_files = []
-        try:
-            for root, dirs, files in os.walk(self.directory):
-                for file in files:
-                    # Get path relative to directory provided in --directory
-                    archive_file_name = os.path.relpath(os.path.join(root, file), self.directory)
-                    # Exclude state file from tracking
-                    if archive_file_name not in self.state_file:
-                        # Gather current state of filesystem
-                        directory_files.append(archive_file_name)
-            current_files = set(directory_files)
-            archived_files = set([ x['relative_path'] for x in self.state_data ])
-            # Use asymmetric difference of sets to file new and missing files
-            if type == 'new':
-                file_diff = current_files - archived_files
-            elif type == 'missing':
-                file_diff = archived_files - current_files
-            return list(file_diff)
-        except Exception as error:
-            raise error
-
-    # Read the contents of the archive state file
-    def _get_archived_files(self):
-        content = self._read_from_s3(object_name=self.state_file)
-        if content:
-            return json.loads(content)
-        else:
-            return []
+        self._scan()
+        if type == 'new':
+            # Archived flags only hold for the state they were set against, which may have been reset
+            identity = self.manifest.identity()
+            if identity is None or identity != self.scanner.identity:
+                logger.info('State \'%s\' is empty or was replaced, checking every file against it', self.state_file)
+                self.scanner.reset_archived()
+            # Modified files are archived again, other files only when the state does not know them yet
+            unarchived = list(self.scanner.unarchived())
+            modified = set(x[0] for x in unarchived if x[1])
+            candidates = set(x[0] for x in unarchived if not x[1])
+            archived = self.manifest.lookup(candidates) if candidates else {}
+            self._scanned_files = candidates | modified
+            file_diff = (candidates - archived.keys()) | modified
+        elif type == 'missing':
+            file_diff = self.manifest.select(lambda path: path not in self.scanner).keys()
+        return list(file_diff)
 
     # Remove a file
     def _remove_file(self, file_path):
@@ -84,10 +151,11 @@ class ArchiveTemplate:
         except Exception as error:
             raise error
 
+    @metrics.stage('state_write')
     def _write_to_s3(self, data, object_name):
         try:
             self.s3.put_object(
-                Body=bytes(data.encode('utf-8')),
+                Body=data if isinstance(data, bytes) else bytes(data.encode('utf-8')),
                 Bucket=self.bucket,
                 Key=object_name
             )
@@ -101,11 +169,12 @@ class ArchiveTemplate:
         except Exception as error:
             raise error
 
-    def _read_from_s3(self, object_name):
+    @metrics.stage('state_read')
+    def _read_from_s3(self, object_name, decode=True):
         try:
             data = self.s3.get_object(Bucket=self.bucket, Key=object_name)
             contents = data['Body'].read()
-            return contents.decode('utf-8')
+            return contents.decode('utf-8') if decode else contents
         except botocore.exceptions.NoCredentialsError:
             logger.error('AWS credentials not found. Please check the provided key ID and secret')
             sys.exit(1)
@@ -118,17 +187,137 @@ class ArchiveTemplate:
                 logger.error('Credentials provided are forbidden from accessing this object')
                 raise e
             elif error_code == 'NoSuchKey':
-                logger.info('The object does not exist')
+                logger.debug('The object \'%s\' does not exist', object_name)
             else:
                 raise e
         except Exception as error:
             raise error
 
+    # Read an object unless its ETag still is 'etag', returns (contents or None, current ETag or None)
+    @metrics.stage('state_read')
+    def _read_if_changed(self, object_name, etag=None):
+        try:
+            kwargs = { 'IfNoneMatch': etag } if etag else {}
+            data = self.s3.get_object(Bucket=self.bucket, Key=object_name, **kwargs)
+            return data['Body'].read(), data['ETag']
+        except botocore.exceptions.NoCredentialsError:
+            logger.error('AWS credentials not found. Please check the provided key ID and secret')
+            sys.exit(1)
+        except botocore.exceptions.EndpointConnectionError:
+            logger.error('Failed to connect to the specified S3 endpoint URL')
+            sys.exit(1)
+        except botocore.exceptions.ClientError as e:
+            error_code = e.response['Error']['Code']
+            if error_code in ('304', 'NotModified'):
+                logger.debug('The object \'%s\' did not change', object_name)
+                return None, etag
+            elif error_code == 'NoSuchKey':
+                logger.debug('The object \'%s\' does not exist', object_name)
+                return None, None
+            raise e
+        except Exception as error:
+            raise error
+
+    # List all objects under a prefix
+    @metrics.stage('state_read')
+    def _list_s3(self, prefix):
+        try:
+            objects = []
+            paginator = self.s3.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+                objects.extend(page.get('Contents', []))
+            return objects
+        except botocore.exceptions.NoCredentialsError:
+            logger.error('AWS credentials not found. Please check the provided key ID and secret')
+            sys.exit(1)
+        except botocore.exceptions.EndpointConnectionError:
+            logger.error('Failed to connect to the specified S3 endpoint URL')
+            sys.exit(1)
+        except Exception as error:
+            raise error
+
+    # Delete a list of objects, 1000 keys per request
+    def _delete_from_s3(self, object_names):
+        try:
+            for i in range(0, len(object_names), 1000):
+                self.s3.delete_objects(
+                    Bucket=self.bucket,
+                    Delete={'Objects': [{'Key': x} for x in object_names[i:i + 1000]], 'Quiet': True}
+                )
+            logger.debug('Deleted \'%s\' objects from bucket \'%s\'', len(object_names), self.bucket)
+        except botocore.exceptions.NoCredentialsError:
+            logger.error('AWS credentials not found. Please check the provided key ID and secret')
+            sys.exit(1)
+        except botocore.exceptions.EndpointConnectionError:
+            logger.error('Failed to connect to the specified S3 endpoint URL')
+            sys.exit(1)
+        except Exception as error:
+            raise error
+
     # Upload a file to S3 bucket with a given object name
+    @metrics.stage('upload')
     def _upload_to_s3(self, file_name, object_name):
         try:
-            self.s3.upload_file(file_name, self.bucket, object_name)
-            logger.info('Uploaded file \'%s\' to S3 bucket \'%s\' as \'%s\'', file_name, self.bucket, object_name)
+            size = os.path.getsize(file_name)
+            started = time.monotonic()
+            self.s3.upload_file(file_name, self.bucket, object_name,
+                                Config=self.transfer.transfer_config(size),
+                                Callback=self.transfer.throttle.consume)
+            metrics.count('bytes_uploaded', size)
+            logger.info('Uploaded file \'%s\' to S3 bucket \'%s\' as \'%s\' at \'%.1f\' MB/s', file_name, self.bucket, object_name, throughput(size, started))
+        except botocore.exceptions.NoCredentialsError:
+            logger.error('AWS credentials not found. Please check the provided key ID and secret')
+            sys.exit(1)
+        except botocore.exceptions.EndpointConnectionError:
+            logger.error('Failed to connect to the specified S3 endpoint URL')
+            sys.exit(1)
+        except Exception as error:
+            raise error
+
+    # Return the metadata of an object (ETag, ContentLength...), or None when it does not exist
+    def _head_s3(self, object_name):
+        try:
+            return self.s3.head_object(Bucket=self.bucket, Key=object_name)
+        except botocore.exceptions.NoCredentialsError:
+            logger.error('AWS credentials not found. Please check the provided key ID and secret')
+            sys.exit(1)
+        except botocore.exceptions.EndpointConnectionError:
+            logger.error('Failed to connect to the specified S3 endpoint URL')
+            sys.exit(1)
+        except botocore.exceptions.ClientError as e:
+            error_code = e.response['Error']['Code']
+            if error_code == '404':
+                logger.debug('The object \'%s\' does not exist', object_name)
+            else:
+                raise e
+        except Exception as error:
+            raise error
+
+    # Open a writable stream into a multipart upload of 'object_name'
+    def _open_s3_writer(self, object_name):
+        try:
+            return S3MultipartWriter(self.s3, self.bucket, object_name,
+                                     part_size=self.transfer.part_size / (1024 ** 2),
+                                     max_inflight=self.transfer.max_inflight_parts,
+                                     max_concurrency=self.transfer.max_concurrency,
+                                     throttle=self.transfer.throttle)
+        except botocore.exceptions.NoCredentialsError:
+            logger.error('AWS credentials not found. Please check the provided key ID and secret')
+            sys.exit(1)
+        except botocore.exceptions.EndpointConnectionError:
+            logger.error('Failed to connect to the specified S3 endpoint URL')
+            sys.exit(1)
+        except Exception as error:
+            raise error
+
+    # Open a streaming body of an object, optionally limited to the byte range [start, end)
+    def _open_s3_range(self, object_name, start=None, end=None):
+        try:
+            kwargs = {}
+            if start is not None:
+                kwargs['Range'] = 'bytes={s}-{e}'.format(s=start, e='' if end is None else end - 1)
+            data = self.s3.get_object(Bucket=self.bucket, Key=object_name, **kwargs)
+            return ThrottledReader(data['Body'], self.transfer.throttle)
         except botocore.exceptions.NoCredentialsError:
             logger.error('AWS credentials not found. Please check the provided key ID and secret')
             sys.exit(1)
@@ -139,10 +328,14 @@ class ArchiveTemplate:
             raise error
 
     # Download a file from S3 bucket to a local file path
-    def _download_from_s3(self, object_name, file_name):
+    @metrics.stage('download')
+    def _download_from_s3(self, object_name, file_name, size=0):
         try:
-            self.s3.download_file(self.bucket, object_name, file_name)
-            logger.info('Downloaded file \'%s\' from S3 bucket \'%s\' as \'%s\'', object_name, self.bucket, file_name)
+            started = time.monotonic()
+            self.s3.download_file(self.bucket, object_name, file_name,
+                                  Config=self.transfer.transfer_config(size),
+                                  Callback=self.transfer.throttle.consume)
+            logger.info('Downloaded file \'%s\' from S3 bucket \'%s\' as \'%s\' at \'%.1f\' MB/s', object_name, self.bucket, file_name, throughput(os.path.getsize(file_name), started))
         except botocore.exceptions.NoCredentialsError:
             logger.error('AWS credentials not found. Please check the provided key ID and secret')
             sys.exit(1)
@@ -164,24 +357,55 @@ class ArchiveTemplate:
 # ArchiveTemplate subclass for archiving & compressing archive objects
 class Archiver(ArchiveTemplate):
 
-    suffix = '.tgz'
+    scan_index = 'archive'
 
-    def __init__(self, name, max = 30, *args, **kwargs):
+    # Suffix of the member index uploaded next to every archive
+    index_suffix = '.idx'
+
+    def __init__(self, name, max = 30, stream = False, workers = None, codec = 'gzip', dedup = False, jobs = 2, files = None, *args, **kwargs):
         ArchiveTemplate.__init__(self, *args, **kwargs)
         self.name = str(name)
+        self.codec = get_codec(codec)
+        self.dedup = bool(dedup)
+        # Content hashes computed before archiving, { relative path: hash }
+        self._hashes = {}
+        # Stat results of the files hashed before archiving, taken before they were hashed
+        self._hashed_stats = {}
+        # Files of this run identical to a file archived in this run, { stored relative path: [relative paths] }
+        self._duplicates = {}
         self.max = int(max)
         self.max_bytes = self.max * (1024 ** 3)
+        self.stream = bool(stream)
+        self.workers = int(workers or os.cpu_count() or 1)
+        # Shared pool compressing archive blocks in parallel
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        # Number of archives built and uploaded concurrently
+        self.jobs = int(jobs or 1)
+        self._lock = threading.Lock()
         self._archive_list = []
         self.timestamp = datetime.utcnow().isoformat(timespec='seconds').replace(':','')
-        self.new_files = self._get_changed_files('new')
+        # Archive an explicit list of written files, or scan the directory for changes
+        self._scanned = files is None
+        if self._scanned:
+            self.new_files = self._get_changed_files('new')
+        else:
+            self._scanned_files = set()
+            self.new_files = [x for x in set(files) if os.path.isfile(os.path.join(self.directory, x))]
 
     def __exit__(self, *exc):
-        # Upload and delete all archives we just created
+        # Delete archives left behind by a failed build or upload
         for arc_name, arc in self._archive_list:
-            # Upload the updated archive to S3
-            self._upload_to_s3(arc, arc_name)
-            # Delete the archive
-            self._remove_file(arc)
+            if os.path.exists(arc):
+                self._remove_file(arc)
+        self._executor.shutdown()
+        # Fold accumulated state deltas into a snapshot
+        if self.new_files:
+            self.manifest.compact()
+        # Only remember files as archived once the whole run succeeded
+        if self._scanned and exc and exc[0] is None:
+            self.scanner.mark_archived(self._scanned_files)
+            self.scanner.identity = self.manifest.identity()
+            self.scanner.save()
         # Call Parent cleanup
         ArchiveTemplate.__exit__(self)
 
@@ -191,126 +415,399 @@ class Archiver(ArchiveTemplate):
         tarinfo.uname = tarinfo.gname = 'root'
         return tarinfo
 
+    # Open the destination of an archive, either a local file or an S3 multipart upload
+    def _open_archive(self, archive_name):
+        if self.stream:
+            return self._open_s3_writer(archive_name)
+        return open(os.path.join(self.directory, archive_name), 'wb')
+
+    # Add a file to an archive, returning its content hash and size in dedup mode
+    # A file hashed before archiving keeps its hash as long as its size and mtime did not change
+    # since then, a file which changed while it was streamed gets no hash at all
+    def _add_member(self, tar, path, target):
+        if not self.dedup:
+            tar.add(path, target, filter=self._reset)
+            return None, None
+        tarinfo = self._reset(tar.gettarinfo(path, target))
+        if not tarinfo.isreg():
+            tar.addfile(tarinfo)
+            return None, None
+        hashed = self._hashed_stats.get(target)
+        unchanged = lambda x: (x.st_size, x.st_mtime_ns) == (hashed.st_size, hashed.st_mtime_ns)
+        with open(path, 'rb') as f:
+            if target in self._hashes and unchanged(os.fstat(f.fileno())):
+                tar.addfile(tarinfo, f)
+                digest = self._hashes[target] if unchanged(os.fstat(f.fileno())) else None
+                return digest, tarinfo.size
+            # Hash the file while it is streamed into the archive
+            reader = HashingReader(f)
+            tar.addfile(tarinfo, reader)
+        return reader.hexdigest(), tarinfo.size
+
     # Add a list of files to the archive and update state file
-    def _add_to_archive(self, data, archive):
+    @metrics.stage('archive')
+    def _add_to_archive(self, data, archive_name):
         try:
             archived_data = []
-            new_state_data = self.state_data
-            with tarfile.open(archive, 'w:gz') as tar:
-                logger.debug('tarfile \'%s\' opened', archive)
-                for target in data:
+            # Uncompressed [start, end) of every member, headers included
+            members = {}
+            pending = collections.deque(data)
+            with self._open_archive(archive_name) as output, \
+                    ParallelCompressor(output, self._executor, self.codec, max_pending=self.workers * 2) as compressor, \
+                    tarfile.open(fileobj=compressor, mode='w|') as tar:
+                logger.debug('tarfile \'%s\' opened', archive_name)
+                while pending:
+                    target = pending.popleft()
                     path = os.path.join(self.directory, target)
-                    tar.add(path, target, filter=self._reset)
-                    logger.info('Added file \'%s\' to the archive \'%s\'', path, archive)
-                    archived_data.append({
-                                          'relative_path': target,
-                                          'archive_name': os.path.relpath(archive, self.directory)
-                                        })
-            for item in archived_data:
-                new_state_data.append(item)
+                    start = tar.offset
+                    digest, size = self._add_member(tar, path, target)
+                    members[target] = [start, tar.offset]
+                    logger.debug('Added file \'%s\' to the archive \'%s\'', path, archive_name)
+                    metrics.count('files_archived')
+                    metrics.tick()
+                    record = {
+                              'relative_path': target,
+                              'archive_name': archive_name,
+                              'codec': self.codec.name
+                             }
+                    if digest is not None:
+                        record.update(hash=digest, size=size)
+                    archived_data.append(record)
+                    duplicates = self._duplicates.pop(target, [])
+                    if duplicates and digest != self._hashes.get(target):
+                        # The file changed since it was hashed, its duplicates must be stored on their own
+                        logger.warning('File \'%s\' changed while archiving, archiving its duplicates separately', path)
+                        pending.extend(duplicates)
+                        continue
+                    for duplicate in duplicates:
+                        archived_data.append(dict(record, relative_path=duplicate, member=target))
+                    if duplicates:
+                        metrics.count('files_deduplicated', len(duplicates))
+            metrics.count('archives')
+            metrics.count('bytes_archived', compressor.bytes_in)
+            metrics.count('bytes_compressed', compressor.bytes_out)
+            # Upload the archive staged in the directory
+            if not self.stream:
+                archive_path = os.path.join(self.directory, archive_name)
+                self._upload_to_s3(archive_path, archive_name)
+                self._remove_file(archive_path)
+            # Upload the member index next to the archive
             self._write_to_s3(
-                data=json.dumps(new_state_data, indent=4),
-                object_name=self.state_file
+                data=gzip.compress(json.dumps({
+                    'codec': self.codec.name,
+                    'size': compressor.bytes_out,
+                    'frames': compressor.frames,
+                    'members': members
+                }, separators=(',', ':')).encode('utf-8'), mtime=0),
+                object_name=archive_name + Archiver.index_suffix
             )
+            # Only append this archive's records to the state
+            with self._lock:
+                self.manifest.append(archived_data)
         except Exception as error:
             raise error
 
-    # Create archive of approx size 'self.max_bytes'
+    # Write and upload an archive, tracking it while it is staged in the directory
+    def _flush_archive(self, data, archive_name):
+        if not self.stream:
+            with self._lock:
+                self._archive_list.append((archive_name, os.path.join(self.directory, archive_name)))
+        self._add_to_archive(data, archive_name)
+
+    # Stat every file once, skipping files which disappeared since the scan
+    def _stat_files(self, files):
+        stats = {}
+        for target in files:
+            try:
+                stats[target] = os.lstat(os.path.join(self.directory, target))
+            except FileNotFoundError:
+                logger.warning('File \'%s\' disappeared before it was archived', target)
+        return stats
+
+    # Pack files into archives of even size which stay below 'self.max_bytes'
+    # Files are ordered by directory, so related files share archives, which helps both
+    # compression and restores. Files larger than the limit get an archive of their own.
+    def _plan(self, files, stats):
+        ordered = sorted(files, key=os.path.split)
+        oversized = [x for x in ordered if stats[x].st_size > self.max_bytes]
+        for target in oversized:
+            logger.warning('File \'%s\' of \'%s\' bytes exceeds the max archive size, archiving it on its own', target, stats[target].st_size)
+        fitting = [x for x in ordered if stats[x].st_size <= self.max_bytes]
+        total = sum(stats[x].st_size for x in fitting)
+        target_size = total / max(math.ceil(total / max(self.max_bytes, 1)), 1)
+        plan = []
+        current = []
+        current_size = 0
+        for target in fitting:
+            size = stats[target].st_size
+            # Close the archive when it is nearer to the target size without this file than with it
+            if current and (current_size + size > self.max_bytes or current_size + size - target_size > target_size - current_size):
+                plan.append(current)
+                current = []
+                current_size = 0
+            current.append(target)
+            current_size += size
+        if current:
+            plan.append(current)
+        plan.extend([x] for x in oversized)
+        return plan
+
+    # Split files into files to archive and duplicates of content stored before
+    # Only files whose size matches another file are hashed up front, and keep that hash when
+    # archived, every other file is hashed while it is archived. Duplicates of stored blobs are recorded right away,
+    # duplicates of files of this run are recorded along with the file they duplicate.
+    def _deduplicate(self, files, stats):
+        blobs = self.manifest.blobs()
+        known_sizes = set(x['size'] for x in blobs.values())
+        sizes = { x: stats[x].st_size for x in files if stat.S_ISREG(stats[x].st_mode) }
+        size_counts = collections.Counter(sizes.values())
+        candidates = [x for x, size in sizes.items() if size in known_sizes or size_counts[size] > 1]
+        # Hash candidates on the compression pool
+        with metrics.stage('hash'):
+            self._hashes = dict(zip(candidates, self._executor.map(hash_file, [os.path.join(self.directory, x) for x in candidates])))
+        self._hashed_stats = { x: stats[x] for x in candidates }
+        metrics.count('bytes_hashed', sum(sizes[x] for x in candidates))
+        references = []
+        stored = {}
+        archive_files = []
+        for target in files:
+            digest = self._hashes.get(target)
+            if digest is None:
+                archive_files.append(target)
+            elif digest in blobs:
+                blob = blobs[digest]
+                references.append(dict(blob, relative_path=target, member=blob.get('member', blob['relative_path'])))
+            elif digest in stored:
+                self._duplicates.setdefault(stored[digest], []).append(target)
+            else:
+                stored[digest] = target
+                archive_files.append(target)
+        duplicates = len(files) - len(archive_files)
+        if duplicates:
+            logger.info('Found \'%s\' duplicate file(s) of \'%s\' bytes, storing them by reference', duplicates, sum(sizes[x] for x in set(files) - set(archive_files)))
+        if references:
+            metrics.count('files_deduplicated', len(references))
+            self.manifest.append(references)
+        return archive_files
+
+    # Create archives of at most 'self.max_bytes', built and uploaded concurrently
     def create(self):
         if self.new_files:
-            # Variables for tracking archives
-            temp_archive = [] # Temporary list for tracking size of archives
-            current_size = 0
-            current_archive = 0
-            for target in self.new_files:
-                archive_name = self.name + '-' + self.timestamp + '-' + str(current_archive) + Archiver.suffix
-                archive = os.path.join(self.directory, archive_name)
-                file_path = os.path.join(self.directory, target)
-                file_size = os.path.getsize(file_path)
-                # If total size of archive is less than the max, create a temporary list of files that need to be archived
-                if current_size + file_size <= self.max_bytes:
-                    temp_archive.append(target)
-                    current_size += file_size
-                # Once archive max size is reached, flush to an archive, and incrementing unique naming variables
-                else:
-                    # Append current iteration file before flushing
-                    temp_archive.append(target)
-                    # Flush to archive
-                    self._add_to_archive(temp_archive, archive)
-                    # Track the archive we just created
-                    self._archive_list.append((archive_name, archive))
-                    # Reset internal tracking variables
-                    temp_archive = []
-                    current_size = 0
-                    # Increment naming variables
-                    current_archive += 1
-            # If we don't reach max, still create archive with the files we have
-            if temp_archive:
-                self._add_to_archive(temp_archive, archive)
-                # Track the archive we just created
-                self._archive_list.append((archive_name, archive))
+            stats = self._stat_files(self.new_files)
+            files = self._deduplicate(list(stats), stats) if self.dedup else list(stats)
+            plan = self._plan(files, stats)
+            logger.info('Packing \'%s\' file(s) of \'%s\' bytes into \'%s\' archive(s)', len(files), sum(stats[x].st_size for x in files), len(plan))
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                futures = [executor.submit(self._flush_archive, data, self.name + '-' + self.timestamp + '-' + str(i) + self.codec.suffix) for i, data in enumerate(plan)]
+                for future in futures:
+                    future.result()
         else:
             logger.debug('There are no new files')
 
 # ArchiveTemplate subclass for extracting archive objects
 class Extractor(ArchiveTemplate):
 
-    def __init__(self, *args, **kwargs):
+    scan_index = 'extract'
+
+    # Only use ranged requests when they fetch less than this fraction of the archive
+    range_ratio = 0.5
+    # Merge ranges separated by less than this many compressed bytes into one request
+    range_gap = 4 * (1024 ** 2)
+    # Only download the rest of an archive into the cache when at most this many bytes are left,
+    # past it stopping at the last missing file is worth more than the cached copy
+    cache_drain_limit = 64 * (1024 ** 2)
+
+    def __init__(self, workers = None, archive_cache_size = 0, files = None, *args, **kwargs):
         ArchiveTemplate.__init__(self, *args, **kwargs)
-        self.missing_files = self._get_changed_files('missing')
-        self._state_entries = [item for item in self.state_data if item['relative_path'] in self.missing_files]
+        self.workers = int(workers or os.cpu_count() or 1)
+        # Keep downloaded archives in the cache directory for later restores
+        self.cache = None
+        if self.cache_dir and archive_cache_size:
+            self.cache = ArchiveCache(os.path.join(self.cache_dir, 'archives'), float(archive_cache_size) * (1024 ** 3))
+        # Only keep state entries of files missing from the directory
+        # Either of an explicit list of deleted files, or of a scan of the directory
+        self._scanned = files is None
+        if self._scanned:
+            self._scan()
+            entries = self.manifest.select(lambda path: path not in self.scanner)
+        else:
+            entries = self.manifest.lookup(set(files))
+            entries = { k: v for k, v in entries.items() if not os.path.lexists(os.path.join(self.directory, k)) }
+        self._state_entries = list(entries.values())
+        self.missing_files = [ x['relative_path'] for x in self._state_entries ]
         self._missing_files_map = self._reduce_map(self._state_entries)
+        # Archives created before codecs were recorded are gzip
+        self._codec_map = { x['archive_name']: get_codec(x.get('codec', 'gzip')) for x in self._state_entries }
+
+    def __exit__(self, *exc):
+        if self._scanned and exc and exc[0] is None:
+            self.scanner.save()
+        ArchiveTemplate.__exit__(self)
 
-    # Retrieve TarInfo of member files from missing files map
-    def _get_missing_members(self, archive):
-        missing_files_list = []
-        with tarfile.open(archive, 'r:gz') as tar:
-            members = tar.getmembers()
-        for key in self._missing_files_map:
-            for member in members:
-                if member.name in self._missing_files_map[key]:
-                    missing_files_list.append(member)
-        return missing_files_list
-
-    # Take missing files, and return map of { 'archive': [list of files to extract from 'archive'] }
+    # Take missing files, and return map of { 'archive': { member: [files to extract from 'member'] } }
+    # Files with a content hash are resolved through it, so every blob is only fetched once
     def _reduce_map(self, data):
         data_map = {}
+        sources = {}
         for key in data:
-            archive_name = key['archive_name']
-            relative_path = key['relative_path']
+            source = sources.setdefault(key['hash'], key) if 'hash' in key else key
+            archive_name = source['archive_name']
+            member = source.get('member', source['relative_path'])
             try:
-                data_map[archive_name].append(relative_path)
+                data_map[archive_name].setdefault(member, []).append(key['relative_path'])
             except KeyError:
-                data_map[archive_name] = [relative_path]
+                data_map[archive_name] = {member: [key['relative_path']]}
             except Exception as error:
                 raise error
         return data_map
 
-    # Extact all files from an archive to a specified directory
-    def _extract_archive(self, archive, member_list):
+    # Extract a member to the first of its relative paths, and copy it to the others
+    def _extract_member(self, tar, member, relative_paths):
+        if member.name != relative_paths[0]:
+            member = copy.copy(member)
+            member.name = relative_paths[0]
+        tar.extract(member, path=self.directory)
+        for relative_path in relative_paths[1:]:
+            shutil.copy2(os.path.join(self.directory, relative_paths[0]), os.path.join(self.directory, relative_path), follow_symlinks=False)
+        metrics.count('files_extracted', len(relative_paths))
+        metrics.tick()
+
+    # Extract the wanted members of a sequential tar stream in a single pass
+    # 'wanted' maps member names to the relative paths to extract them to
+    # Stops reading as soon as every wanted member was extracted, returns the members not found
+    def _extract_stream(self, archive_name, reader, wanted):
+        wanted = dict(wanted)
+        with tarfile.open(fileobj=reader, mode='r|') as tar:
+            for member in tar:
+                relative_paths = wanted.pop(member.name, None)
+                if relative_paths:
+                    self._extract_member(tar, member, relative_paths)
+                    logger.debug('Extracted \'%s\' from archive \'%s\' to \'%s\'', member.name, archive_name, relative_paths)
+                if not wanted:
+                    break
+        return set(wanted)
+
+    # Read the member index uploaded next to an archive, if there is one
+    def _get_index(self, archive_name):
+        content = self._read_from_s3(object_name=archive_name + Archiver.index_suffix, decode=False)
+        if content:
+            return json.loads(gzip.decompress(content))
+        return None
+
+    # Map members to the compressed byte ranges of the frames holding them
+    # Returns a list of (compressed start, compressed end, uncompressed start, [(member start, member name)])
+    def _plan_ranges(self, index, names):
+        frame_starts = [x[0] for x in index['frames']]
+        spans = []
+        for name in names:
+            start, end = index['members'][name]
+            first = bisect.bisect_right(frame_starts, start) - 1
+            last = bisect.bisect_left(frame_starts, end)
+            compressed_end = index['frames'][last][1] if last < len(frame_starts) else index['size']
+            spans.append((index['frames'][first][1], compressed_end, index['frames'][first][0], start, name))
+        ranges = []
+        for compressed_start, compressed_end, frame_start, start, name in sorted(spans):
+            if ranges and compressed_start <= ranges[-1][1] + Extractor.range_gap:
+                ranges[-1][1] = max(ranges[-1][1], compressed_end)
+                ranges[-1][3].append((start, name))
+            else:
+                ranges.append([compressed_start, compressed_end, frame_start, [(start, name)]])
+        return ranges
+
+    # Key of an archive in the archive cache
+    def _cache_key(self, archive_name):
+        return (self.endpoint_url or '') + '/' + self.bucket + '/' + archive_name
+
+    # Open a byte range of an archive, reading its cached copy when there is one
+    # Cached copies are read from 'start' on, readers stop once they found what they need
+    def _open_range(self, archive_name, start=None, end=None, cached=None):
+        if cached is None:
+            return self._open_s3_range(archive_name, start, end)
+        f = os.fdopen(os.dup(cached.fileno()), 'rb')
+        f.seek(start or 0)
+        return f
+
+    # Extract missing files from an indexed archive with ranged requests
+    # Returns False when the archive has no index or most of it is needed anyway
+    def _extract_indexed(self, archive_name, wanted, cached=None):
+        index = self._get_index(archive_name)
+        if not index or not set(wanted).issubset(index['members']):
+            return False
+        ranges = self._plan_ranges(index, wanted)
+        fetch_size = sum(x[1] - x[0] for x in ranges)
+        # Seeking into a cached copy is always cheaper than decompressing all of it
+        if cached is None and fetch_size >= index['size'] * Extractor.range_ratio:
+            return False
+        logger.info('%s \'%s\' of \'%s\' bytes of archive \'%s\' in \'%s\' range(s)', 'Fetching' if cached is None else 'Reading cached', fetch_size, index['size'], archive_name, len(ranges))
+        codec = self._codec_map[archive_name]
+        not_found = set()
+        for compressed_start, compressed_end, frame_start, members in ranges:
+            with contextlib.closing(self._open_range(archive_name, compressed_start, compressed_end, cached)) as body, \
+                    codec.open_reader(body) as reader:
+                # Skip to the header of the first wanted member
+                skip = members[0][0] - frame_start
+                while skip > 0:
+                    chunk = reader.read(min(skip, 1024 ** 2))
+                    if not chunk:
+                        raise EOFError('Unexpected end of archive \'{a}\''.format(a=archive_name))
+                    skip -= len(chunk)
+                not_found |= self._extract_stream(archive_name, reader, { x[1]: wanted[x[1]] for x in members })
+        if not_found:
+            logger.warning('File(s) \'%s\' not found in archive \'%s\'', sorted(not_found), archive_name)
+        return True
+
+    # Extract the missing files of an archive, streaming it from S3 without a temporary file
+    # With an archive cache, a cached copy matching the object's ETag is read instead, and
+    # archives streamed in full are copied into the cache on the way. Ranged reads are not cached.
+    @metrics.stage('extract')
+    def _extract_archive(self, archive_name):
+        cached = None
         try:
-            files = [ x.name for x in member_list ]
-            logger.info('Extracting file(s) \'%s\' from archive \'%s\' into directory \'%s\'', files, archive, self.directory)
-            with tarfile.open(archive, 'r:gz') as tar:
-                logger.debug('Starting extraction of \'%s\' into \'%s\'', archive, self.directory)
-                tar.extractall(path=self.directory, members=member_list)
-            logger.debug('Extraction complete')
+            wanted = self._missing_files_map[archive_name]
+            logger.info('Extracting \'%s\' file(s) from archive \'%s\' into directory \'%s\'', sum(len(x) for x in wanted.values()), archive_name, self.directory)
+            logger.debug('Files extracted from archive \'%s\': \'%s\'', archive_name, sorted(wanted))
+            head = self._head_s3(archive_name) if self.cache else None
+            etag = head['ETag'] if head else None
+            if etag:
+                cached = self.cache.get(self._cache_key(archive_name), etag)
+                metrics.count('archive_cache_hits' if cached else 'archive_cache_misses')
+            # Only fetch the frames holding missing files when possible
+            if self._extract_indexed(archive_name, wanted, cached):
+                return
+            codec = self._codec_map[archive_name]
+            with contextlib.ExitStack() as stack:
+                source = body = stack.enter_context(contextlib.closing(self._open_range(archive_name, cached=cached)))
+                if cached is None and etag:
+                    body = TeeReader(body, stack.enter_context(self.cache.put(self._cache_key(archive_name), etag, head['ContentLength'])))
+                with codec.open_reader(body) as reader:
+                    logger.debug('Starting extraction of \'%s\' into \'%s\'', archive_name, self.directory)
+                    not_found = self._extract_stream(archive_name, reader, wanted)
+                # Complete the cached copy when little is left, an incomplete copy is not cached
+                if isinstance(body, TeeReader) and head['ContentLength'] - body.bytes_read <= Extractor.cache_drain_limit:
+                    body.drain()
+                if isinstance(source, ThrottledReader):
+                    logger.info('Read \'%s\' bytes of archive \'%s\' at \'%.1f\' MB/s', source.bytes_read, archive_name, throughput(source.bytes_read, source.started))
+            if not_found:
+                logger.warning('File(s) \'%s\' not found in archive \'%s\'', sorted(not_found), archive_name)
+            logger.debug('Extraction of \'%s\' complete', archive_name)
         except Exception as error:
             raise error
+        finally:
+            if cached is not None:
+                cached.close()
 
     def extract(self):
         if self.missing_files:
             logger.debug('Missing files: \'%s\'', self.missing_files)
-            for item in self._missing_files_map:
-                archive_full_path = os.path.join(self.directory, item)
-                # Download the archive if it is not present
-                if not os.path.isfile(archive_full_path):
-                    self._download_from_s3(item, archive_full_path)
-                # Retrieve TarInfo of members that must be extracted
-                tar_members = self._get_missing_members(archive_full_path)
-                # Extract only missing files
-                self._extract_archive(archive_full_path, tar_members)
-                # Do not store archives on local disk
-                self._remove_file(archive_full_path)
+            # Create parent directories up front, so concurrent extractions do not race on them
+            for directory in set(os.path.dirname(x) for x in self.missing_files):
+                os.makedirs(os.path.join(self.directory, directory), exist_ok=True)
+            # Stream, decompress and extract several archives concurrently
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [executor.submit(self._extract_archive, item) for item in self._missing_files_map]
+                for future in futures:
+                    future.result()
+            # Restored files come from archives, do not archive them again
+            self.scanner.mark_archived(self.missing_files, restat=True)
         else:
             logger.debug('There are no files missing from the current state')
@@ -0,0 +1,111 @@
+import contextlib
+import fcntl
+import hashlib
+import os
+import tempfile
+import time
+
+from libs.logger import logger
+
+# Readable file object copying everything read through it into another file object
+class TeeReader:
+
+    def __init__(self, fileobj, copy):
+        self.fileobj = fileobj
+        self.copy = copy
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.copy.write(data)
+        self.bytes_read += len(data)
+        return data
+
+    # Copy whatever was not read yet
+    def drain(self, chunk_size=1024 ** 2):
+        while self.read(chunk_size):
+            pass
+
+# Local cache of downloaded archives, bounded to 'max_bytes' with least recently used eviction
+#
+# Entries are named after the bucket, key and ETag of their object, so an object replaced
+# in S3 never matches its old entry. Entries are written to a temporary file and renamed
+# into place, and eviction holds an exclusive lock on the cache, so concurrent runs can
+# share the same cache. An entry evicted while it is read stays readable until closed.
+class ArchiveCache:
+
+    suffix = '.archive'
+    # Temporary files older than this many seconds were left behind by a crashed run
+    stale_age = 24 * 3600
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = int(max_bytes)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key, etag):
+        return os.path.join(self.directory, hashlib.sha1((key + '\0' + etag).encode('utf-8')).hexdigest() + ArchiveCache.suffix)
+
+    # Open the entry of an object, or return None when it is not cached
+    def get(self, key, etag):
+        path = self._path(key, etag)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        # Mark the entry as recently used
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(path)
+        logger.debug('Found \'%s\' in the archive cache', key)
+        return f
+
+    # Writable file which becomes the entry of an object once the block exits without error
+    # With the 'size' of the object, a partial copy is discarded
+    @contextlib.contextmanager
+    def put(self, key, etag, size=None):
+        f = tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False)
+        try:
+            with f:
+                yield f
+            written = os.path.getsize(f.name)
+            if size is not None and written != size:
+                logger.debug('Not caching \'%s\', only \'%s\' of \'%s\' bytes were read', key, written, size)
+                os.remove(f.name)
+                return
+            if written > self.max_bytes:
+                logger.debug('Not caching \'%s\', it is larger than the archive cache', key)
+                os.remove(f.name)
+                return
+            os.replace(f.name, self._path(key, etag))
+            logger.debug('Added \'%s\' to the archive cache', key)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(f.name)
+            raise
+        self.evict()
+
+    # Remove the least recently used entries until the cache fits in 'max_bytes'
+    def evict(self):
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = []
+            now = time.time()
+            with os.scandir(self.directory) as scan:
+                for entry in scan:
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    if entry.name.endswith(ArchiveCache.suffix):
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    elif entry.name.endswith('.tmp') and now - stat.st_mtime > ArchiveCache.stale_age:
+                        with contextlib.suppress(FileNotFoundError):
+                            os.remove(entry.path)
+            total = sum(x[1] for x in entries)
+            for mtime, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+                total -= size
+                logger.debug('Evicted \'%s\' from the archive cache', path)
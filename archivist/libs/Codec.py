@@ -0,0 +1,121 @@
+import contextlib
+import gzip
+import threading
+
+# Optional codecs, only required when selected with '--codec'
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Base class
+# A codec compresses independent blocks whose concatenation is a valid stream for its decoder
+class Codec:
+
+    name = None
+    suffix = None
+    default_level = None
+    levels = range(0)
+
+    def __init__(self, level=None):
+        if level is not None and not self.levels:
+            raise ValueError('Codec \'{c}\' does not take a level'.format(c=self.name))
+        self.level = self.default_level if level is None else int(level)
+        if self.levels and self.level not in self.levels:
+            raise ValueError('Invalid level \'{l}\' for codec \'{c}\'. Must be between {lo} and {hi}'.format(
+                l=self.level, c=self.name, lo=self.levels[0], hi=self.levels[-1]))
+
+    def __str__(self):
+        return self.name
+
+    # Compress a block into a self-contained member/frame
+    def compress_block(self, block):
+        raise NotImplementedError
+
+    # Wrap a readable file object into a readable stream of decompressed data
+    def open_reader(self, fileobj):
+        raise NotImplementedError
+
+class GzipCodec(Codec):
+
+    name = 'gzip'
+    suffix = '.tgz'
+    default_level = 6
+    levels = range(1, 10)
+
+    def compress_block(self, block):
+        return gzip.compress(block, compresslevel=self.level, mtime=0)
+
+    def open_reader(self, fileobj):
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+
+class ZstdCodec(Codec):
+
+    name = 'zstd'
+    suffix = '.tar.zst'
+    default_level = 3
+    levels = range(1, 23)
+
+    def __init__(self, *args, **kwargs):
+        if zstandard is None:
+            raise ValueError('Codec \'zstd\' requires the \'zstandard\' package, install it with \'pip install -r requirements-codecs.txt\'')
+        Codec.__init__(self, *args, **kwargs)
+        # Compressor contexts are not thread safe, keep one per worker thread
+        self._local = threading.local()
+
+    def compress_block(self, block):
+        try:
+            compressor = self._local.compressor
+        except AttributeError:
+            compressor = self._local.compressor = zstandard.ZstdCompressor(level=self.level)
+        return compressor.compress(block)
+
+    def open_reader(self, fileobj):
+        return zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True)
+
+class Lz4Codec(Codec):
+
+    name = 'lz4'
+    suffix = '.tar.lz4'
+    default_level = 0
+    levels = range(0, 17)
+
+    def __init__(self, *args, **kwargs):
+        if lz4 is None:
+            raise ValueError('Codec \'lz4\' requires the \'lz4\' package, install it with \'pip install -r requirements-codecs.txt\'')
+        Codec.__init__(self, *args, **kwargs)
+
+    def compress_block(self, block):
+        return lz4.frame.compress(block, compression_level=self.level)
+
+    def open_reader(self, fileobj):
+        return lz4.frame.open(fileobj, mode='rb')
+
+# Plain tar, for data which is already compressed
+class NoneCodec(Codec):
+
+    name = 'none'
+    suffix = '.tar'
+
+    def compress_block(self, block):
+        return block
+
+    # Readers are used as context managers, which wrapped file objects may not support
+    def open_reader(self, fileobj):
+        return contextlib.nullcontext(fileobj)
+
+codecs = {codec.name: codec for codec in (GzipCodec, ZstdCodec, Lz4Codec, NoneCodec)}
+
+# Build a codec from a '<name>[:<level>]' specification
+def get_codec(spec):
+    name, _, level = str(spec).partition(':')
+    try:
+        codec = codecs[name]
+    except KeyError:
+        raise ValueError('Unknown codec \'{c}\'. Must be one of {n}'.format(c=name, n=list(codecs)))
+    return codec(int(level) if level else None)
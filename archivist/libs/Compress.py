@@ -0,0 +1,79 @@
+import collections
+
+from libs.metrics import metrics
+
+# Writable file object which compresses fixed size blocks on a shared executor
+# Every block becomes an independent member/frame of the codec. Blocks are written
+# in order, so the output is a regular multi-member stream (pigz style)
+# The (uncompressed offset, compressed offset) of every frame is kept in 'frames',
+# which allows decompressing any range of the stream from the nearest frame
+class ParallelCompressor:
+
+    block_size = 1024 ** 2
+
+    def __init__(self, fileobj, executor, codec, max_pending=8):
+        self.fileobj = fileobj
+        self.executor = executor
+        self.codec = codec
+        self.max_pending = max(int(max_pending), 1)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames = []
+        self._frame_start = 0
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            for length, future in self._pending:
+                future.cancel()
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.bytes_in
+
+    def write(self, data):
+        self._buffer += data
+        self.bytes_in += len(data)
+        while len(self._buffer) >= ParallelCompressor.block_size:
+            self._submit(bytes(self._buffer[:ParallelCompressor.block_size]))
+            del self._buffer[:ParallelCompressor.block_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    # Queue a block for compression, writing out finished blocks once too many are pending
+    def _submit(self, block):
+        self._pending.append((len(block), self.executor.submit(self._compress, block)))
+        while len(self._pending) >= self.max_pending:
+            self._write_next()
+
+    @metrics.stage('compress')
+    def _compress(self, block):
+        return self.codec.compress_block(block)
+
+    # Write the oldest pending block to the underlying file object
+    def _write_next(self):
+        length, future = self._pending.popleft()
+        data = future.result()
+        self.frames.append((self._frame_start, self.bytes_out))
+        self._frame_start += length
+        self.fileobj.write(data)
+        self.bytes_out += len(data)
+
+    # Compress the remaining buffer and drain all pending blocks
+    # The underlying file object is left open
+    def close(self):
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self._write_next()
@@ -0,0 +1,28 @@
+import hashlib
+
+# Content hashes identifying file blobs, for deduplication
+algorithm = 'sha256'
+
+# Readable file object hashing everything read through it
+# Lets tarfile hash a file while it is added to an archive, without reading it twice
+class HashingReader:
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self._hash = hashlib.new(algorithm)
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self._hash.update(data)
+        return data
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+# Hash the content of a file
+def hash_file(path, chunk_size=1024 ** 2):
+    with open(path, 'rb') as f:
+        reader = HashingReader(f)
+        while reader.read(chunk_size):
+            pass
+    return reader.hexdigest()
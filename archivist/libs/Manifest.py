@@ -0,0 +1,232 @@
+import gzip
+import json
+import os
+import pickle
+import uuid
+
+from datetime import datetime
+
+from libs.logger import logger
+
+# Append-only state manifest stored as immutable objects under '<state_file>.d/'
+#
+# Every archive adds a small gzip compressed, newline delimited JSON delta object.
+# Object keys start with a UTC timestamp, so listing order is chronological and the
+# latest record of a relative path wins. Once too many objects accumulate they are
+# compacted into a single snapshot object. A legacy JSON state file at '<state_file>'
+# is read as the oldest object and folded into the first snapshot.
+#
+# The latest records are read once and kept in memory, later calls only read objects
+# which appeared since the objects were last listed, for long running processes.
+# The first delta is preceded by an empty '<state_file>.d/identity-<id>' marker object. The
+# marker survives compactions, and a state which was deleted and started over gets a new one,
+# so local caches can tell they were built against another state.
+#
+# With a 'cache_file', the latest records and the objects they were read from are also
+# persisted locally, so a later run only lists the objects and reads the ones it has not
+# seen yet. An unchanged state costs a single listing request.
+class Manifest:
+
+    suffix = '.ndjson.gz'
+    compact_threshold = 64
+    identity_prefix = 'identity-'
+
+    def __init__(self, store, name, cache_file=None):
+        self.store = store
+        self.name = name
+        self.prefix = name + '.d/'
+        self.cache_file = cache_file
+        self._objects = None
+        self._identities = []
+        self._has_legacy = False
+        self._legacy_etag = None
+        self._latest = None
+        self._read = []
+        # Listing the latest records are up to date with
+        self._loaded = None
+        self._dirty = False
+
+    # Keys of all manifest objects in chronological order, listed once per run
+    @property
+    def objects(self):
+        if self._objects is None:
+            keys = sorted(x['Key'] for x in self.store._list_s3(self.prefix))
+            self._objects = [x for x in keys if x.endswith(Manifest.suffix)]
+            self._identities = [x for x in keys if x[len(self.prefix):].startswith(Manifest.identity_prefix)]
+        return self._objects
+
+    # Key of the identity marker of the state, None when the state is empty
+    # Nodes racing to start a state each write a marker, the first one in listing order wins
+    def identity(self):
+        self.objects
+        return self._identities[0] if self._identities else None
+
+    # List the objects again on next access
+    def refresh(self):
+        self._objects = None
+
+    # Build a new object key, optionally reusing the timestamp of an existing key
+    def _new_key(self, kind, timestamp=None):
+        if timestamp is None:
+            timestamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+        return self.prefix + timestamp + '-' + kind + '-' + uuid.uuid4().hex[:8] + Manifest.suffix
+
+    def _encode(self, records):
+        lines = ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in records)
+        return gzip.compress(lines.encode('utf-8'), mtime=0)
+
+    # Yield the records of a single manifest object
+    def _read_object(self, key):
+        content = self.store._read_from_s3(object_name=key, decode=False)
+        if not content:
+            return
+        for line in gzip.decompress(content).splitlines():
+            if line:
+                yield json.loads(line)
+
+    # Yield the records of the legacy JSON state file, if there is one
+    def _read_legacy(self):
+        content, self._legacy_etag = self.store._read_if_changed(object_name=self.name)
+        if content:
+            self._has_legacy = True
+            yield from json.loads(content)
+
+    # Whether the legacy JSON state file changed since it was read
+    def _legacy_changed(self):
+        if self._legacy_etag is None:
+            return False
+        content, etag = self.store._read_if_changed(object_name=self.name, etag=self._legacy_etag)
+        return etag != self._legacy_etag
+
+    # Yield the latest record of every relative path
+    def records(self):
+        yield from self._load().values()
+
+    # Load the records persisted by a previous run
+    def _load_cache(self):
+        if not self.cache_file or not os.path.isfile(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'rb') as f:
+                cache = pickle.load(f)
+            self._latest, self._read, self._legacy_etag = cache['latest'], cache['read'], cache['legacy_etag']
+            self._has_legacy = self._legacy_etag is not None
+            logger.debug('Loaded \'%s\' cached state records from \'%s\'', len(self._latest), self.cache_file)
+        except Exception:
+            logger.warning('Ignoring unreadable state cache \'%s\'', self.cache_file)
+
+    # Persist the records for the next run, if they changed
+    def save(self):
+        if not self.cache_file or not self._dirty or self._latest is None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_file)), exist_ok=True)
+        temp_file = self.cache_file + '.' + str(os.getpid()) + '.tmp'
+        with open(temp_file, 'wb') as f:
+            pickle.dump({ 'latest': self._latest, 'read': self._read, 'legacy_etag': self._legacy_etag }, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, self.cache_file)
+        self._dirty = False
+        logger.debug('Saved state cache \'%s\'', self.cache_file)
+
+    # Bring the in-memory records up to date, only reading objects not read yet
+    def _load(self):
+        if self._latest is not None and self._loaded is self._objects:
+            return self._latest
+        if self._latest is None:
+            self._load_cache()
+        objects = set(self.objects)
+        # Forget objects removed by a compaction, their records live on in its snapshot
+        read = [key for key in self._read if key in objects]
+        unread = sorted(objects.difference(read))
+        # Start over when an object appeared before one already read, like a concurrent compaction,
+        # or when the legacy state file changed
+        if self._latest is None or (unread and read and unread[0] < read[-1]) or self._legacy_changed():
+            self._latest = {}
+            read = []
+            unread = list(self.objects)
+            for record in self._read_legacy():
+                self._latest[record['relative_path']] = record
+            self._dirty = True
+        self._dirty |= read != self._read or bool(unread)
+        self._read = read
+        for key in unread:
+            for record in self._read_object(key):
+                self._latest[record['relative_path']] = record
+            self._read.append(key)
+        self._loaded = self._objects
+        return self._latest
+
+    # Set of every relative path recorded in the manifest
+    def paths(self):
+        return set(record['relative_path'] for record in self.records())
+
+    # Latest record of every relative path accepted by 'predicate'
+    def select(self, predicate):
+        selected = {}
+        for record in self.records():
+            if predicate(record['relative_path']):
+                selected[record['relative_path']] = record
+        return selected
+
+    # Latest record of every relative path in 'paths' known to the manifest
+    def lookup(self, paths):
+        latest = self._load()
+        return { x: latest[x] for x in paths if x in latest }
+
+    # Record of a stored copy of every content hash, for deduplication
+    # Archives are never modified, so any record ever holding a hash can serve it
+    def blobs(self):
+        blobs = {}
+        for record in self.records():
+            if 'hash' in record:
+                blobs.setdefault(record['hash'], record)
+        return blobs
+
+    # Write a delta object holding 'records'
+    def append(self, records):
+        if self.identity() is None:
+            identity = self.prefix + Manifest.identity_prefix + uuid.uuid4().hex
+            self.store._write_to_s3(data=b'', object_name=identity)
+            self._identities = [identity]
+        key = self._new_key('delta')
+        self.store._write_to_s3(data=self._encode(records), object_name=key)
+        self.objects.append(key)
+        if self._latest is not None:
+            for record in records:
+                self._latest[record['relative_path']] = record
+            self._read.append(key)
+            self._dirty = True
+        return key
+
+    # Fold all objects listed in this run into a single snapshot once there are enough of them,
+    # or right away to migrate a legacy state file
+    # The snapshot takes the timestamp of the newest object it holds. Objects are only deleted
+    # after it has been written and the objects were listed again: an object written meanwhile
+    # and ordered before the snapshot would be overridden by its older records, so the snapshot
+    # is deleted again and compaction is left to a later run. Records are never lost.
+    def compact(self, force=False):
+        # Reading the records tells whether there is a legacy state file to migrate
+        latest = self._load()
+        keys = list(self.objects)
+        if not force and not self._has_legacy and len(keys) < Manifest.compact_threshold:
+            return None
+        timestamp = keys[-1][len(self.prefix):].split('-', 1)[0] if keys else None
+        key = self._new_key('snapshot', timestamp)
+        self.store._write_to_s3(data=self._encode(latest.values()), object_name=key)
+        self.refresh()
+        unlisted = [x for x in self.objects if x not in keys and x < key]
+        if unlisted or self._legacy_changed():
+            logger.warning('State changed while compacting \'%s\' manifest objects, compacting later', len(keys))
+            self.store._delete_from_s3([key])
+            self.refresh()
+            return None
+        self.store._delete_from_s3(keys + [self.name])
+        # Objects written after the snapshot are read on top of it
+        self._objects = [x for x in self._objects if x not in keys]
+        self._has_legacy = False
+        self._legacy_etag = None
+        self._latest = latest
+        self._read = [key]
+        self._loaded = None
+        self._dirty = True
+        logger.info('Compacted \'%s\' manifest objects into \'%s\'', len(keys), key)
+        return key
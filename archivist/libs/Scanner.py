@@ -0,0 +1,192 @@
+import os
+import pickle
+import time
+
+from libs.logger import logger
+
+# Directory scanner keeping a persisted index of the tree
+#
+# The index maps every directory (relative to the scanned directory, '' for the root) to
+# [mtime_ns, { file name: (size, mtime_ns, inode, flag) }, [sub-directory names]].
+# The flag tracks whether a file is known to be archived, and survives scans by other users
+# of the same index, so a modification is never lost before it is archived.
+# File names are stored per directory rather than as full paths, which keeps memory low on
+# large trees. The listing of a directory whose mtime did not change since the previous scan
+# is reused, only its files are stat'ed to detect modifications.
+# The index also keeps the 'identity' of the state the flags were set against.
+class Scanner:
+
+    # Version of the persisted index, older indexes are read without an identity
+    version = 2
+
+    # Directories modified within this many nanoseconds of a scan are listed again next time,
+    # as further changes in the same mtime tick would go unnoticed
+    racy_ns = 2 * (10 ** 9)
+
+    # File flags
+    UNKNOWN = 0
+    ARCHIVED = 1
+    MODIFIED = 2
+
+    def __init__(self, directory, index_file=None, exclude=()):
+        self.directory = directory
+        self.index_file = index_file
+        self.exclude = set(os.path.normpath(x) for x in exclude)
+        self.new = []
+        self.modified = []
+        self.deleted = []
+        self.identity = None
+        self._index = {}
+        self._previous = self._load()
+
+    # Load the index persisted by a previous scan
+    def _load(self):
+        if not self.index_file or not os.path.isfile(self.index_file):
+            return {}
+        try:
+            with open(self.index_file, 'rb') as f:
+                index = pickle.load(f)
+            if isinstance(index, tuple) and index[0] == Scanner.version:
+                _, self.identity, index = index
+            logger.debug('Loaded scan index \'%s\' of \'%s\' directories', self.index_file, len(index))
+            return index
+        except Exception:
+            logger.warning('Ignoring unreadable scan index \'%s\'', self.index_file)
+            return {}
+
+    # Persist the index for the next scan
+    def save(self):
+        if not self.index_file:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_file)), exist_ok=True)
+        temp_file = self.index_file + '.' + str(os.getpid()) + '.tmp'
+        with open(temp_file, 'wb') as f:
+            pickle.dump((Scanner.version, self.identity, self._index), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, self.index_file)
+        logger.debug('Saved scan index \'%s\'', self.index_file)
+
+    def _join(self, root, name):
+        return os.path.join(root, name) if root else name
+
+    # List a directory, returning its files and sub-directories
+    def _list(self, root, path):
+        files = {}
+        dirs = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                relative_path = self._join(root, entry.name)
+                if relative_path in self.exclude:
+                    continue
+                # Like os.walk, do not descend into symlinks to directories
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        dirs.append(entry.name)
+                    continue
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                files[entry.name] = (stat.st_size, stat.st_mtime_ns, stat.st_ino, Scanner.UNKNOWN)
+        return files, dirs
+
+    # Stat the files of a directory whose listing did not change
+    def _restat(self, root, path, previous_files):
+        files = {}
+        for name in previous_files:
+            try:
+                stat = os.stat(os.path.join(path, name), follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            files[name] = (stat.st_size, stat.st_mtime_ns, stat.st_ino, Scanner.UNKNOWN)
+        return files
+
+    # Walk the directory, recording new, modified and deleted files since the previous scan
+    def scan(self):
+        self.new, self.modified, self.deleted = [], [], []
+        self._index = {}
+        now_ns = time.time_ns()
+        stack = ['']
+        while stack:
+            root = stack.pop()
+            path = os.path.join(self.directory, root)
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            previous = self._previous.get(root)
+            if previous and previous[0] == mtime_ns:
+                files = self._restat(root, path, previous[1])
+                dirs = previous[2]
+            else:
+                files, dirs = self._list(root, path)
+            previous_files = previous[1] if previous else {}
+            for name, stat in files.items():
+                before = previous_files.get(name)
+                if before is None:
+                    self.new.append(self._join(root, name))
+                elif before[:2] != stat[:2]:
+                    self.modified.append(self._join(root, name))
+                    # Archived files must be archived again
+                    if before[3] != Scanner.UNKNOWN:
+                        files[name] = stat[:3] + (Scanner.MODIFIED,)
+                else:
+                    # Carry the flag over unchanged files
+                    files[name] = stat[:3] + before[3:]
+            for name in previous_files:
+                if name not in files:
+                    self.deleted.append(self._join(root, name))
+            self._index[root] = [None if now_ns - mtime_ns < Scanner.racy_ns else mtime_ns, files, dirs]
+            stack.extend(self._join(root, x) for x in dirs)
+        # Files of directories which disappeared entirely
+        for root, previous in self._previous.items():
+            if root not in self._index:
+                self.deleted.extend(self._join(root, x) for x in previous[1])
+        self._previous = self._index
+        logger.debug('Scanned \'%s\': \'%s\' new, \'%s\' modified, \'%s\' deleted', self.directory, len(self.new), len(self.modified), len(self.deleted))
+        return self
+
+    def __contains__(self, relative_path):
+        root, name = os.path.split(relative_path)
+        entry = self._index.get(root)
+        return entry is not None and name in entry[1]
+
+    def __iter__(self):
+        for root, entry in self._index.items():
+            for name in entry[1]:
+                yield self._join(root, name)
+
+    def __len__(self):
+        return sum(len(x[1]) for x in self._index.values())
+
+    # Files which have not been marked as archived yet, as (relative path, modified since archived)
+    def unarchived(self):
+        for root, entry in self._index.items():
+            for name, stat in entry[1].items():
+                if stat[3] != Scanner.ARCHIVED:
+                    yield self._join(root, name), stat[3] == Scanner.MODIFIED
+
+    # Forget which files are archived, e.g. once the state they were archived to is gone
+    # Modified files keep their flag, they must be archived again whatever the state holds
+    def reset_archived(self):
+        for entry in self._index.values():
+            for name, stat in entry[1].items():
+                if stat[3] == Scanner.ARCHIVED:
+                    entry[1][name] = stat[:3] + (Scanner.UNKNOWN,)
+
+    # Flag files as archived, so later scans only report them again when modified
+    # With 'restat', files are stat'ed again and added to the index, e.g. once restored from an archive
+    def mark_archived(self, relative_paths, restat=False):
+        for relative_path in relative_paths:
+            root, name = os.path.split(relative_path)
+            entry = self._index.get(root)
+            if restat:
+                try:
+                    stat = os.stat(os.path.join(self.directory, relative_path), follow_symlinks=False)
+                except FileNotFoundError:
+                    continue
+                if entry is None:
+                    # Unknown directory, list it again on the next scan
+                    entry = self._index[root] = [None, {}, []]
+                entry[1][name] = (stat.st_size, stat.st_mtime_ns, stat.st_ino, Scanner.ARCHIVED)
+            elif entry is not None and name in entry[1]:
+                entry[1][name] = entry[1][name][:3] + (Scanner.ARCHIVED,)
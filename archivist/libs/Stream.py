@@ -0,0 +1,146 @@
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from libs.logger import logger
+from libs.metrics import metrics
+from libs.Transfer import throughput
+
+# Writable file object which streams its contents into an S3 multipart upload
+# At most 'max_inflight' parts are buffered or uploading at once, on up to 'max_concurrency'
+# threads, so memory is bounded to roughly 'part_size * (max_inflight + 1)' bytes whatever
+# the concurrency. The first failed part aborts the upload on the next write.
+# The size of the object is not known up front, so the part size doubles every
+# 'grow_every' parts to stay within the 10000 parts S3 allows
+class S3MultipartWriter:
+
+    # S3 rejects non-final parts smaller than 5MB
+    min_part_size = 5 * (1024 ** 2)
+    grow_every = 1000
+
+    def __init__(self, s3, bucket, key, part_size=64, max_inflight=2, max_concurrency=None, throttle=None):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.name = key
+        self.part_size = max(int(part_size * (1024 ** 2)), S3MultipartWriter.min_part_size)
+        self.max_inflight = max(int(max_inflight), 1)
+        self.max_concurrency = min(int(max_concurrency or self.max_inflight), self.max_inflight)
+        self.throttle = throttle
+        self.bytes_written = 0
+        self._started = time.monotonic()
+        self._buffer = bytearray()
+        self._futures = []
+        # First exception raised by a part upload
+        self._error = None
+        self._slots = threading.BoundedSemaphore(self.max_inflight)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        self._closed = False
+        response = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key)
+        self._upload_id = response['UploadId']
+        logger.debug('Started multipart upload of \'%s\' to S3 bucket \'%s\'', self.key, self.bucket)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.bytes_written
+
+    def write(self, data):
+        self._check()
+        self._buffer += data
+        self.bytes_written += len(data)
+        # Hand off every full part to the upload pool
+        while len(self._buffer) >= self.part_size:
+            self._submit(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+            if len(self._futures) % S3MultipartWriter.grow_every == 0:
+                self.part_size *= 2
+        return len(data)
+
+    def flush(self):
+        pass
+
+    # Raise the error of a failed part upload, instead of compressing the rest of the object in vain
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    # Release the slot of an uploaded part, keeping the first error
+    def _done(self, future):
+        if not future.cancelled() and future.exception() is not None and self._error is None:
+            self._error = future.exception()
+        self._slots.release()
+
+    # Queue a part for upload, blocking while 'max_inflight' parts are already in flight
+    def _submit(self, body):
+        self._slots.acquire()
+        part_number = len(self._futures) + 1
+        try:
+            self._check()
+            future = self._executor.submit(self._upload_part, part_number, body)
+        except Exception as error:
+            self._slots.release()
+            raise error
+        future.add_done_callback(self._done)
+        self._futures.append(future)
+
+    @metrics.stage('upload')
+    def _upload_part(self, part_number, body):
+        if self.throttle is not None:
+            self.throttle.consume(len(body))
+        response = self.s3.upload_part(
+            Body=body,
+            Bucket=self.bucket,
+            Key=self.key,
+            PartNumber=part_number,
+            UploadId=self._upload_id
+        )
+        metrics.count('bytes_uploaded', len(body))
+        logger.debug('Uploaded part \'%s\' of \'%s\' (%s bytes)', part_number, self.key, len(body))
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    # Upload the remaining buffer and complete the multipart upload
+    def close(self):
+        if self._closed:
+            return
+        try:
+            # S3 requires at least one part, even for an empty object
+            if self._buffer or not self._futures:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            parts = [future.result() for future in self._futures]
+            self.s3.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self._upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+            self._closed = True
+            self._executor.shutdown()
+            logger.info('Streamed \'%s\' bytes to S3 bucket \'%s\' as \'%s\' at \'%.1f\' MB/s', self.bytes_written, self.bucket, self.key, throughput(self.bytes_written, self._started))
+        except Exception as error:
+            self.abort()
+            raise error
+
+    # Discard all uploaded parts
+    def abort(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._executor.shutdown(cancel_futures=True)
+        try:
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+            logger.warning('Aborted multipart upload of \'%s\' to S3 bucket \'%s\'', self.key, self.bucket)
+        except Exception:
+            logger.exception('Failed to abort multipart upload of \'%s\'', self.key)
@@ -0,0 +1,87 @@
+import math
+import threading
+import time
+
+from libs.metrics import metrics
+
+# S3 transfer settings shared by every client, upload and download of a run
+class Transfer:
+
+    # S3 limits a multipart upload to this many parts
+    max_parts = 10000
+    # S3 rejects non-final parts smaller than 5MB
+    min_part_size = 5 * (1024 ** 2)
+
+    def __init__(self, multipart_threshold=64, part_size=64, max_concurrency=10, max_pool_connections=None, retries=5, bandwidth_limit=0, max_inflight_parts=2):
+        self.multipart_threshold = int(multipart_threshold * (1024 ** 2))
+        self.part_size = max(int(part_size * (1024 ** 2)), Transfer.min_part_size)
+        self.max_concurrency = max(int(max_concurrency), 1)
+        # Parts of a streamed archive held in memory at once, which bounds its memory rather than
+        # 'max_concurrency': up to 'part_size * (max_inflight_parts + 1)' bytes per archive
+        self.max_inflight_parts = max(int(max_inflight_parts), 1)
+        # Concurrent archives and multipart uploads each need connections of their own
+        self.max_pool_connections = int(max_pool_connections or 4 * self.max_concurrency)
+        self.retries = int(retries)
+        self.throttle = Throttle(float(bandwidth_limit or 0) * (1024 ** 2))
+
+    # Configuration of the S3 client
+    def client_config(self):
+        from botocore.config import Config
+        return Config(max_pool_connections=self.max_pool_connections, retries={'max_attempts': self.retries, 'mode': 'standard'})
+
+    # Part size of an object of 'size' bytes, grown so the object fits in 'max_parts' parts
+    def part_size_for(self, size):
+        part_size = max(self.part_size, math.ceil(size / Transfer.max_parts))
+        # Round up to a whole MB
+        return -(-part_size // (1024 ** 2)) * (1024 ** 2)
+
+    # Configuration of a managed upload or download of an object of 'size' bytes
+    def transfer_config(self, size):
+        from boto3.s3.transfer import TransferConfig
+        return TransferConfig(
+            multipart_threshold=self.multipart_threshold,
+            multipart_chunksize=self.part_size_for(size),
+            max_concurrency=self.max_concurrency
+        )
+
+# Token bucket shared by every transfer of a run, capping their aggregate bandwidth
+# Each caller reserves the time its bytes take at 'rate' and waits for its turn
+class Throttle:
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        if not self.rate or amount <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + amount / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+# Readable file object counting, and throttling, the bytes read through it
+class ThrottledReader:
+
+    def __init__(self, fileobj, throttle):
+        self.fileobj = fileobj
+        self.throttle = throttle
+        self.bytes_read = 0
+        self.started = time.monotonic()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.bytes_read += len(data)
+        self.throttle.consume(len(data))
+        return data
+
+    def close(self):
+        metrics.count('bytes_downloaded', self.bytes_read)
+        self.fileobj.close()
+
+# Throughput of 'size' bytes transferred since 'started', as MB/s
+def throughput(size, started):
+    return size / (1024 ** 2) / max(time.monotonic() - started, 1e-6)
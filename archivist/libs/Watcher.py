@@ -0,0 +1,189 @@
+import os
+import time
+
+from datetime import datetime
+
+from libs.Archive import ArchiveTemplate, Archiver, Extractor
+from libs.Inotify import Inotify, IN_CLOSE_WRITE, IN_CREATE, IN_DELETE, IN_DONT_FOLLOW, IN_IGNORED, IN_ISDIR, IN_MOVED_FROM, IN_MOVED_TO, IN_ONLYDIR, IN_Q_OVERFLOW
+from libs.logger import logger
+from libs.metrics import metrics
+
+# ArchiveTemplate subclass archiving written files and restoring deleted files as they happen
+# The S3 client, the state and the scan index are kept warm and shared by every batch
+class Watcher(ArchiveTemplate):
+
+    scan_index = 'watch'
+
+    watch_mask = IN_CLOSE_WRITE | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR | IN_DONT_FOLLOW
+
+    # Seconds to let a deletion settle before restoring, the file may be replaced by a rename
+    restore_delay = 1
+    # Seconds before retrying with a rescan after a failed batch
+    retry_delay = 30
+
+    def __init__(self, name, max = 30, stream = False, workers = None, codec = 'gzip', dedup = False, jobs = 2,
+                 batch_size = 1024, batch_interval = 60, rescan_interval = 3600, archive_cache_size = 0, *args, **kwargs):
+        ArchiveTemplate.__init__(self, *args, **kwargs)
+        self.batch_bytes = int(batch_size) * (1024 ** 2)
+        self.batch_interval = int(batch_interval)
+        self.rescan_interval = int(rescan_interval)
+        self._archive_kwargs = dict(name=name, max=max, stream=stream, workers=workers, codec=codec, dedup=dedup, jobs=jobs)
+        self._extract_kwargs = dict(workers=workers, archive_cache_size=archive_cache_size)
+        self._shared_kwargs = dict(kwargs, client=self.s3, manifest=self.manifest, scanner=self.scanner)
+        self._inotify = None
+        self._watches = {}
+        # Files written since the last batch, { relative path: size }
+        self._pending = {}
+        self._pending_bytes = 0
+        self._pending_since = None
+        # Files deleted and waiting to be restored, { relative path: time of deletion }
+        self._deleted = {}
+        # Files restored by ourselves, whose events must not trigger an archive
+        self._ignored = set()
+        # Archives staged in the directory by ourselves
+        self._archives = set()
+        self._last_timestamp = None
+        self._next_rescan = 0
+
+    def _join(self, root, name):
+        return os.path.join(root, name) if root else name
+
+    # Watch a directory and all of its sub-directories, returns the files found in them
+    def _watch_tree(self, relative_path):
+        found = []
+        for root, dirs, files in os.walk(os.path.join(self.directory, relative_path)):
+            root_path = os.path.relpath(root, self.directory)
+            root_path = '' if root_path == os.curdir else root_path
+            dirs[:] = [x for x in dirs if self._join(root_path, x) not in self.scanner.exclude]
+            try:
+                wd = self._inotify.add_watch(root, Watcher.watch_mask)
+            except OSError as error:
+                logger.warning('Cannot watch directory \'%s\', relying on rescans: %s', root, error)
+                continue
+            self._watches[wd] = root_path
+            found.extend(self._join(root_path, x) for x in files if self._join(root_path, x) not in self.scanner.exclude)
+        return found
+
+    # Queue a written file for the next archive batch
+    def _queue(self, relative_path):
+        if relative_path in self._archives:
+            return
+        if relative_path in self._ignored:
+            self._ignored.discard(relative_path)
+            return
+        try:
+            size = os.lstat(os.path.join(self.directory, relative_path)).st_size
+        except FileNotFoundError:
+            return
+        self._deleted.pop(relative_path, None)
+        self._pending_bytes += size - self._pending.get(relative_path, 0)
+        self._pending[relative_path] = size
+        if self._pending_since is None:
+            self._pending_since = time.monotonic()
+
+    def _handle(self, wd, mask, cookie, name):
+        if mask & IN_Q_OVERFLOW:
+            logger.warning('Inotify event queue overflowed, rescanning \'%s\'', self.directory)
+            self._next_rescan = 0
+            return
+        root = self._watches.get(wd)
+        if root is None:
+            return
+        if mask & IN_IGNORED:
+            del self._watches[wd]
+            return
+        relative_path = self._join(root, name)
+        if not name or relative_path in self.scanner.exclude:
+            return
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                for x in self._watch_tree(relative_path):
+                    self._queue(x)
+            elif mask & IN_MOVED_FROM:
+                # Files moved away with their directory do not get events of their own
+                self._next_rescan = min(self._next_rescan, time.monotonic() + Watcher.restore_delay)
+        elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            self._queue(relative_path)
+        elif mask & (IN_DELETE | IN_MOVED_FROM):
+            if relative_path in self._archives:
+                self._archives.discard(relative_path)
+                return
+            self._pending_bytes -= self._pending.pop(relative_path, 0)
+            self._deleted[relative_path] = time.monotonic()
+
+    # Seconds until the next batch, restore or rescan is due
+    def _timeout(self):
+        deadlines = [self._next_rescan]
+        if self._pending_since is not None:
+            deadlines.append(self._pending_since + self.batch_interval)
+        if self._deleted:
+            deadlines.append(min(self._deleted.values()) + Watcher.restore_delay)
+        return max(min(deadlines) - time.monotonic(), 0)
+
+    # Archive a list of written files, or every new file of the last full scan
+    # Returns the files archived
+    def _archive(self, files=None):
+        # Archive names have a resolution of one second
+        while datetime.utcnow().isoformat(timespec='seconds').replace(':','') == self._last_timestamp:
+            time.sleep(0.1)
+        self.manifest.refresh()
+        with Archiver(files=files, scan=False, **self._archive_kwargs, **self._shared_kwargs) as archiver:
+            archiver.create()
+            self._archives.update(x[0] for x in archiver._archive_list)
+            self._last_timestamp = archiver.timestamp
+            return set(archiver.new_files)
+
+    # Restore a list of deleted files, or every missing file of the last full scan
+    def _restore(self, files=None):
+        self.manifest.refresh()
+        with Extractor(files=files, scan=False, **self._extract_kwargs, **self._shared_kwargs) as extractor:
+            self._ignored.update(extractor.missing_files)
+            extractor.extract()
+
+    # Full cycle, catching up with anything events did not report
+    # A single scan is shared by the restore and the archive
+    def _rescan(self):
+        logger.debug('Rescanning \'%s\'', self.directory)
+        self._ignored.clear()
+        with metrics.stage('scan'):
+            self.scanner.scan()
+        metrics.count('files_scanned', len(self.scanner))
+        self._restore()
+        archived = self._archive()
+        # Written files archived by the rescan must not be archived again by their batch
+        for x in archived.intersection(self._pending):
+            self._pending_bytes -= self._pending.pop(x)
+        if not self._pending:
+            self._pending_bytes, self._pending_since = 0, None
+        self._next_rescan = time.monotonic() + self.rescan_interval
+
+    # Run batches which are due
+    def _process(self):
+        now = time.monotonic()
+        settled = [x for x, deleted in self._deleted.items() if now - deleted >= Watcher.restore_delay]
+        if settled:
+            for x in settled:
+                del self._deleted[x]
+            logger.info('Restoring \'%s\' deleted file(s)', len(settled))
+            self._restore(settled)
+        if self._pending and (self._pending_bytes >= self.batch_bytes or now - self._pending_since >= self.batch_interval):
+            files = list(self._pending)
+            self._pending, self._pending_bytes, self._pending_since = {}, 0, None
+            logger.info('Archiving \'%s\' written file(s)', len(files))
+            self._archive(files)
+        if now >= self._next_rescan:
+            self._rescan()
+
+    def run(self):
+        with Inotify() as self._inotify:
+            self._watch_tree('')
+            logger.info('Watching \'%s\' directories under \'%s\'', len(self._watches), self.directory)
+            while True:
+                try:
+                    self._process()
+                    metrics.save()
+                except Exception:
+                    logger.exception('Batch failed, retrying with a rescan in \'%s\' seconds', Watcher.retry_delay)
+                    self._next_rescan = time.monotonic() + Watcher.retry_delay
+                for event in self._inotify.read(self._timeout()):
+                    self._handle(*event)
@@ -1,10 +1,23 @@
 import argparse
+import os
+
+from libs.Codec import get_codec
+
+# Validate a '<codec>[:<level>]' argument
+def codec_spec(arg_value):
+    try:
+        get_codec(arg_value)
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+    return arg_value
 
 # Read command line args
 # Top level parser
 parser = argparse.ArgumentParser(description="This tools helps monitor a directory and archive new files, or extract missing files from archives uploaded onto S3")
 parser.add_argument("--debug", help="Set logging to Debug", action='store_true', required=False)
 parser.add_argument("--disable_logging", help="Disable logging", action='store_true', required=False)
+parser.add_argument("--metrics_file", type=str, help="Write timings and counters of every stage to this file, in the Prometheus text format when it ends with '.prom', as JSON otherwise", default=None, required=False)
+parser.add_argument("--profile", type=str, help="Profile the run with cProfile and write the stats to this file", default=None, required=False)
 
 # Parent parser
 parent_parser = argparse.ArgumentParser(add_help=False)
@@ -14,18 +27,47 @@ parent_parser.add_argument("-d", "--directory", type=str, help="Directory to run
 parent_parser.add_argument("-i", "--key_id", type=str, help="S3 Key ID to use", required=True)
 parent_parser.add_argument("-k", "--key_secret", type=str, help="S3 Key Secret to use", required=True)
 parent_parser.add_argument("-s", "--state_file", type=str, help="State file to use", default="archived_files.state", required=False)
+parent_parser.add_argument("--cache_dir", type=str, help="Directory outside of --directory holding local scan indexes and caches. Set to '' to disable. Default = ~/.cache/archivist", default=os.path.join(os.path.expanduser('~'), '.cache', 'archivist'), required=False)
 parent_parser.add_argument("-u", "--endpoint_url", type=str, help="endpoint url for s3 upload", required=False)
 
+# S3 transfer options
+parent_parser.add_argument("--part_size", type=int, help="Size of each multipart upload part in MB. Grown for large objects so they fit in 10000 parts. With --stream, archives take up to --part_size x (--max_inflight_parts + 1) MB of memory each, times --jobs. Default = 64", default=64, required=False)
+parent_parser.add_argument("--multipart_threshold", type=int, help="Upload files larger than this many MB in multiple parts. Default = 64", default=64, required=False)
+parent_parser.add_argument("--max_concurrency", type=int, help="Number of parts of a single object transferred concurrently. Streamed archives upload at most --max_inflight_parts parts at once. Default = 10", default=10, required=False)
+parent_parser.add_argument("--max_pool_connections", type=int, help="Max number of connections kept open to S3. Default = 4 x --max_concurrency", default=None, required=False)
+parent_parser.add_argument("--retries", type=int, help="Max attempts of every S3 request, retried with exponential backoff. Default = 5", default=5, required=False)
+parent_parser.add_argument("--bandwidth_limit", type=float, help="Cap the aggregate bandwidth of all transfers to this many MB/s. Default = 0 (unlimited)", default=0, required=False)
+
 # Sub-command parser
 sub_parser = parser.add_subparsers(dest='cmd', required=True)
 
+# Archive options, shared by the archive and watch sub-commands
+archive_options = argparse.ArgumentParser(add_help=False)
+archive_options.add_argument("-m", "--max_size", type=int, help="Max file size of the archive in GB. Splits large archive into multi files. Default = 30", default=30, required=False)
+archive_options.add_argument("-n", "--name", type=str, help="Name of the archive *Appended with timestamp + codec suffix (e.g. '.tgz')*", default="archive", required=False)
+archive_options.add_argument("-w", "--workers", type=int, help="Number of threads compressing (and extracting) archives in parallel. Default = number of CPUs", default=None, required=False)
+archive_options.add_argument("-j", "--jobs", type=int, help="Number of archives built and uploaded concurrently. Default = 2", default=2, required=False)
+archive_options.add_argument("-z", "--codec", type=codec_spec, help="Compression codec and optional level, as '<codec>[:<level>]' with codec one of gzip, zstd, lz4 or none (e.g. 'zstd:3'). Default = gzip", default="gzip", required=False)
+archive_options.add_argument("--dedup", help="Store identical file contents only once, referencing duplicates by their sha256 hash in the state", action='store_true', required=False)
+archive_options.add_argument("--stream", help="Stream archives straight into S3 multipart uploads instead of staging them in the directory", action='store_true', required=False)
+archive_options.add_argument("--max_inflight_parts", type=int, help="Number of parts of a streamed archive buffered or uploading at once. Worst case memory is --part_size x (--max_inflight_parts + 1) x --jobs MB. Default = 2", default=2, required=False)
+
+# Extract options, shared by the extract and watch sub-commands
+extract_options = argparse.ArgumentParser(add_help=False)
+extract_options.add_argument("--archive_cache_size", type=float, help="Keep up to this many GB of downloaded archives in --cache_dir, to restore files from them again without downloading. Default = 0 (disabled)", default=0, required=False)
+
 # Archive sub-command
-archive_parser = sub_parser.add_parser('archive', parents=[parent_parser], description='Archive a specified directory')
-archive_parser.add_argument("-m", "--max_size", type=int, help="Max file size of the archive in GB. Splits large archive into multi files. Default = 30", default=30, required=False)
-archive_parser.add_argument("-n", "--name", type=str, help="Name of the archive *Appended with timestamp + '.tgz'*", default="archive", required=False)
+archive_parser = sub_parser.add_parser('archive', parents=[parent_parser, archive_options], description='Archive a specified directory')
 
 # Extract sub-command
-extract_parser = sub_parser.add_parser('extract', parents=[parent_parser], description='Extract specified archive into directory')
+extract_parser = sub_parser.add_parser('extract', parents=[parent_parser, extract_options], description='Extract specified archive into directory')
+extract_parser.add_argument("-w", "--workers", type=int, help="Number of archives streamed and extracted concurrently. Default = number of CPUs", default=None, required=False)
+
+# Watch sub-command
+watch_parser = sub_parser.add_parser('watch', parents=[parent_parser, archive_options, extract_options], description='Continuously archive files written to, and restore files deleted from a specified directory (Linux only)')
+watch_parser.add_argument("--batch_size", type=int, help="Archive written files once they add up to this many MB. Default = 1024", default=1024, required=False)
+watch_parser.add_argument("--batch_interval", type=int, help="Archive written files at least every this many seconds. Default = 60", default=60, required=False)
+watch_parser.add_argument("--rescan_interval", type=int, help="Fully rescan the directory every this many seconds, in case events were missed. Default = 3600", default=3600, required=False)
 
 args = parser.parse_args()
 
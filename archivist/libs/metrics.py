@@ -0,0 +1,112 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+from libs.arguments import args
+from libs.logger import logger
+
+# Timings and counters of a run, per stage
+#
+# Stage timings add up the time every thread spent in a stage, so concurrent stages
+# may add up to more than the wall clock time of the run.
+class Metrics:
+
+    # Seconds between two progress lines
+    progress_interval = 10
+
+    def __init__(self, output=None):
+        self.output = output
+        self.started = time.monotonic()
+        self.stages = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._last_progress = self.started
+
+    # Time a block of work as part of a stage
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                seconds, count = self.stages.get(name, (0.0, 0))
+                self.stages[name] = (seconds + elapsed, count + 1)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    # Count requests and retries of an S3 client
+    # Every attempt of a request is sent, only the first one is a call
+    def instrument(self, client):
+        client.meta.events.register('before-call.s3', lambda **kwargs: self.count('s3_requests'))
+        client.meta.events.register('before-send.s3', lambda **kwargs: self.count('s3_attempts'))
+
+    # Log an aggregated progress line, at most every 'progress_interval' seconds
+    def tick(self):
+        now = time.monotonic()
+        if now - self._last_progress < Metrics.progress_interval:
+            return
+        with self._lock:
+            if now - self._last_progress < Metrics.progress_interval:
+                return
+            self._last_progress = now
+            counters = dict(self.counters)
+        logger.info('Progress: %s', ', '.join('{k} {v}'.format(k=k, v=v) for k, v in sorted(counters.items())))
+
+    # Summary of the run, with derived throughputs and ratios
+    def summary(self):
+        with self._lock:
+            stages = dict(self.stages)
+            counters = dict(self.counters)
+        counters['s3_retries'] = max(counters.get('s3_attempts', 0) - counters.get('s3_requests', 0), 0)
+        summary = {
+            'elapsed_seconds': round(time.monotonic() - self.started, 3),
+            'stages': { k: { 'seconds': round(v[0], 3), 'count': v[1] } for k, v in sorted(stages.items()) },
+            'counters': counters
+        }
+        if counters.get('bytes_archived'):
+            summary['compression_ratio'] = round(counters.get('bytes_compressed', 0) / counters['bytes_archived'], 4)
+        # MB/s of the stages moving bytes
+        for stage, counter in (('archive', 'bytes_archived'), ('upload', 'bytes_uploaded'), ('extract', 'bytes_downloaded'), ('hash', 'bytes_hashed')):
+            if stages.get(stage) and counters.get(counter):
+                summary['stages'][stage]['mb_per_second'] = round(counters[counter] / (1024 ** 2) / max(stages[stage][0], 1e-6), 3)
+        return summary
+
+    # Summary in the Prometheus text exposition format, for the node exporter textfile collector
+    def prometheus(self):
+        summary = self.summary()
+        lines = [
+            '# TYPE archivist_elapsed_seconds gauge',
+            'archivist_elapsed_seconds {v}'.format(v=summary['elapsed_seconds']),
+            '# TYPE archivist_stage_seconds gauge'
+        ]
+        lines.extend('archivist_stage_seconds{{stage="{k}"}} {v}'.format(k=k, v=v['seconds']) for k, v in summary['stages'].items())
+        lines.append('# TYPE archivist_stage_count gauge')
+        lines.extend('archivist_stage_count{{stage="{k}"}} {v}'.format(k=k, v=v['count']) for k, v in summary['stages'].items())
+        for k, v in sorted(summary['counters'].items()):
+            lines.append('# TYPE archivist_{k} gauge'.format(k=k))
+            lines.append('archivist_{k} {v}'.format(k=k, v=v))
+        if 'compression_ratio' in summary:
+            lines.append('# TYPE archivist_compression_ratio gauge')
+            lines.append('archivist_compression_ratio {v}'.format(v=summary['compression_ratio']))
+        return '\n'.join(lines) + '\n'
+
+    # Write the summary to 'output', as Prometheus text when it ends with '.prom', as JSON otherwise
+    def save(self):
+        if not self.output:
+            return
+        content = self.prometheus() if self.output.endswith('.prom') else json.dumps(self.summary(), indent=2) + '\n'
+        temp_file = self.output + '.' + str(os.getpid()) + '.tmp'
+        with open(temp_file, 'w') as f:
+            f.write(content)
+        os.replace(temp_file, self.output)
+        logger.debug('Saved metrics to \'%s\'', self.output)
+
+metrics = Metrics(output=args.metrics_file)
+
+# from metrics import metrics
@@ -0,0 +1,61 @@
+import os
+import random
+import types
+
+import pytest
+
+pytest.importorskip('botocore')
+
+from libs.Archive import Archiver, Extractor
+
+def archiver(max_bytes):
+    archiver = Archiver.__new__(Archiver)
+    archiver.max_bytes = max_bytes
+    return archiver
+
+def stats(sizes):
+    return { k: types.SimpleNamespace(st_size=v) for k, v in sizes.items() }
+
+# Member index of an archive of 4 frames of 100 uncompressed bytes, compressed to 40 bytes each
+INDEX = {
+    'size': 160,
+    'frames': [[0, 0], [100, 40], [200, 80], [300, 120]],
+    'members': { 'a': [0, 50], 'b': [150, 250], 'c': [310, 400] }
+}
+
+def test_ranges_cover_the_frames_of_every_member(monkeypatch):
+    monkeypatch.setattr(Extractor, 'range_gap', 0)
+    extractor = Extractor.__new__(Extractor)
+    assert extractor._plan_ranges(INDEX, ['c', 'a']) == [
+        [0, 40, 0, [(0, 'a')]],
+        [120, 160, 300, [(310, 'c')]]
+    ]
+
+def test_close_ranges_are_merged(monkeypatch):
+    monkeypatch.setattr(Extractor, 'range_gap', 0)
+    extractor = Extractor.__new__(Extractor)
+    # 'b' spans frames 1 and 2, and starts where the frame of 'a' ends
+    assert extractor._plan_ranges(INDEX, ['a', 'b']) == [[0, 120, 0, [(0, 'a'), (150, 'b')]]]
+    monkeypatch.setattr(Extractor, 'range_gap', 80)
+    assert extractor._plan_ranges(INDEX, ['a', 'c']) == [[0, 160, 0, [(0, 'a'), (310, 'c')]]]
+
+def test_plan_packs_files_by_directory_into_even_archives():
+    sizes = { os.path.join('a', '1'): 40, os.path.join('a', '2'): 40, os.path.join('a', '3'): 40, os.path.join('b', '1'): 40 }
+    assert archiver(100)._plan(list(sizes), stats(sizes)) == [
+        [os.path.join('a', '1'), os.path.join('a', '2')],
+        [os.path.join('a', '3'), os.path.join('b', '1')]
+    ]
+
+def test_plan_archives_oversized_files_alone():
+    sizes = { 'big': 150, 'small': 10, 'other': 20 }
+    assert archiver(100)._plan(list(sizes), stats(sizes)) == [['other', 'small'], ['big']]
+
+def test_plan_keeps_every_file_once_below_the_limit():
+    rng = random.Random(0)
+    sizes = { os.path.join('d{d}'.format(d=rng.randrange(20)), 'f{i}'.format(i=i)): rng.randrange(1, 100) for i in range(1000) }
+    plan = archiver(1000)._plan(list(sizes), stats(sizes))
+    assert sorted(x for archive in plan for x in archive) == sorted(sizes)
+    totals = [sum(sizes[x] for x in archive) for archive in plan]
+    assert max(totals) <= 1000
+    # Archives are even, none is left mostly empty
+    assert min(totals) >= 500
@@ -0,0 +1,44 @@
+import io
+import os
+
+from libs.Cache import ArchiveCache, TeeReader
+
+def test_entry_is_cached_once_complete(tmp_path):
+    cache = ArchiveCache(str(tmp_path), 1024)
+    with cache.put('bucket/a', 'etag', 10) as f:
+        f.write(b'x' * 10)
+    with cache.get('bucket/a', 'etag') as f:
+        assert f.read() == b'x' * 10
+    assert cache.get('bucket/a', 'other') is None
+
+def test_partial_copy_is_not_cached(tmp_path):
+    cache = ArchiveCache(str(tmp_path), 1024)
+    with cache.put('bucket/a', 'etag', 10) as f:
+        reader = TeeReader(io.BytesIO(b'x' * 10), f)
+        reader.read(4)
+    assert reader.bytes_read == 4
+    assert cache.get('bucket/a', 'etag') is None
+    assert not [x for x in os.listdir(str(tmp_path)) if x.endswith('.tmp')]
+
+def test_drained_copy_is_cached(tmp_path):
+    cache = ArchiveCache(str(tmp_path), 1024)
+    with cache.put('bucket/a', 'etag', 10) as f:
+        reader = TeeReader(io.BytesIO(b'0123456789'), f)
+        reader.read(4)
+        reader.drain()
+    with cache.get('bucket/a', 'etag') as f:
+        assert f.read() == b'0123456789'
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = ArchiveCache(str(tmp_path), 1024)
+    for age, name in enumerate(('c', 'b', 'a')):
+        with cache.put(name, 'etag') as f:
+            f.write(b'x' * 10)
+        os.utime(cache._path(name, 'etag'), (1000 - age, 1000 - age))
+    # Reading 'a' makes it the most recently used entry
+    cache.get('a', 'etag').close()
+    cache.max_bytes = 25
+    cache.evict()
+    assert cache.get('b', 'etag') is None
+    assert cache.get('a', 'etag') is not None
+    assert cache.get('c', 'etag') is not None
@@ -0,0 +1,39 @@
+import io
+import tarfile
+
+import pytest
+
+from libs.Codec import codecs, get_codec
+
+def available():
+    for name in codecs:
+        try:
+            get_codec(name)
+        except ValueError:
+            continue
+        yield name
+
+@pytest.mark.parametrize('name', list(available()))
+def test_concatenated_blocks_decode_as_one_stream(name):
+    codec = get_codec(name)
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as tar:
+        for i in range(3):
+            content = ('file {i}\n'.format(i=i) * 1000).encode()
+            info = tarfile.TarInfo('f{i}'.format(i=i))
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    data = buffer.getvalue()
+    compressed = b''.join(codec.compress_block(data[i:i + 4096]) for i in range(0, len(data), 4096))
+    with codec.open_reader(io.BytesIO(compressed)) as reader, tarfile.open(fileobj=reader, mode='r|') as tar:
+        names = [member.name for member in tar]
+    assert names == ['f0', 'f1', 'f2']
+
+def test_level_is_parsed():
+    assert get_codec('gzip:9').level == 9
+    assert get_codec('gzip').level == 6
+
+@pytest.mark.parametrize('spec', ['gzip:0', 'gzip:10', 'none:7', 'none:0', 'bzip2'])
+def test_invalid_specs_are_rejected(spec):
+    with pytest.raises(ValueError):
+        get_codec(spec)
@@ -0,0 +1,160 @@
+import io
+import os
+
+import pytest
+
+pytest.importorskip('botocore')
+
+import libs.Archive
+
+from libs.Archive import Archiver, Extractor
+from libs.Digest import HashingReader, hash_file
+from libs.Manifest import Manifest
+
+# In-memory bucket in place of the S3 methods of ArchiveTemplate
+class MemoryStore:
+
+    def __init__(self, objects, *args, **kwargs):
+        self.objects = objects
+        super().__init__(*args, **kwargs)
+
+    def _list_s3(self, prefix):
+        return [{'Key': x} for x in sorted(self.objects) if x.startswith(prefix)]
+
+    def _read_from_s3(self, object_name, decode=True):
+        content = self.objects.get(object_name)
+        return content.decode('utf-8') if decode and content is not None else content
+
+    def _read_if_changed(self, object_name, etag=None):
+        return self.objects.get(object_name), None
+
+    def _write_to_s3(self, data, object_name):
+        self.objects[object_name] = data
+
+    def _delete_from_s3(self, object_names):
+        for name in object_names:
+            self.objects.pop(name, None)
+
+    def _upload_to_s3(self, file_name, object_name):
+        with open(file_name, 'rb') as f:
+            self.objects[object_name] = f.read()
+
+    def _head_s3(self, object_name):
+        return None
+
+    def _open_s3_range(self, object_name, start=None, end=None):
+        return io.BytesIO(self.objects[object_name][start:end])
+
+class MemoryArchiver(MemoryStore, Archiver):
+    pass
+
+class MemoryExtractor(MemoryStore, Extractor):
+    pass
+
+def options(directory):
+    return dict(directory=directory, state_file='state.json', key_id='test', key_secret='test', bucket='test', certificate_path=None)
+
+def write(directory, relative_path, content):
+    path = os.path.join(directory, relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+def archive(objects, directory, files, name='test'):
+    with MemoryArchiver(objects, name=name, workers=2, dedup=True, files=files, **options(directory)) as archiver:
+        archiver.create()
+    return archiver
+
+# Latest state record of every path
+def state(objects):
+    return Manifest(MemoryStore(objects), 'state.json').select(lambda path: True)
+
+def archived(objects):
+    return [x for x in objects if x.startswith('test-') and not x.endswith(Archiver.index_suffix)]
+
+def test_duplicates_within_a_run_are_stored_once(tmp_path):
+    directory, objects = str(tmp_path), {}
+    write(directory, 'a/1', b'same')
+    write(directory, 'b/2', b'same')
+    write(directory, 'c/3', b'diff')
+    archive(objects, directory, ['a/1', 'b/2', 'c/3'])
+    records = state(objects)
+    # Either copy is stored, the other one refers to it
+    [stored] = [x for x in ('a/1', 'b/2') if 'member' not in records[x]]
+    [duplicate] = [x for x in ('a/1', 'b/2') if x != stored]
+    assert records[duplicate]['member'] == stored
+    assert records[duplicate]['archive_name'] == records[stored]['archive_name']
+    assert records[duplicate]['hash'] == records[stored]['hash']
+    assert records['c/3']['hash'] != records['a/1']['hash']
+    assert len(archived(objects)) == 1
+
+def test_duplicates_of_stored_blobs_are_referenced_without_archiving(tmp_path):
+    directory, objects = str(tmp_path), {}
+    write(directory, 'a/1', b'same')
+    archive(objects, directory, ['a/1'])
+    archives = archived(objects)
+    write(directory, 'b/2', b'same')
+    archive(objects, directory, ['b/2'], name='test-again')
+    # No new archive was written for the duplicate
+    assert archived(objects) == archives
+    record = state(objects)['b/2']
+    assert record['archive_name'] == archives[0]
+    assert record['member'] == 'a/1'
+
+def test_file_changed_while_archiving_stores_its_duplicates(tmp_path, monkeypatch):
+    directory, objects = str(tmp_path), {}
+    write(directory, 'a/1', b'same')
+    write(directory, 'b/2', b'same')
+    add_member = Archiver._add_member
+    modified = []
+    # Modify the first file archived after it was hashed, right before it is archived
+    def modify(self, tar, path, target):
+        if not modified:
+            modified.append(target)
+            write(directory, target, b'other')
+            os.utime(path, ns=(0, 0))
+        return add_member(self, tar, path, target)
+    monkeypatch.setattr(Archiver, '_add_member', modify)
+    archive(objects, directory, ['a/1', 'b/2'])
+    records = state(objects)
+    assert 'member' not in records['a/1'] and 'member' not in records['b/2']
+    assert records['a/1']['hash'] != records['b/2']['hash']
+    [duplicate] = [x for x in ('a/1', 'b/2') if x not in modified]
+    assert records[duplicate]['hash'] == hash_file(os.path.join(directory, duplicate))
+
+def test_hashes_are_reused_while_archiving(tmp_path, monkeypatch):
+    directory, objects = str(tmp_path), {}
+    write(directory, 'a/1', b'same')
+    write(directory, 'b/2', b'same')
+    write(directory, 'c/3', b'unique')
+    hashed = []
+    monkeypatch.setattr(libs.Archive, 'hash_file', lambda path: hashed.append(path) or hash_file(path))
+    streamed = []
+    monkeypatch.setattr(libs.Archive, 'HashingReader', lambda f: streamed.append(f.name) or HashingReader(f))
+    archive(objects, directory, ['a/1', 'b/2', 'c/3'])
+    # Only the file of a unique size is hashed while archived, the others were hashed once up front
+    assert sorted(hashed) == [os.path.join(directory, 'a/1'), os.path.join(directory, 'b/2')]
+    assert streamed == [os.path.join(directory, 'c/3')]
+    records = state(objects)
+    assert records['a/1']['hash'] == hash_file(os.path.join(directory, 'a/1'))
+    assert records['c/3']['hash'] == hash_file(os.path.join(directory, 'c/3'))
+
+def test_extraction_resolves_content_by_hash(tmp_path):
+    directory, objects = str(tmp_path), {}
+    write(directory, 'a/1', b'same')
+    write(directory, 'b/2', b'same')
+    archive(objects, directory, ['a/1', 'b/2'])
+    write(directory, 'c/3', b'same')
+    archive(objects, directory, ['c/3'], name='test-again')
+    for path in ('a/1', 'b/2', 'c/3'):
+        os.remove(os.path.join(directory, path))
+    with MemoryExtractor(objects, workers=2, files=['a/1', 'b/2', 'c/3'], **options(directory)) as extractor:
+        # Every path is extracted from the single stored member
+        [(archive_name, members)] = extractor._missing_files_map.items()
+        assert archive_name == archived(objects)[0]
+        [(member, paths)] = members.items()
+        assert sorted(paths) == ['a/1', 'b/2', 'c/3']
+        extractor.extract()
+    for path in ('a/1', 'b/2', 'c/3'):
+        with open(os.path.join(directory, path), 'rb') as f:
+            assert f.read() == b'same'
@@ -0,0 +1,169 @@
+import gzip
+import json
+
+from libs.Manifest import Manifest
+
+# In-memory bucket with the storage methods of ArchiveTemplate used by the manifest
+class FakeStore:
+
+    def __init__(self):
+        self.objects = {}
+        self.reads = 0
+        self.lists = 0
+        # Called after every write, to simulate concurrent writers
+        self.on_write = None
+
+    def _list_s3(self, prefix):
+        self.lists += 1
+        return [{'Key': x} for x in sorted(self.objects) if x.startswith(prefix)]
+
+    def _read_from_s3(self, object_name, decode=True):
+        self.reads += 1
+        content = self.objects.get(object_name)
+        return content.decode('utf-8') if decode and content is not None else content
+
+    def _read_if_changed(self, object_name, etag=None):
+        content = self.objects.get(object_name)
+        if content is None:
+            return None, None
+        current = str(hash(content))
+        if current == etag:
+            return None, etag
+        self.reads += 1
+        return content, current
+
+    def _write_to_s3(self, data, object_name):
+        self.objects[object_name] = data
+        if self.on_write is not None:
+            on_write, self.on_write = self.on_write, None
+            on_write(object_name)
+
+    def _delete_from_s3(self, object_names):
+        for name in object_names:
+            self.objects.pop(name, None)
+
+def record(path, archive):
+    return {'relative_path': path, 'archive_name': archive, 'codec': 'gzip'}
+
+def manifest_objects(store):
+    return sorted(x for x in store.objects if x.endswith(Manifest.suffix))
+
+def test_latest_record_wins():
+    store = FakeStore()
+    writer = Manifest(store, 'state')
+    writer.append([record('a', 'one'), record('b', 'one')])
+    writer.append([record('a', 'two')])
+    reader = Manifest(store, 'state')
+    assert reader.lookup({'a', 'b', 'c'}) == {'a': record('a', 'two'), 'b': record('b', 'one')}
+
+def test_manifest_is_read_once_per_listing():
+    store = FakeStore()
+    writer = Manifest(store, 'state')
+    for i in range(3):
+        writer.append([record('f{i}'.format(i=i), 'one')])
+    reader = Manifest(store, 'state')
+    reader.lookup({'f0'})
+    reader.blobs()
+    reader.compact(force=True)
+    assert store.reads == 3
+
+def test_compaction_keeps_every_record():
+    store = FakeStore()
+    writer = Manifest(store, 'state')
+    expected = {}
+    for i in range(Manifest.compact_threshold):
+        path = 'f{i}'.format(i=i % 10)
+        expected[path] = record(path, str(i))
+        writer.append([expected[path]])
+    assert writer.compact() is not None
+    assert len(manifest_objects(store)) == 1
+    assert Manifest(store, 'state').select(lambda path: True) == expected
+
+def test_compaction_below_threshold_does_nothing():
+    store = FakeStore()
+    writer = Manifest(store, 'state')
+    writer.append([record('a', 'one')])
+    assert writer.compact() is None
+    assert len(manifest_objects(store)) == 1
+
+def test_delta_written_during_compaction_is_not_overridden():
+    store = FakeStore()
+    writer = Manifest(store, 'state')
+    writer.append([record('a', 'one')])
+    writer.append([record('b', 'one')])
+    keys = manifest_objects(store)
+    compactor = Manifest(store, 'state')
+    compactor.objects
+    # Another node's delta, ordered before the newest listed object, lands while compacting
+    late_key = keys[-1].replace('-delta-', '-delta-0')
+    assert keys[0] < late_key < keys[-1]
+    store.on_write = lambda name: store.objects.__setitem__(late_key, compactor._encode([record('a', 'late')]))
+    assert compactor.compact(force=True) is None
+    assert manifest_objects(store) == sorted(keys + [late_key])
+    assert Manifest(store, 'state').lookup({'a'}) == {'a': record('a', 'late')}
+
+def test_delta_written_after_compaction_is_read_on_top():
+    store = FakeStore()
+    writer = Manifest(store, 'state')
+    writer.append([record('a', 'one')])
+    store.on_write = lambda name: writer.append([record('a', 'two')])
+    writer.compact(force=True)
+    assert writer.lookup({'a'}) == {'a': record('a', 'two')}
+    assert Manifest(store, 'state').lookup({'a'}) == {'a': record('a', 'two')}
+
+def test_legacy_state_is_migrated():
+    store = FakeStore()
+    store.objects['state'] = json.dumps([record('a', 'legacy'), record('b', 'legacy')]).encode()
+    writer = Manifest(store, 'state')
+    writer.append([record('b', 'new')])
+    writer.compact()
+    assert 'state' not in store.objects
+    assert len(manifest_objects(store)) == 1
+    assert Manifest(store, 'state').lookup({'a', 'b'}) == {'a': record('a', 'legacy'), 'b': record('b', 'new')}
+
+def test_cache_only_reads_new_objects(tmp_path):
+    store = FakeStore()
+    cache_file = str(tmp_path / 'state.cache')
+    writer = Manifest(store, 'state')
+    writer.append([record('a', 'one')])
+    first = Manifest(store, 'state', cache_file=cache_file)
+    first.lookup({'a'})
+    first.save()
+    writer.append([record('b', 'two')])
+    store.reads = 0
+    second = Manifest(store, 'state', cache_file=cache_file)
+    assert second.lookup({'a', 'b'}) == {'a': record('a', 'one'), 'b': record('b', 'two')}
+    assert store.reads == 1
+
+def test_cache_restarts_after_concurrent_compaction(tmp_path):
+    store = FakeStore()
+    cache_file = str(tmp_path / 'state.cache')
+    writer = Manifest(store, 'state')
+    writer.append([record('a', 'one')])
+    cached = Manifest(store, 'state', cache_file=cache_file)
+    cached.lookup({'a'})
+    cached.save()
+    writer.append([record('a', 'two')])
+    writer.compact(force=True)
+    assert Manifest(store, 'state', cache_file=cache_file).lookup({'a'}) == {'a': record('a', 'two')}
+
+def test_objects_are_gzip_ndjson():
+    store = FakeStore()
+    key = Manifest(store, 'state').append([record('a', 'one')])
+    lines = gzip.decompress(store.objects[key]).splitlines()
+    assert [json.loads(x) for x in lines] == [record('a', 'one')]
+
+def test_identity_survives_compaction_and_changes_on_reset():
+    store = FakeStore()
+    writer = Manifest(store, 'state')
+    assert writer.identity() is None
+    writer.append([record('a', 'one')])
+    identity = writer.identity()
+    assert identity is not None
+    writer.compact(force=True)
+    assert Manifest(store, 'state').identity() == identity
+    store.objects.clear()
+    reset = Manifest(store, 'state')
+    assert reset.identity() is None
+    reset.append([record('a', 'two')])
+    assert reset.identity() not in (None, identity)
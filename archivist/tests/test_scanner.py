@@ -0,0 +1,74 @@
+import os
+import pickle
+
+from libs.Scanner import Scanner
+
+def write(directory, relative_path, content='x'):
+    path = os.path.join(directory, relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+def test_scan_reports_new_modified_and_deleted_files(tmp_path):
+    directory = str(tmp_path / 'tree')
+    index_file = str(tmp_path / 'index')
+    write(directory, 'a')
+    write(directory, 'sub/b')
+    write(directory, 'sub/c')
+    scanner = Scanner(directory, index_file=index_file).scan()
+    assert sorted(scanner.new) == ['a', os.path.join('sub', 'b'), os.path.join('sub', 'c')]
+    scanner.save()
+    write(directory, 'sub/b', 'longer')
+    os.remove(os.path.join(directory, 'sub', 'c'))
+    write(directory, 'd')
+    scanner = Scanner(directory, index_file=index_file).scan()
+    assert scanner.new == ['d']
+    assert scanner.modified == [os.path.join('sub', 'b')]
+    assert scanner.deleted == [os.path.join('sub', 'c')]
+
+def test_excluded_paths_are_skipped(tmp_path):
+    directory = str(tmp_path)
+    write(directory, 'a')
+    write(directory, 'state')
+    write(directory, 'cache/x')
+    scanner = Scanner(directory, exclude=['state', 'cache']).scan()
+    assert list(scanner) == ['a']
+
+def test_archived_flags_and_identity_persist(tmp_path):
+    directory = str(tmp_path / 'tree')
+    index_file = str(tmp_path / 'index')
+    write(directory, 'a')
+    write(directory, 'b')
+    scanner = Scanner(directory, index_file=index_file).scan()
+    scanner.mark_archived(['a', 'b'])
+    scanner.identity = 'state.d/identity-1'
+    scanner.save()
+    write(directory, 'b', 'changed')
+    scanner = Scanner(directory, index_file=index_file).scan()
+    assert scanner.identity == 'state.d/identity-1'
+    # Modified archived files are reported as such
+    assert list(scanner.unarchived()) == [('b', True)]
+
+def test_reset_archived_keeps_modified_flags(tmp_path):
+    directory = str(tmp_path / 'tree')
+    index_file = str(tmp_path / 'index')
+    write(directory, 'a')
+    write(directory, 'b')
+    scanner = Scanner(directory, index_file=index_file).scan()
+    scanner.mark_archived(['a', 'b'])
+    scanner.save()
+    write(directory, 'b', 'changed')
+    scanner = Scanner(directory, index_file=index_file).scan()
+    scanner.reset_archived()
+    assert sorted(scanner.unarchived()) == [('a', False), ('b', True)]
+
+def test_unversioned_index_is_read_without_identity(tmp_path):
+    directory = str(tmp_path / 'tree')
+    index_file = str(tmp_path / 'index')
+    write(directory, 'a')
+    scanner = Scanner(directory).scan()
+    with open(index_file, 'wb') as f:
+        pickle.dump(scanner._index, f)
+    scanner = Scanner(directory, index_file=index_file).scan()
+    assert scanner.identity is None
+    assert scanner.new == []
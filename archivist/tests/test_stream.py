@@ -0,0 +1,88 @@
+import threading
+
+import pytest
+
+from libs.Stream import S3MultipartWriter
+
+MB = 1024 ** 2
+
+# In-memory S3 client serving multipart uploads
+class FakeS3:
+
+    def __init__(self, fail_part=None, block=None):
+        self.parts = {}
+        self.completed = None
+        self.aborted = False
+        self.fail_part = fail_part
+        self.block = block
+        self.inflight = 0
+        self.max_inflight = 0
+        self._lock = threading.Lock()
+
+    def create_multipart_upload(self, Bucket, Key):
+        return {'UploadId': 'upload'}
+
+    def upload_part(self, Body, Bucket, Key, PartNumber, UploadId):
+        with self._lock:
+            self.inflight += 1
+            self.max_inflight = max(self.max_inflight, self.inflight)
+        try:
+            if self.block is not None:
+                self.block.wait(5)
+            if PartNumber == self.fail_part:
+                raise IOError('part {p} failed'.format(p=PartNumber))
+            self.parts[PartNumber] = Body
+            return {'ETag': str(PartNumber)}
+        finally:
+            with self._lock:
+                self.inflight -= 1
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.completed = b''.join(self.parts[x['PartNumber']] for x in MultipartUpload['Parts'])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted = True
+
+def test_parts_are_reassembled_in_order():
+    s3 = FakeS3()
+    data = bytes(range(256)) * (50 * 1024)
+    with S3MultipartWriter(s3, 'bucket', 'key', part_size=5, max_inflight=3) as writer:
+        for i in range(0, len(data), 1024 ** 2 + 7):
+            writer.write(data[i:i + 1024 ** 2 + 7])
+    assert s3.completed == data
+    assert len(s3.parts) == 3
+    assert not s3.aborted
+
+def test_empty_object_uploads_one_part():
+    s3 = FakeS3()
+    with S3MultipartWriter(s3, 'bucket', 'key'):
+        pass
+    assert s3.completed == b''
+
+def test_inflight_parts_are_bounded_independently_of_concurrency():
+    s3 = FakeS3(block=threading.Event())
+    writer = S3MultipartWriter(s3, 'bucket', 'key', part_size=5, max_inflight=2, max_concurrency=10)
+    assert writer.max_concurrency == 2
+    writer.write(b'x' * 10 * MB)
+    # A third part must wait for a slot
+    thread = threading.Thread(target=writer.write, args=(b'x' * 5 * MB,))
+    thread.start()
+    thread.join(0.2)
+    assert thread.is_alive()
+    s3.block.set()
+    thread.join(5)
+    writer.close()
+    assert s3.max_inflight <= 2
+    assert len(s3.completed) == 15 * MB
+
+def test_failed_part_aborts_on_next_write():
+    s3 = FakeS3(fail_part=1)
+    writer = S3MultipartWriter(s3, 'bucket', 'key', part_size=5, max_inflight=1)
+    writer.write(b'x' * 5 * MB)
+    with pytest.raises(IOError):
+        with writer:
+            # Waits for the slot of the failed part, then raises its error
+            for _ in range(100):
+                writer.write(b'x' * MB)
+    assert s3.aborted
+    assert s3.completed is None
@@ -0,0 +1,85 @@
+import io
+import threading
+
+import pytest
+
+import libs.Transfer
+
+from libs.Transfer import Throttle, ThrottledReader, Transfer
+
+MB = 1024 ** 2
+
+# Clock advancing only when slept on, in place of the time module
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(libs.Transfer, 'time', clock)
+    return clock
+
+@pytest.mark.parametrize('size', [0, 1, 64 * MB, 640 * 1000 * MB, 640 * 1000 * MB + 1, 5 * 1024 ** 4])
+def test_part_size_keeps_uploads_within_the_part_limit(size):
+    transfer = Transfer(part_size=64)
+    part_size = transfer.part_size_for(size)
+    assert part_size >= transfer.part_size
+    assert part_size % MB == 0
+    assert -(-size // part_size) <= Transfer.max_parts
+    # Grown no more than needed
+    if part_size > transfer.part_size:
+        assert -(-size // (part_size - MB)) > Transfer.max_parts
+
+def test_part_size_is_at_least_the_s3_minimum():
+    assert Transfer(part_size=1).part_size_for(1) == Transfer.min_part_size
+
+def test_throttle_paces_to_its_rate(clock):
+    throttle = Throttle(10 * MB)
+    for _ in range(20):
+        throttle.consume(MB)
+    # The first MB goes out right away, every later one waits for its turn
+    assert clock.now - 1000.0 == pytest.approx(1.9)
+    assert clock.sleeps == pytest.approx([0.1] * 19)
+
+def test_throttle_does_not_bank_idle_time(clock):
+    throttle = Throttle(10 * MB)
+    throttle.consume(MB)
+    clock.now += 60
+    throttle.consume(MB)
+    throttle.consume(MB)
+    assert clock.sleeps == pytest.approx([0.1])
+
+def test_unlimited_throttle_never_waits(clock):
+    throttle = Throttle(0)
+    for _ in range(100):
+        throttle.consume(100 * MB)
+    assert clock.sleeps == []
+
+def test_throttle_is_shared_by_concurrent_callers():
+    # On the real clock, 40MB at 100MB/s take 0.39s past the first MB, however many threads send them
+    throttle = Throttle(100 * MB)
+    started = libs.Transfer.time.monotonic()
+    threads = [threading.Thread(target=lambda: [throttle.consume(MB) for _ in range(5)]) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert libs.Transfer.time.monotonic() - started >= 0.39
+
+def test_throttled_reader_counts_and_paces_reads(clock):
+    throttle = Throttle(10 * MB)
+    reader = ThrottledReader(io.BytesIO(b'\0' * (4 * MB)), throttle)
+    while reader.read(MB):
+        pass
+    assert reader.bytes_read == 4 * MB
+    assert clock.sleeps == pytest.approx([0.1] * 3)
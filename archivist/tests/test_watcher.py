@@ -0,0 +1,28 @@
+import pytest
+
+pytest.importorskip('botocore')
+
+from libs.Scanner import Scanner
+from libs.Watcher import Watcher
+
+def test_rescan_scans_once_and_drops_pending_files_it_archived(monkeypatch, tmp_path):
+    watcher = Watcher.__new__(Watcher)
+    watcher.directory = str(tmp_path)
+    watcher.scanner = Scanner(str(tmp_path))
+    watcher.rescan_interval = 3600
+    watcher._ignored = set()
+    watcher._pending = {'a': 1, 'b': 2}
+    watcher._pending_bytes = 3
+    watcher._pending_since = 0
+    scans = []
+    monkeypatch.setattr(watcher.scanner, 'scan', lambda: scans.append(1))
+    monkeypatch.setattr(watcher, '_restore', lambda files=None: None)
+    monkeypatch.setattr(watcher, '_archive', lambda files=None: {'a', 'c'})
+    watcher._rescan()
+    assert len(scans) == 1
+    assert watcher._pending == {'b': 2}
+    assert watcher._pending_bytes == 2
+    monkeypatch.setattr(watcher, '_archive', lambda files=None: {'b'})
+    watcher._rescan()
+    assert watcher._pending == {}
+    assert watcher._pending_since is None
@@ -0,0 +1,82 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Harness shared by the benchmarks of the scripts of this repo
+#
+# A benchmark generates its own workload and runs every phase of it as a separate process,
+# measured here. Results are { phase: { result: value } }, written as JSON and compared to a
+# baseline recorded by an earlier run. The peak RSS of a child includes the memory of its
+# parent at the time it was forked, so benchmarks keep their own memory low.
+
+# Options of the harness, not parameters of the workload
+OPTIONS = ('work_dir', 'output', 'baseline', 'update_baseline', 'tolerance')
+
+# Add the options of the harness to the parser of a benchmark
+def add_arguments(parser):
+    parser.add_argument('--work_dir', help='Directory holding the synthetic tree. Default = a temporary directory', default=None, type=str)
+    parser.add_argument('--output', '-o', help='Write the results to this JSON file', default=None, type=str)
+    parser.add_argument('--baseline', help='Compare the results to this JSON file, and exit with 1 on regressions', default=None, type=str)
+    parser.add_argument('--update_baseline', help='Write the results to --baseline instead of comparing them', action='store_true')
+    parser.add_argument('--tolerance', help='Relative change of a result tolerated before it is a regression. Default = 0.15', default=0.15, type=float)
+
+# Parameters of the workload, recorded with the results
+def parameters(options, exclude=()):
+    return { k: v for k, v in vars(options).items() if k not in OPTIONS and k not in exclude }
+
+# Run a command, returns its wall clock seconds and peak RSS in MB, exits when it fails
+def run(command):
+    started = time.monotonic()
+    process = subprocess.Popen(command)
+    _, status, rusage = os.wait4(process.pid, 0)
+    seconds = time.monotonic() - started
+    # Reaped by os.wait4, tell Popen so
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        sys.exit('Benchmark run \'{c}\' failed with exit code {r}'.format(c=' '.join(command), r=process.returncode))
+    # ru_maxrss is in KB on Linux
+    return seconds, rusage.ru_maxrss / 1024
+
+# Compare results to a baseline, returns the list of regressions
+# 'lower_is_better(name)' tells whether a lower value of a result is an improvement,
+# 'ignored' results depend on the workload only and are not compared
+def compare(results, baseline, tolerance, lower_is_better, ignored=()):
+    regressions = []
+    for phase, values in results['phases'].items():
+        for name, value in values.items():
+            before = baseline.get('phases', {}).get(phase, {}).get(name)
+            if not before or name in ignored:
+                continue
+            change = (value - before) / before
+            if (change > tolerance) if lower_is_better(name) else (change < -tolerance):
+                regressions.append('{p} {n}: {b} -> {v} ({c:+.0%})'.format(p=phase, n=name, b=before, v=value, c=change))
+    return regressions
+
+# Print the results, write them to --output and compare them to --baseline, returns the exit code
+def report(results, options, lower_is_better, ignored=()):
+    width = max(len(x) for x in results['phases']) + 2
+    for phase, values in results['phases'].items():
+        print('{p:<{w}}{v}'.format(p=phase, w=width, v='  '.join('{k}={x}'.format(k=k, x=x) for k, x in values.items())))
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if not options.baseline:
+        return 0
+    if options.update_baseline or not os.path.isfile(options.baseline):
+        with open(options.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Wrote baseline \'{b}\''.format(b=options.baseline))
+        return 0
+    with open(options.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('parameters') != results['parameters']:
+        print('Warning: baseline \'{b}\' was recorded with different parameters'.format(b=options.baseline))
+    regressions = compare(results, baseline, options.tolerance, lower_is_better, ignored)
+    for regression in regressions:
+        print('Regression: ' + regression)
+    if regressions:
+        return 1
+    print('No regression against baseline \'{b}\''.format(b=options.baseline))
+    return 0
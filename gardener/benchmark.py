@@ -0,0 +1,217 @@
+import argparse
+import json
+import os
+import random
+import re
+import shlex
+import shutil
+import sys
+import tempfile
+import time
+
+# The harness shared by the benchmarks of this repo lives at its root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import benchmark_harness
+
+# Benchmark scan and prune runs of gardener.py on a synthetic tree
+#
+# A tree of 'depth' levels of 'fanout' directories is generated from a seed, with its
+# files spread over the leaf directories and their mtimes backdated with os.utime.
+# Directories are backdated by a minute, out of the racy window of the index.
+# Every phase is a separate gardener.py process, whose metrics file provides the files
+# scanned and deleted and whose rusage provides the peak RSS. With --strace, the system
+# calls of every phase are counted by strace, which slows the runs down.
+
+GARDENER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gardener.py')
+
+# Age of the files deleted by the prune phase, files are either well past it or well below it
+AGE = '1d'
+AGE_SECONDS = 86400
+
+# Lower is better for these results and for syscall counts, higher is better for every other one
+LOWER_IS_BETTER = ('seconds', 'peak_rss_mb')
+
+def lower_is_better(name):
+    return name in LOWER_IS_BETTER or name.startswith('syscalls')
+
+# System calls reported on their own with --strace, by family
+SYSCALLS = {
+    'getdents': ('getdents', 'getdents64'),
+    'stat': ('stat', 'lstat', 'fstat', 'newfstatat', 'fstatat64', 'statx'),
+    'open': ('open', 'openat', 'openat2'),
+    'unlink': ('unlink', 'unlinkat')
+}
+
+# Read command line args
+parser = argparse.ArgumentParser(description='Benchmark scan and prune throughput of gardener on a synthetic tree')
+parser.add_argument('--depth', help='Levels of directories of the synthetic tree. Default = 3', default=3, type=int)
+parser.add_argument('--fanout', help='Subdirectories of every directory above the leaves. Default = 10', default=10, type=int)
+parser.add_argument('--files', '-f', help='Number of files, spread evenly over the leaf directories. Default = 100000', default=100000, type=int)
+parser.add_argument('--file_size', help='Size of every file in bytes. Default = 0', default=0, type=int)
+parser.add_argument('--expired', help='Fraction of files older than the age of the prune phase. Default = 0.5', default=0.5, type=float)
+parser.add_argument('--unmatched', help='Fraction of files matching no pattern. Default = 0.2', default=0.2, type=float)
+parser.add_argument('--systems', help='Number of systems of the config, each with its own file pattern. Default = 1', default=1, type=int)
+parser.add_argument('--layout', help='Paths of the systems: all at the root (shared), one at the root and the others in its subdirectories (nested), or each in its own subdirectory (disjoint). Default = shared', default='shared', choices=['shared', 'nested', 'disjoint'])
+parser.add_argument('--index', help='Run gardener with an index, built by the scan phase', action='store_true')
+parser.add_argument('--strace', help='Count the system calls of every phase with strace -f -c', action='store_true')
+parser.add_argument('--seed', help='Seed of the synthetic tree. Default = 0', default=0, type=int)
+parser.add_argument('--gardener_args', help='Extra arguments of every gardener run, quoted as a shell would, e.g. --gardener_args=\'-w 8\'. A single argument needs the \'=\' form, e.g. --gardener_args=--idle', default='', type=str)
+benchmark_harness.add_arguments(parser)
+
+# Relative path and file pattern of every system
+def systems(options):
+    directories = [''] * options.systems
+    if options.layout == 'nested':
+        directories = [''] + ['d{n:03d}'.format(n=n % options.fanout) for n in range(options.systems - 1)]
+    elif options.layout == 'disjoint':
+        directories = ['d{n:03d}'.format(n=n % options.fanout) for n in range(options.systems)]
+    return { 's{n}'.format(n=n): (directories[n], '*.s{n}'.format(n=n)) for n in range(options.systems) }
+
+# Leaf directories of the tree, as relative paths
+def leaves(options):
+    paths = ['']
+    for _ in range(options.depth):
+        paths = [os.path.join(x, 'd{n:03d}'.format(n=n)) for x in paths for n in range(options.fanout)]
+    return paths
+
+# Generate the synthetic tree, returns its number of entries and the number of files the prune phase deletes
+# Files are written one at a time and never listed, which keeps the peak RSS of this process low
+def generate(directory, options):
+    rng = random.Random(options.seed)
+    now = time.time()
+    rules = list(systems(options).values())
+    content = b'\0' * options.file_size
+    directories = leaves(options)
+    entries = sum(options.fanout ** level for level in range(1, options.depth + 1))
+    expected = 0
+    for i in range(options.files):
+        relative_directory = directories[i % len(directories)]
+        if rng.random() < options.unmatched:
+            extension = 'dat'
+        else:
+            extension = 's{n}'.format(n=rng.randrange(options.systems))
+        expired = rng.random() < options.expired
+        if expired:
+            mtime = now - AGE_SECONDS * rng.uniform(2, 30)
+        else:
+            mtime = now - AGE_SECONDS * rng.uniform(0, 0.5)
+        path = os.path.join(directory, relative_directory, 'f{i:08d}.{e}'.format(i=i, e=extension))
+        if i < len(directories):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        os.utime(path, (mtime, mtime))
+        if expired and extension != 'dat':
+            rule_directory = rules[int(extension[1:])][0]
+            if not rule_directory or (relative_directory + os.sep).startswith(rule_directory + os.sep):
+                expected += 1
+    # Directories written just now are within the racy window of the index, which lists them
+    # again on every run, so they are backdated too. Changing the mtime of a directory leaves its parent's as is.
+    directories = set(os.path.join(directory, x) for x in directories[:options.files])
+    for path in list(directories):
+        while path != directory:
+            path = os.path.dirname(path)
+            directories.add(path)
+    for path in directories:
+        os.utime(path, (now - 60, now - 60))
+    return entries + options.files, expected
+
+# Config of the systems, all kept at the default age and size
+def write_config(config_file, directory, options):
+    config = { system: { 'path': os.path.join(directory, path), 'file_pattern': pattern } for system, (path, pattern) in systems(options).items() }
+    with open(config_file, 'w') as f:
+        json.dump(config, f, indent=2)
+
+# Syscall counts of an strace -c summary, in total and by family
+def parse_strace(strace_file):
+    calls = {}
+    with open(strace_file) as f:
+        for line in f:
+            # % time, seconds, usecs/call, calls, errors if any, syscall
+            match = re.match(r'^\s*[0-9.]+\s+[0-9.]+\s+[0-9]+\s+([0-9]+)\s+(?:[0-9]+\s+)?(\w+)\s*$', line)
+            if match and match.group(2) != 'total':
+                calls[match.group(2)] = int(match.group(1))
+    counts = { 'syscalls': sum(calls.values()) }
+    for family, names in SYSCALLS.items():
+        counts['syscalls_' + family] = sum(calls.get(x, 0) for x in names)
+    return counts
+
+# Run gardener.py, returns its wall clock seconds, peak RSS in MB, metrics summary and syscall counts
+def run(phase, age, config_file, work_dir, options):
+    metrics_file = os.path.join(work_dir, phase + '.metrics.json')
+    command = [sys.executable, GARDENER, '--disable_logging', '--metrics_file', metrics_file,
+               '-c', config_file, '-a', age, '-m', '0B'] + shlex.split(options.gardener_args)
+    if options.index:
+        command += ['-i', os.path.join(work_dir, 'index.db')]
+    strace_file = os.path.join(work_dir, phase + '.strace')
+    if options.strace:
+        command = ['strace', '-f', '-c', '-o', strace_file] + command
+    seconds, peak_rss_mb = benchmark_harness.run(command)
+    with open(metrics_file) as f:
+        summary = json.load(f)
+    syscalls = parse_strace(strace_file) if options.strace else {}
+    return seconds, peak_rss_mb, summary, syscalls
+
+def result(seconds, entries, peak_rss_mb, summary, syscalls):
+    counters = summary['systems'].values()
+    files_scanned = sum(x.get('files_scanned', 0) for x in counters)
+    files_deleted = sum(x.get('files_deleted', 0) for x in counters)
+    return {
+        'seconds': round(seconds, 3),
+        'entries_per_second': round(entries / seconds, 1),
+        'files_scanned': files_scanned,
+        'files_deleted': files_deleted,
+        'deletions_per_second': round(files_deleted / seconds, 1),
+        'peak_rss_mb': round(peak_rss_mb, 1),
+        **syscalls
+    }
+
+def main(options):
+    if options.strace and shutil.which('strace') is None:
+        sys.exit('strace is required by --strace')
+    if options.layout != 'shared' and options.systems > options.fanout:
+        sys.exit('The {l} layout needs at most --fanout systems'.format(l=options.layout))
+    work_dir = options.work_dir or tempfile.mkdtemp(prefix='gardener-benchmark-')
+    directory = os.path.join(work_dir, 'tree')
+    config_file = os.path.join(work_dir, 'settings.json')
+    try:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        for name in ('index.db', 'index.db-wal', 'index.db-shm'):
+            if os.path.exists(os.path.join(work_dir, name)):
+                os.remove(os.path.join(work_dir, name))
+        started = time.monotonic()
+        entries, expected = generate(directory, options)
+        print('Generated {e} entries in {s:.1f}s, {x} files to delete'.format(e=entries, s=time.monotonic() - started, x=expected))
+        write_config(config_file, directory, options)
+        phases = {}
+
+        # Walk the whole tree with nothing old enough to delete, and build the index if any
+        seconds, rss, summary, syscalls = run('scan', '1000w', config_file, work_dir, options)
+        phases['scan'] = result(seconds, entries, rss, summary, syscalls)
+
+        # Delete the expired files
+        seconds, rss, summary, syscalls = run('prune', AGE, config_file, work_dir, options)
+        phases['prune'] = result(seconds, entries, rss, summary, syscalls)
+        if phases['prune']['files_deleted'] != expected:
+            sys.exit('The prune phase deleted {d} files instead of {x}'.format(d=phases['prune']['files_deleted'], x=expected))
+
+        # Run again with nothing left to delete, as a scheduled run would
+        seconds, rss, summary, syscalls = run('rescan', AGE, config_file, work_dir, options)
+        phases['rescan'] = result(seconds, entries - expected, rss, summary, syscalls)
+        if phases['rescan']['files_deleted']:
+            sys.exit('The rescan phase deleted {d} files'.format(d=phases['rescan']['files_deleted']))
+    finally:
+        if options.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {
+        'parameters': benchmark_harness.parameters(options),
+        'tree': { 'entries': entries, 'files': options.files, 'expired': expected },
+        'phases': phases
+    }
+    # Counts of files scanned and deleted depend on the tree only, they are checked by the run itself
+    return benchmark_harness.report(results, options, lower_is_better, ignored=('files_scanned', 'files_deleted'))
+
+if __name__ == '__main__':
+    sys.exit(main(parser.parse_args()))
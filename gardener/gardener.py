@@ -1,11 +1,35 @@
+import signal
+import sys
+
 from libs.arguments import args
 
 from libs.Garden import Garden
+from libs.Daemon import Daemon
+from libs.logger import logger
+from libs.metrics import metrics
+from libs.ioprio import set_idle
+
+# Exit on SIGTERM like on SIGINT, so the daemon is shut down and the metrics are saved
+def terminate(signum, frame):
+    sys.exit(128 + signum)
 
 def main():
+    signal.signal(signal.SIGTERM, terminate)
+    if args.idle:
+        set_idle()
     # Main execution
-    with Garden(system=args.system, age=args.age, config_file=args.config, size=args.min_size) as garden:
+    if args.daemon:
+        with Daemon(system=args.system, age=args.age, config_file=args.config, size=args.min_size, workers=args.workers, rescan_interval=args.rescan_interval,
+                    delete_rate=args.delete_rate, delete_bandwidth=args.delete_bandwidth) as daemon:
+            daemon.run()
+        return
+    with Garden(system=args.system, age=args.age, config_file=args.config, size=args.min_size, workers=args.workers, index_file=args.index,
+                delete_rate=args.delete_rate, delete_bandwidth=args.delete_bandwidth) as garden:
         garden.tend()
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    finally:
+        logger.debug('Run summary: %s', metrics.summary())
+        metrics.save()
@@ -0,0 +1,167 @@
+import heapq
+import os
+import stat as stat_module
+import time
+
+from libs.Garden import Garden
+from libs.Inotify import Inotify, IN_ATTRIB, IN_CLOSE_WRITE, IN_CREATE, IN_DONT_FOLLOW, IN_IGNORED, IN_ISDIR, IN_MOVED_TO, IN_ONLYDIR, IN_Q_OVERFLOW
+from libs.logger import logger
+from libs.metrics import metrics
+from libs.Walker import Traversal
+
+# Garden subclass running as a long lived process, deleting every file when it expires
+#
+# An initial scan schedules the expiry of every matching file on a heap and watches every
+# directory with inotify. New files are scheduled as their events arrive, so work is
+# proportional to the files created rather than to the size of the trees. Files are
+# stat'ed again when their expiry comes, a file written since is rescheduled on its new
+# mtime. Appending to a file does not need an event of its own for the same reason.
+class Daemon(Garden):
+
+    watch_mask = IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE | IN_ATTRIB | IN_ONLYDIR | IN_DONT_FOLLOW
+
+    # Seconds before retrying with a rescan after a failed expiry
+    retry_delay = 30
+
+    def __init__(self, rescan_interval=86400, *args, **kwargs):
+        Garden.__init__(self, *args, **kwargs)
+        self.rescan_interval = int(rescan_interval)
+        systems = list(self.config) if self.system.lower() == 'all' else [self.system]
+        # Systems with a disk usage target are pruned towards it on every rescan instead
+        self.quota_systems = [x for x in systems if self._quota(x)]
+        self.traversals = Traversal.plan([self._rule(x) for x in systems if x not in self.quota_systems])
+        self.thresholds = { x.system: self._thresholds(x.system) for traversal in self.traversals for x in traversal.rules }
+        self._inotify = None
+        # { watch descriptor: (traversal, directory, states) }
+        self._watches = {}
+        # Heap of (expiry, system, path), an entry is stale unless it matches _deadlines
+        self._heap = []
+        self._deadlines = {}
+        self._next_rescan = 0
+
+    # Schedule the expiry of a file, keeping the earliest one already scheduled
+    def _schedule(self, system, path, deadline):
+        key = (system, path)
+        if key in self._deadlines and self._deadlines[key] <= deadline:
+            return
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, system, path))
+
+    def _watch(self, traversal, directory, states):
+        try:
+            wd = self._inotify.add_watch(directory, Daemon.watch_mask)
+        except FileNotFoundError:
+            return
+        except OSError as error:
+            logger.warning('Cannot watch directory \'%s\', relying on rescans: %s', directory, error)
+            return
+        self._watches[wd] = (traversal, directory, states)
+
+    # Schedule the expiry of a file for every system matching it
+    def _schedule_file(self, path, stat, systems):
+        for system in systems:
+            self._schedule(system, path, stat.st_mtime + self.thresholds[system][0])
+
+    # Watch the tree of a traversal, or a subdirectory of it, and schedule the expiry of its files
+    def _scan(self, traversal, root=None, states=None):
+        visit = lambda directory, states: self._watch(traversal, directory, states)
+        count = 0
+        for count, (path, stat, systems) in enumerate(self.walker.walk(traversal, visit=visit, root=root, states=states), 1):
+            metrics.count(systems, 'files_scanned')
+            self._schedule_file(path, stat, systems)
+        return count
+
+    # Full scan, catching up with anything events did not report
+    def _rescan(self):
+        for traversal in self.traversals:
+            count = self._scan(traversal)
+            logger.debug("Scheduled '%s' files under '%s'", count, traversal.root)
+        for system in self.quota_systems:
+            self.prune(system)
+        self._next_rescan = time.monotonic() + self.rescan_interval
+        logger.info("Watching '%s' directories, '%s' files scheduled", len(self._watches), len(self._deadlines))
+
+    def _handle(self, wd, mask, cookie, name):
+        if mask & IN_Q_OVERFLOW:
+            logger.warning('Inotify event queue overflowed, rescanning')
+            self._next_rescan = 0
+            return
+        watched = self._watches.get(wd)
+        if watched is None:
+            return
+        if mask & IN_IGNORED:
+            del self._watches[wd]
+            return
+        if not name:
+            return
+        traversal, directory, states = watched
+        path = os.path.join(directory, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                child_states = traversal.child_states(states, path, name)
+                if child_states is not None:
+                    self._scan(traversal, path, child_states)
+            return
+        systems = traversal.match(states, name)
+        if not systems:
+            return
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return
+        if stat_module.S_ISREG(stat.st_mode):
+            self._schedule_file(path, stat, systems)
+
+    # Delete the files whose expiry came
+    def _expire(self):
+        now = time.time()
+        due = {}
+        while self._heap and self._heap[0][0] <= now:
+            deadline, system, path = heapq.heappop(self._heap)
+            if self._deadlines.get((system, path)) != deadline:
+                continue
+            del self._deadlines[(system, path)]
+            due.setdefault(path, []).append(system)
+        if not due:
+            return
+        expired = []
+        # Sorted so the files of a directory are deleted in a batch
+        for path, stat in self.walker.stat(sorted(due)):
+            deleting = []
+            for system in due[path]:
+                age, min_size = self.thresholds[system]
+                if self._file_age(path, stat, now) < age:
+                    # Written since it was scheduled
+                    self._schedule(system, path, stat.st_mtime + age)
+                elif stat.st_size >= min_size:
+                    deleting.append(system)
+                else:
+                    logger.debug('File \'%s\' not large enough for deletion', path)
+                    # Only a write can make it large enough, and a write resets its age
+                    self._schedule(system, path, now + age)
+            if deleting:
+                expired.append((path, stat.st_size, len(expired) + 1, deleting))
+        # A file which cannot be deleted is picked up again by the next rescan
+        for system, deleted_count in self._delete(expired, strict=False).items():
+            logger.info("Deleted '%s' expired files for system '%s'", deleted_count, system)
+
+    # Seconds until the next expiry, rescan or metrics save is due
+    def _timeout(self):
+        timeout = min(self._next_rescan - time.monotonic(), metrics.until_tick())
+        if self._heap:
+            timeout = min(timeout, self._heap[0][0] - time.time())
+        return max(timeout, 0)
+
+    def run(self):
+        with Inotify() as self._inotify:
+            while True:
+                try:
+                    self._expire()
+                    if time.monotonic() >= self._next_rescan:
+                        self._rescan()
+                    metrics.tick()
+                except Exception:
+                    logger.exception('Expiry failed, retrying with a rescan in \'%s\' seconds', Daemon.retry_delay)
+                    self._next_rescan = time.monotonic() + Daemon.retry_delay
+                for event in self._inotify.read(self._timeout()):
+                    self._handle(*event)
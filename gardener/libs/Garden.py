@@ -1,4 +1,5 @@
-import glob
+import collections
+import concurrent.futures
 import json
 import os
 import time
@@ -7,6 +8,12 @@ import re
 from libs.arguments import age_regex_str, size_regex_str
 
 from libs.logger import logger
+from libs.metrics import metrics
+from libs.Index import Index
+from libs.Quota import Quota, Oldest, Budget
+from libs.Throttle import Throttle
+from libs.Walker import Rule, Traversal, Walker
+
 class Garden:
     time_units = {
         's': 1,
@@ -19,20 +26,35 @@ class Garden:
 
     size_units = {"B": 1, "KB": 2**10, "MB": 2**20, "GB": 2**30, "TB": 2**40}
 
-    def __init__(self, config_file, system, age, size):
+    # Files of a directory deleted together, through a single descriptor of the directory
+    batch_size = 256
+
+    def __init__(self, config_file, system, age, size, workers=None, index_file=None, delete_rate=0, delete_bandwidth=None):
         self.config_file = config_file
         self.system = system
         self.age = age
         self.min_size = size
+        self.workers = workers or min(32, (os.cpu_count() or 1) + 4)
 
         self.time_divisor = self._dict_parser(regex=age_regex_str, dict_name='time_units', obj=self.age)
         self.size_divisor = self._dict_parser(regex=size_regex_str, dict_name='size_units', obj=self.min_size, upper=True)
         self.config = self._import_json()
 
+        self.walker = Walker(workers=self.workers)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        self.index = Index(index_file) if index_file else None
+        # Deletions per second and bytes deleted per second, shared by every deleting thread
+        self.file_throttle = Throttle(float(delete_rate or 0))
+        self.byte_throttle = Throttle(self._parse_size(delete_bandwidth) if delete_bandwidth else 0)
+
     def __enter__(self):
         return self
 
     def __exit__(self, *exc):
+        self.walker.shutdown()
+        self.executor.shutdown(wait=True)
+        if self.index:
+            self.index.close()
         return exc
 
     # Import config
@@ -55,43 +77,226 @@ class Garden:
         number, unit = [string.strip() for string in obj.split()]
         return int(float(number)*getattr(Garden, dict_name)[unit])
 
+    # Size in bytes of a config value, either a number of bytes or a string like '10GB'
+    def _parse_size(self, value):
+        if isinstance(value, (int, float)):
+            return int(value)
+        return self._dict_parser(regex=size_regex_str, dict_name='size_units', obj=value, upper=True)
+
+    # Disk usage target of a system, or None when it is pruned by age
+    def _quota(self, object):
+        settings = self.config[object]
+        if not any(settings.get(x) for x in Quota.keys):
+            return None
+        return Quota(
+            path=settings["path"],
+            free_bytes=self._parse_size(settings.get("free_bytes", 0)),
+            free_percent=settings.get("free_percent", 0),
+            max_bytes=self._parse_size(settings.get("max_bytes", 0))
+        )
+
     # Check the age of a file
     # Returns the duration of time since the file was modified in seconds
-    def _file_age(self, filepath):
-        present_time = time.time()
-        file_mtime = os.path.getmtime(filepath)
-        time_diff = present_time - file_mtime
+    def _file_age(self, filepath, stat, present_time):
+        time_diff = present_time - stat.st_mtime
         logger.debug("Time difference of file \'%s\' is \'%s\'", filepath, time_diff)
         return time_diff
 
-    # Delete files
-    def prune(self, object):
-        deleted_files = []
-        present_time = time.time()
-        files = glob.glob(self.config[object]["path"] + '//**//' + self.config[object]["file_pattern"], recursive=True)
-        for count,file in enumerate(files):
-            file_count = count++1
-            if self._file_age(file) >= int(self.time_divisor):
-                file_size = os.path.getsize(file)
-                if file_size >= int(self.size_divisor):
-                    try:
-                        os.remove(file)
-                        deleted_files.append(file)
-                        logger.debug("(%s) File '%s' deleted", file_count, file)
-                    except Exception as e:
-                        logger.exception("(%s) Cannot delete file '%s'", file_count, file)
-                        raise e
-                else:
-                    logger.debug('File \'%s\' not large enough for deletion', file)
-        deleted_count = len(deleted_files)
+    # Delete a single file, relative to the descriptor of its directory when there is one
+    # Returns whether it was deleted, a file matched by several systems may already be gone
+    def _remove(self, file, file_count, index=None, dir_fd=None):
+        try:
+            if dir_fd is None:
+                os.remove(file)
+            else:
+                os.unlink(os.path.basename(file), dir_fd=dir_fd)
+            logger.debug("(%s) File '%s' deleted", file_count, file)
+            if index:
+                index.forget(file)
+            return True
+        except FileNotFoundError:
+            logger.debug("(%s) File '%s' already deleted", file_count, file)
+            if index:
+                index.forget(file)
+            return False
+        except Exception as e:
+            logger.exception("(%s) Cannot delete file '%s'", file_count, file)
+            raise e
+
+    # Delete a batch of files of a single directory, throttled to the deletion rates
+    # 'files' is a list of (path, size, file_count, systems)
+    # Returns the systems of every file deleted
+    def _remove_batch(self, files, index=None, strict=True):
+        deleted = []
+        dir_fd = None
+        if os.unlink in os.supports_dir_fd:
+            try:
+                dir_fd = os.open(os.path.dirname(files[0][0]), os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+            except OSError:
+                # Deleted with its files, or not readable, each file is deleted by path instead
+                dir_fd = None
+        try:
+            for file, size, file_count, systems in files:
+                self.file_throttle.consume(1)
+                self.byte_throttle.consume(size)
+                try:
+                    with metrics.stage(systems, 'delete'):
+                        removed = self._remove(file, file_count, index, dir_fd)
+                except Exception:
+                    if strict:
+                        raise
+                    # Logged by _remove, the file is picked up again later
+                    continue
+                if removed:
+                    metrics.count(systems, 'files_deleted')
+                    metrics.count(systems, 'bytes_freed', size)
+                    deleted.append(systems)
+        finally:
+            if dir_fd is not None:
+                os.close(dir_fd)
+        return deleted
+
+    # Group consecutive files of the same directory into batches of at most 'batch_size'
+    def _batches(self, files):
+        batch = []
+        for item in files:
+            if batch and (len(batch) >= Garden.batch_size or os.path.dirname(item[0]) != os.path.dirname(batch[0][0])):
+                yield batch
+                batch = []
+            batch.append(item)
+        if batch:
+            yield batch
+
+    # Delete files given as (path, size, file_count, systems), in batches per directory
+    # Batches in flight are bounded so a slow disk does not queue the whole tree
+    # With 'strict', the first file which cannot be deleted stops the deletions
+    # Returns the number of files deleted per system
+    def _delete(self, files, index=None, strict=True):
+        deleted_counts = {}
+        deletions = collections.deque()
+        def collect():
+            for systems in deletions.popleft().result():
+                for system in systems:
+                    deleted_counts[system] = deleted_counts.get(system, 0) + 1
+            metrics.tick()
+        for batch in self._batches(files):
+            deletions.append(self.executor.submit(self._remove_batch, batch, index, strict))
+            while len(deletions) > 2 * self.workers:
+                collect()
+        while deletions:
+            collect()
+        return deleted_counts
+
+    # Age in seconds and minimum size in bytes of the files of a system to delete
+    # The 'age' and 'min_size' of a system in the config override the arguments
+    def _thresholds(self, object):
+        settings = self.config[object]
+        age = self._dict_parser(regex=age_regex_str, dict_name='time_units', obj=settings["age"]) if "age" in settings else self.time_divisor
+        min_size = self._parse_size(settings["min_size"]) if "min_size" in settings else self.size_divisor
+        return int(age), int(min_size)
+
+    def _rule(self, object):
+        return Rule(object, self.config[object]["path"], self.config[object]["file_pattern"])
+
+    # Whether a file is old and large enough to be deleted
+    def _expired(self, file, stat, present_time, age, min_size):
+        if self._file_age(file, stat, present_time) < age:
+            return False
+        if stat.st_size < min_size:
+            logger.debug('File \'%s\' not large enough for deletion', file)
+            return False
+        return True
+
+    # Files of a traversal to consider for deletion, with their matching systems
+    # With an index, the files of the directories which changed, then the indexed files older than 'cutoff'
+    # Indexed files come in mtime order, they are sorted so the files of a directory are deleted in a batch
+    def _files(self, traversal, index, cutoff):
+        yield from self.walker.walk(traversal, index=index)
+        if index:
+            candidates = index.candidates(cutoff)
+            for file, stat in self.walker.stat(sorted(candidates), index=index):
+                yield file, stat, candidates[file]
+
+    # Delete the oldest files of a system until its disk usage target is met, regardless of their age and size
+    def _prune_quota(self, object, quota):
+        deleted_count = 0
+        systems = (object,)
+        traversal = Traversal.plan([self._rule(object)])[0]
+        if quota.max_bytes:
+            # Files falling out of the budget are deleted as the tree is walked
+            budget = Budget(quota.max_bytes)
+            def dropped():
+                for file_count, (file, stat, matched) in enumerate(self.walker.walk(traversal), 1):
+                    metrics.count(systems, 'files_scanned')
+                    for path, size in budget.add(file, stat):
+                        yield path, size, file_count, systems
+            deleted_count += self._delete(dropped()).get(object, 0)
+            logger.debug("Files of system '%s' add up to '%s' bytes", object, budget.total)
+        deficit = quota.deficit()
+        if deficit:
+            oldest = Oldest(deficit)
+            for file, stat, matched in self.walker.walk(traversal):
+                metrics.count(systems, 'files_scanned')
+                oldest.add(file, stat)
+            files = [(path, size, file_count, systems) for file_count, (path, size) in enumerate(oldest.files(), 1)]
+            logger.debug("Freeing '%s' bytes from '%s' files for system '%s'", deficit, len(files), object)
+            # Delete in chunks, checking the free space again after each of them
+            # Space freed by others, or not freed by files still open or linked elsewhere, is accounted for
+            # Each chunk is sorted so the files of a directory are deleted in a batch
+            chunk = Garden.batch_size
+            for start in range(0, len(files), chunk):
+                if not quota.deficit():
+                    break
+                deleted_count += self._delete(sorted(files[start:start + chunk])).get(object, 0)
+            deficit = quota.deficit()
+            if deficit:
+                logger.warning("Free space target of system '%s' not met, '%s' bytes short", object, deficit)
         if deleted_count > 0:
-            logger.info("Deleted '%s' files for system '%s'", deleted_count, object)
+            logger.info("Deleted '%s' files for system '%s' to meet its disk usage target", deleted_count, object)
         else:
-            logger.debug("No files deleted for system '%s'", object)
+            logger.debug("No files deleted for system '%s', its disk usage target is met", object)
+
+    # Delete the files of the systems of a traversal, walking its tree once
+    def _prune_traversal(self, traversal):
+        present_time = time.time()
+        thresholds = { x.system: self._thresholds(x.system) for x in traversal.rules }
+        index = self.index.traversal(traversal) if self.index else None
+        files = self._files(traversal, index, present_time - min(x[0] for x in thresholds.values()))
+        def expired():
+            for file_count, (file, stat, systems) in enumerate(files, 1):
+                metrics.count(systems, 'files_scanned')
+                deleting = [x for x in systems if self._expired(file, stat, present_time, *thresholds[x])]
+                if deleting:
+                    yield file, stat.st_size, file_count, deleting
+        deleted_counts = self._delete(expired(), index)
+        if index:
+            index.commit()
+        for object in thresholds:
+            if deleted_counts.get(object, 0) > 0:
+                logger.info("Deleted '%s' files for system '%s'", deleted_counts[object], object)
+            else:
+                logger.debug("No files deleted for system '%s'", object)
+
+    # Run a prune of 'systems', timing it
+    def _run(self, systems, prune, *args):
+        with metrics.stage(systems, 'prune'):
+            prune(*args)
+
+    # Delete files of the given systems
+    # Systems pruned by age are merged into one traversal per distinct root, so nested or
+    # shared paths are walked once, and traversals run concurrently on the shared threads
+    def prune(self, *objects):
+        quotas = { x: self._quota(x) for x in objects }
+        tasks = [((x,), self._prune_quota, x, quota) for x, quota in quotas.items() if quota]
+        tasks.extend(([rule.system for rule in x.rules], self._prune_traversal, x) for x in Traversal.plan([self._rule(x) for x, quota in quotas.items() if not quota]))
+        if len(tasks) == 1:
+            return self._run(*tasks[0])
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(tasks), self.workers) or 1) as executor:
+            for future in [executor.submit(self._run, *task) for task in tasks]:
+                future.result()
 
     def tend(self):
         if self.system.lower() == 'all':
-            for item in self.config:
-                self.prune(item)
+            self.prune(*self.config)
         else:
-            self.prune(self.system)
\ No newline at end of file
+            self.prune(self.system)
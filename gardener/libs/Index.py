@@ -0,0 +1,129 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from libs.logger import logger
+
+# Persisted index of the files matched by every traversal, in a SQLite database
+#
+# Files are stored with their mtime, size and matching systems, indexed by mtime, so
+# the files expiring past their age are found without walking the tree. Directories are stored with their
+# mtime: a directory whose mtime did not change since it was scanned gained or lost no
+# entries, so it is not listed again and its subdirectories are taken from the index.
+# Files modified in place do not change the mtime of their directory, so expired files
+# are stat'ed again before they are deleted.
+class Index:
+
+    # Version of the schema, an index with another version is rebuilt
+    version = 2
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS roots (root TEXT PRIMARY KEY, signature TEXT);
+        CREATE TABLE IF NOT EXISTS directories (root TEXT, path TEXT, parent TEXT, mtime INTEGER, PRIMARY KEY (root, path));
+        CREATE INDEX IF NOT EXISTS directories_parent ON directories (root, parent);
+        CREATE TABLE IF NOT EXISTS files (root TEXT, path TEXT, directory TEXT, mtime REAL, size INTEGER, systems TEXT, PRIMARY KEY (root, path));
+        CREATE INDEX IF NOT EXISTS files_mtime ON files (root, mtime);
+        CREATE INDEX IF NOT EXISTS files_directory ON files (root, directory);
+    '''
+
+    def __init__(self, index_file):
+        self.index_file = index_file
+        # Systems are pruned concurrently, every statement goes through this lock
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(index_file, timeout=60, check_same_thread=False)
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != Index.version:
+            self.db.executescript('DROP TABLE IF EXISTS systems; DROP TABLE IF EXISTS roots; DROP TABLE IF EXISTS directories; DROP TABLE IF EXISTS files;')
+            self.db.execute('PRAGMA user_version = ' + str(Index.version))
+        self.db.executescript(Index.schema)
+        logger.debug("Index file '%s' loaded", index_file)
+
+    # View of the index for a single traversal, discarding its entries if its systems changed
+    def traversal(self, traversal):
+        root, signature = traversal.root, traversal.signature()
+        with self.lock:
+            row = self.db.execute('SELECT signature FROM roots WHERE root = ?', (root,)).fetchone()
+            if row is None or row[0] != signature:
+                if row is not None:
+                    logger.info("Systems under '%s' changed, rebuilding its index", root)
+                for table in ('files', 'directories'):
+                    self.db.execute('DELETE FROM ' + table + ' WHERE root = ?', (root,))
+                self.db.execute('INSERT OR REPLACE INTO roots VALUES (?, ?)', (root, signature))
+            self.db.commit()
+        return TraversalIndex(self, root)
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+class TraversalIndex:
+
+    # Directories modified this many nanoseconds before a scan started may still be
+    # changing within the resolution of their mtime, they are listed again next run
+    racy_window = 2 * 10 ** 9
+
+    def __init__(self, index, root):
+        self.index = index
+        self.db = index.db
+        self.lock = index.lock
+        self.root = root
+        self.started = time.time_ns()
+        # Directories listed during this run, their files were already seen
+        self.scanned = set()
+
+    # mtime of a directory when it was last listed, or None if it must be listed
+    def mtime(self, directory):
+        with self.lock:
+            row = self.db.execute('SELECT mtime FROM directories WHERE root = ? AND path = ?', (self.root, directory)).fetchone()
+        return row[0] if row else None
+
+    # Subdirectories of a directory when it was last listed
+    def children(self, directory):
+        with self.lock:
+            return [x[0] for x in self.db.execute('SELECT path FROM directories WHERE root = ? AND parent = ?', (self.root, directory))]
+
+    # Record the listing of a directory: its mtime, its matching files and its walked subdirectories
+    def update(self, directory, mtime, files, directories):
+        if mtime is not None and mtime > self.started - TraversalIndex.racy_window:
+            mtime = None
+        subdirectories = set(x[0] for x in directories)
+        with self.lock:
+            self.scanned.add(directory)
+            self.db.execute('DELETE FROM files WHERE root = ? AND directory = ?', (self.root, directory))
+            self.db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)', ((self.root, path, directory, stat.st_mtime, stat.st_size, json.dumps(systems)) for path, stat, systems in files))
+            for path in set(self.children(directory)).difference(subdirectories):
+                self._forget_tree(path)
+            self.db.executemany('INSERT OR IGNORE INTO directories VALUES (?, ?, ?, NULL)', ((self.root, path, directory) for path in subdirectories))
+            parent = self.db.execute('SELECT parent FROM directories WHERE root = ? AND path = ?', (self.root, directory)).fetchone()
+            self.db.execute('INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)', (self.root, directory, parent[0] if parent else None, mtime))
+
+    # Forget a directory which disappeared, and everything below it
+    def _forget_tree(self, directory):
+        lower, upper = directory + os.sep, directory + chr(ord(os.sep) + 1)
+        for table in ('files', 'directories'):
+            self.db.execute('DELETE FROM ' + table + ' WHERE root = ? AND (path = ? OR (path >= ? AND path < ?))', (self.root, directory, lower, upper))
+
+    # Files last seen with an mtime older than 'cutoff', outside of the directories listed this run
+    # Returns their matching systems by path
+    def candidates(self, cutoff):
+        with self.lock:
+            rows = self.db.execute('SELECT path, directory, systems FROM files WHERE root = ? AND mtime <= ? ORDER BY mtime', (self.root, cutoff)).fetchall()
+        return { path: tuple(json.loads(systems)) for path, directory, systems in rows if directory not in self.scanned }
+
+    # Record the current mtime and size of a file
+    def touch(self, path, stat):
+        with self.lock:
+            self.db.execute('UPDATE files SET mtime = ?, size = ? WHERE root = ? AND path = ?', (stat.st_mtime, stat.st_size, self.root, path))
+
+    # Forget a deleted file
+    def forget(self, path):
+        with self.lock:
+            self.db.execute('DELETE FROM files WHERE root = ? AND path = ?', (self.root, path))
+
+    def commit(self):
+        self.index.commit()
@@ -0,0 +1,71 @@
+import heapq
+import shutil
+
+# Disk usage target of a system, declared in its config with any of:
+# - 'free_bytes': free space to keep on the filesystem of its path, e.g. "50GB"
+# - 'free_percent': free space to keep on the filesystem of its path, in percent
+# - 'max_bytes': size the matching files of its path may add up to, e.g. "500GB"
+class Quota:
+
+    keys = ('free_bytes', 'free_percent', 'max_bytes')
+
+    def __init__(self, path, free_bytes=0, free_percent=0, max_bytes=0):
+        self.path = path
+        self.free_bytes = int(free_bytes or 0)
+        self.free_percent = float(free_percent or 0)
+        self.max_bytes = int(max_bytes or 0)
+
+    # Bytes to free on the filesystem of the path to reach the free space targets
+    def deficit(self):
+        if not self.free_bytes and not self.free_percent:
+            return 0
+        usage = shutil.disk_usage(self.path)
+        target = max(self.free_bytes, usage.total * self.free_percent / 100)
+        return max(int(target - usage.free), 0)
+
+# Oldest files whose sizes add up to at least 'amount'
+# The heap holds the youngest selected file on top, and drops it as soon as the others cover
+# 'amount' without it, so it never grows past the files needed
+class Oldest:
+
+    def __init__(self, amount):
+        self.amount = amount
+        self.total = 0
+        self._heap = []
+
+    def add(self, path, stat):
+        heapq.heappush(self._heap, (-stat.st_mtime, path, stat.st_size))
+        self.total += stat.st_size
+        while self._heap and self.total - self._heap[0][2] >= self.amount:
+            self.total -= heapq.heappop(self._heap)[2]
+
+    # Selected files as (path, size), oldest first
+    def files(self):
+        return [(x[1], x[2]) for x in sorted(self._heap, reverse=True)]
+
+# Youngest files whose sizes add up to at most 'budget'
+# A file dropped from the heap is older than files already adding up past the budget with
+# it, so it is dropped for good and can be deleted right away. So is any file added later
+# which is older than a dropped one, even if it would fit in what is left of the budget.
+class Budget:
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.total = 0
+        self._heap = []
+        # mtime of the youngest file dropped so far
+        self._dropped = None
+
+    # Add a file, returns the files falling out of the budget as (path, size)
+    def add(self, path, stat):
+        if self._dropped is not None and stat.st_mtime <= self._dropped:
+            return [(path, stat.st_size)]
+        heapq.heappush(self._heap, (stat.st_mtime, path, stat.st_size))
+        self.total += stat.st_size
+        dropped = []
+        while self.total > self.budget:
+            mtime, dropped_path, size = heapq.heappop(self._heap)
+            self.total -= size
+            self._dropped = mtime
+            dropped.append((dropped_path, size))
+        return dropped
@@ -0,0 +1,21 @@
+import threading
+import time
+
+# Token bucket shared by every deleting thread, capping their aggregate rate
+# Each caller reserves the time its amount takes at 'rate' per second and waits for its turn
+class Throttle:
+
+    def __init__(self, rate=0):
+        self.rate = rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount=1):
+        if not self.rate or amount <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + amount / self.rate
+        if start > now:
+            time.sleep(start - now)
@@ -0,0 +1,233 @@
+import collections
+import concurrent.futures
+import fnmatch
+import glob
+import json
+import os
+import queue
+import re
+
+from libs.logger import logger
+from libs.metrics import metrics
+
+# A glob pattern matched against the relative path of a file, the way
+# glob.glob(path + '/**/' + pattern, recursive=True) matches it
+#
+# Every component of the pattern matches one trailing component of the path.
+# Wildcards do not match hidden names unless the pattern component starts with a dot,
+# and '**' does not descend into hidden directories.
+class Pattern:
+
+    def __init__(self, pattern):
+        self.source = pattern
+        parts = [x for x in re.split(r'[\\/]' if os.altsep else r'/', pattern) if x]
+        # Regular expression of the file name, shared by the patterns of a traversal
+        self.name_regex = fnmatch.translate(os.path.normcase(parts[-1]))
+        self.parts = [Pattern._compile(x) for x in parts]
+
+    @staticmethod
+    def _compile(part):
+        regex = re.compile(fnmatch.translate(os.path.normcase(part)))
+        hidden = glob.has_magic(part) and not part.startswith('.')
+        return regex, hidden
+
+    def __len__(self):
+        return len(self.parts)
+
+    def _match_part(self, part, name):
+        regex, hidden = part
+        if hidden and name.startswith('.'):
+            return False
+        return regex.match(os.path.normcase(name)) is not None
+
+    # Whether a file named 'name' in the directory 'components' (relative to the root) matches
+    def match(self, components, name):
+        if len(self.parts) == 1:
+            return self._match_part(self.parts[0], name)
+        components = components + (name,)
+        if len(components) < len(self.parts):
+            return False
+        head, tail = components[:-len(self.parts)], components[-len(self.parts):]
+        if any(x.startswith('.') for x in head):
+            return False
+        return all(self._match_part(part, x) for part, x in zip(self.parts, tail))
+
+# The files of a system: its path and its pattern
+class Rule:
+
+    def __init__(self, system, path, pattern):
+        self.system = system
+        self.path = os.path.normcase(os.path.realpath(path))
+        self.pattern = Pattern(pattern)
+
+# A single walk of a directory tree, serving every rule whose path is in it
+#
+# Every directory walked carries the states of the rules applying to it, tuples of
+# (rule number, components below the path of the rule, limit). 'limit' is the number
+# of levels below a hidden directory which may still hold matches, or None.
+# Rules with a path nested in the root start applying once the walk reaches it.
+class Traversal:
+
+    def __init__(self, root, rules):
+        self.root = root
+        self.rules = rules
+        # Directories where rules start applying
+        self.starts = {}
+        for number, rule in enumerate(rules):
+            self.starts.setdefault(rule.path, []).append(number)
+        # Directories leading to a nested rule, walked even if no rule applies to them yet
+        self.ancestors = set()
+        for path in self.starts:
+            while path != root and path not in self.ancestors:
+                self.ancestors.add(path)
+                path = os.path.dirname(path)
+        self.states = self.child_states((), root, None)
+        self.systems = [x.system for x in rules]
+        self._name_regexes = {}
+
+    # Merge rules into one traversal per distinct root, nested paths are walked once with their root
+    @staticmethod
+    def plan(rules):
+        roots = {}
+        for rule in sorted(rules, key=lambda x: x.path):
+            root = next((x for x in roots if rule.path == x or rule.path.startswith(x.rstrip(os.sep) + os.sep)), rule.path)
+            roots.setdefault(root, []).append(rule)
+        return [Traversal(root, rules) for root, rules in roots.items()]
+
+    # Identity of the rules of the traversal, an index built for other rules cannot be reused
+    def signature(self):
+        return json.dumps(sorted([x.system, x.path, x.pattern.source] for x in self.rules))
+
+    # States of the rules applying to the subdirectory 'name' at 'path' of a directory,
+    # or None when the subdirectory does not need to be walked
+    def child_states(self, states, path, name):
+        children = []
+        for number, components, limit in states:
+            if limit is not None:
+                limit -= 1
+            elif name.startswith('.'):
+                # Only a pattern with directory components can match below a hidden directory
+                limit = len(self.rules[number].pattern) - 2
+            if limit is None or limit >= 0:
+                children.append((number, components + (name,), limit))
+        key = os.path.normcase(path)
+        children.extend((number, (), None) for number in self.starts.get(key, ()))
+        if not children and key not in self.ancestors:
+            return None
+        return tuple(children)
+
+    # Systems whose rules match the file 'name' of a directory with 'states'
+    def match(self, states, name):
+        if not states:
+            return ()
+        # A single regular expression of every file name pattern rules out most files at once
+        numbers = tuple(x[0] for x in states)
+        name_regex = self._name_regexes.get(numbers)
+        if name_regex is None:
+            name_regex = re.compile('|'.join(sorted(set(self.rules[x].pattern.name_regex for x in numbers))))
+            self._name_regexes[numbers] = name_regex
+        if not name_regex.match(os.path.normcase(name)):
+            return ()
+        return tuple(self.rules[number].system for number, components, limit in states if self.rules[number].pattern.match(components, name))
+
+# Streaming directory walker, scanning directories concurrently on a thread pool
+#
+# Each directory is read with a single os.scandir() call and only matching files are
+# stat'ed, once. Files are yielded with their stat result as their directory is scanned,
+# so a tree is never held in memory. Symbolic links to directories are not followed.
+class Walker:
+
+    def __init__(self, workers):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        # Directories scanned ahead of the consumer
+        self.window = 4 * workers
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    # Scan a single directory
+    # With the mtime it had when last scanned, an unchanged directory is not listed
+    def _scan(self, traversal, directory, states, known=False):
+        with metrics.stage(traversal.systems, 'scan'):
+            return self._scan_directory(traversal, directory, states, known)
+
+    def _scan_directory(self, traversal, directory, states, known):
+        files = []
+        directories = []
+        mtime = None
+        try:
+            if known is not False:
+                mtime = os.stat(directory).st_mtime_ns
+                if mtime == known:
+                    return None, None, mtime
+            with os.scandir(directory) as scan:
+                for entry in scan:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            child_states = traversal.child_states(states, entry.path, entry.name)
+                            if child_states is not None:
+                                directories.append((entry.path, child_states))
+                        else:
+                            systems = traversal.match(states, entry.name)
+                            if systems and entry.is_file():
+                                files.append((entry.path, entry.stat(), systems))
+                    except FileNotFoundError:
+                        # Deleted while scanning
+                        continue
+        except OSError as error:
+            logger.warning('Cannot scan directory \'%s\': %s', directory, error)
+            # Scan it again next time
+            mtime = None
+        return files, directories, mtime
+
+    # Yield the path, stat result and matching systems of every file of a traversal
+    # With an 'index', only directories changed since they were indexed are listed,
+    # and only the files found in them are yielded
+    # 'visit' is called with every directory walked and its states
+    # 'root' and 'states' start the walk from a directory below the root of the traversal
+    def walk(self, traversal, index=None, visit=None, root=None, states=None):
+        results = queue.SimpleQueue()
+        waiting = collections.deque([(root or traversal.root, traversal.states if states is None else states)])
+        running = 0
+        while waiting or running:
+            # Keep a bounded number of directories scanning ahead
+            while waiting and running < self.window:
+                directory = waiting.pop()
+                known = index.mtime(directory[0]) if index else False
+                future = self.executor.submit(self._scan, traversal, *directory, known)
+                future.add_done_callback(lambda future, directory=directory: results.put((directory, future)))
+                running += 1
+            (directory, states), future = results.get()
+            files, directories, mtime = future.result()
+            running -= 1
+            if visit:
+                visit(directory, states)
+            if files is None:
+                # Unchanged since indexed
+                for path in index.children(directory):
+                    child_states = traversal.child_states(states, path, os.path.basename(path))
+                    if child_states is not None:
+                        waiting.append((path, child_states))
+                continue
+            if index:
+                index.update(directory, mtime, files, directories)
+            waiting.extend(directories)
+            yield from files
+
+    # Yield the path and current stat result of every file in 'paths' which still exists
+    def stat(self, paths, index=None):
+        for path, stat in self.executor.map(Walker._stat, paths):
+            if stat is None:
+                if index:
+                    index.forget(path)
+                continue
+            if index:
+                index.touch(path, stat)
+            yield path, stat
+
+    @staticmethod
+    def _stat(path):
+        try:
+            return path, os.stat(path)
+        except FileNotFoundError:
+            return path, None
@@ -27,5 +27,13 @@ parser.add_argument('--age', '-a', help='Change default mtime parameter (e.g. \'
 parser.add_argument('--debug', '-d', help='Change default logging to debug', action='store_true')
 parser.add_argument('--disable_logging', help='Prevent script from logging at all', action='store_true')
 parser.add_argument('--min_size', '-m', help='Minimum file size to delete', default='10G', type=size_regex)
+parser.add_argument('--workers', '-w', help='Number of threads scanning directories and deleting files in parallel. Default = number of CPUs + 4, at most 32', default=None, type=int)
+parser.add_argument('--index', '-i', help='SQLite index file of the files and directories seen by previous runs. Only changed directories and expired files are visited. Default = disabled', default=None, type=str)
+parser.add_argument('--daemon', help='Keep running, watching the paths with inotify (Linux only) and deleting every file as it expires instead of scanning once', action='store_true')
+parser.add_argument('--rescan_interval', help='Seconds between full scans in daemon mode, catching up with anything inotify missed. Default = 86400', default=86400, type=int)
+parser.add_argument('--delete_rate', help='Maximum number of files deleted per second. Default = unlimited', default=0, type=float)
+parser.add_argument('--delete_bandwidth', help='Maximum size of the files deleted per second (e.g. \'500MB\'). Default = unlimited', default=None, type=size_regex)
+parser.add_argument('--idle', help='Run in the idle I/O scheduling class (Linux only), so disk I/O of other processes goes first', action='store_true')
+parser.add_argument('--metrics_file', help='File to write per system metrics to, in the Prometheus text format if it ends with \'.prom\', in JSON otherwise', default=None, type=str)
 
 args = parser.parse_args()
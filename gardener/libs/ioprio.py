@@ -0,0 +1,39 @@
+import ctypes
+import ctypes.util
+import os
+import platform
+
+from libs.logger import logger
+
+# Minimal ctypes binding of the Linux ioprio_set system call
+
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+# ioprio_set has no libc wrapper, its number depends on the architecture
+_syscalls = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'ppc64le': 273,
+    's390x': 282
+}
+
+# Move the process to the idle I/O scheduling class, its disk I/O is only served when no
+# other process needs the disk. Threads started afterwards inherit the class.
+# Only honoured by the BFQ and CFQ I/O schedulers.
+def set_idle():
+    number = _syscalls.get(platform.machine())
+    if platform.system() != 'Linux' or number is None:
+        logger.warning('Idle I/O scheduling is not supported on this platform, ignoring')
+        return False
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    if libc.syscall(number, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) < 0:
+        error = ctypes.get_errno()
+        logger.warning('Cannot set idle I/O scheduling: %s', os.strerror(error))
+        return False
+    logger.debug('Set idle I/O scheduling')
+    return True
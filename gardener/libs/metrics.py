@@ -0,0 +1,120 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+from libs.arguments import args
+from libs.logger import logger
+
+# Counters and latencies of a run, per system
+#
+# Directories are walked once for every system sharing them, so their scans are
+# accounted to each of these systems.
+class Metrics:
+
+    # Seconds between two progress lines
+    progress_interval = 10
+
+    def __init__(self, output=None):
+        self.output = output
+        self.started = time.monotonic()
+        self.systems = {}
+        self._lock = threading.Lock()
+        self._last_progress = self.started
+
+    def _system(self, system):
+        return self.systems.setdefault(system, {})
+
+    def count(self, systems, name, value=1):
+        with self._lock:
+            for system in systems:
+                counters = self._system(system)
+                counters[name] = counters.get(name, 0) + value
+
+    # Record the latency of an operation of a stage
+    def observe(self, systems, name, seconds):
+        with self._lock:
+            for system in systems:
+                counters = self._system(system)
+                counters[name + '_seconds'] = counters.get(name + '_seconds', 0.0) + seconds
+                counters[name + '_count'] = counters.get(name + '_count', 0) + 1
+                counters[name + '_max_seconds'] = max(counters.get(name + '_max_seconds', 0.0), seconds)
+
+    # Time a block of work as an operation of a stage
+    @contextlib.contextmanager
+    def stage(self, systems, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(systems, name, time.monotonic() - started)
+
+    # Seconds until the next progress line is due
+    def until_tick(self):
+        return max(self._last_progress + Metrics.progress_interval - time.monotonic(), 0)
+
+    # Log an aggregated progress line and save the metrics, at most every 'progress_interval' seconds
+    def tick(self):
+        now = time.monotonic()
+        if now - self._last_progress < Metrics.progress_interval:
+            return
+        with self._lock:
+            if now - self._last_progress < Metrics.progress_interval:
+                return
+            self._last_progress = now
+            totals = {}
+            for counters in self.systems.values():
+                for name in ('files_scanned', 'files_deleted', 'bytes_freed'):
+                    totals[name] = totals.get(name, 0) + counters.get(name, 0)
+        logger.info('Progress: %s', ', '.join('{k} {v}'.format(k=k, v=v) for k, v in totals.items()))
+        self.save()
+
+    # Summary of the run, with average latencies and throughputs
+    def summary(self):
+        elapsed = time.monotonic() - self.started
+        with self._lock:
+            systems = { k: dict(v) for k, v in self.systems.items() }
+        for counters in systems.values():
+            for name in ('scan', 'delete'):
+                if counters.get(name + '_count'):
+                    counters[name + '_latency_seconds'] = counters[name + '_seconds'] / counters[name + '_count']
+            # Throughput over the time spent pruning the system, or over the run in daemon mode
+            seconds = max(counters.get('prune_seconds', elapsed), 1e-6)
+            counters['files_scanned_per_second'] = counters.get('files_scanned', 0) / seconds
+            counters['files_deleted_per_second'] = counters.get('files_deleted', 0) / seconds
+            counters['bytes_freed_per_second'] = counters.get('bytes_freed', 0) / seconds
+            for name, value in counters.items():
+                if isinstance(value, float):
+                    counters[name] = round(value, 6)
+        return { 'elapsed_seconds': round(elapsed, 3), 'systems': dict(sorted(systems.items())) }
+
+    # Summary in the Prometheus text exposition format, for the node exporter textfile collector
+    def prometheus(self):
+        summary = self.summary()
+        lines = [
+            '# TYPE gardener_elapsed_seconds gauge',
+            'gardener_elapsed_seconds {v}'.format(v=summary['elapsed_seconds'])
+        ]
+        names = sorted(set(name for counters in summary['systems'].values() for name in counters))
+        for name in names:
+            lines.append('# TYPE gardener_{k} gauge'.format(k=name))
+            for system, counters in summary['systems'].items():
+                if name in counters:
+                    lines.append('gardener_{k}{{system="{s}"}} {v}'.format(k=name, s=system.replace('\\', '\\\\').replace('"', '\\"'), v=counters[name]))
+        return '\n'.join(lines) + '\n'
+
+    # Write the summary to 'output', as Prometheus text when it ends with '.prom', as JSON otherwise
+    def save(self):
+        if not self.output:
+            return
+        content = self.prometheus() if self.output.endswith('.prom') else json.dumps(self.summary(), indent=2) + '\n'
+        temp_file = self.output + '.' + str(os.getpid()) + '.tmp'
+        with open(temp_file, 'w') as f:
+            f.write(content)
+        os.replace(temp_file, self.output)
+        logger.debug('Saved metrics to \'%s\'', self.output)
+
+metrics = Metrics(output=args.metrics_file)
+
+# from metrics import metrics
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# libs.arguments parses the command line on import, give it a valid one
+sys.argv = ['gardener.py', '--disable_logging', '-m', '0B']
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,113 @@
+import json
+import os
+import time
+
+import pytest
+
+from libs.Daemon import Daemon
+from libs.Inotify import IN_CLOSE_WRITE, IN_CREATE, IN_ISDIR
+
+DAY = 86400
+
+def write(root, relative_path, size=0, mtime=None):
+    path = os.path.join(root, relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'\0' * size)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return path
+
+# Watches handed out in place of inotify
+class Watches:
+
+    def __init__(self):
+        self.directories = []
+
+    def add_watch(self, directory, mask):
+        self.directories.append(directory)
+        return len(self.directories) + 1
+
+# Daemon of a single system, with its root watched as descriptor 1, without inotify
+@pytest.fixture
+def daemon(tmp_path):
+    root = str(tmp_path / 'tree')
+    os.makedirs(root)
+    config_file = str(tmp_path / 'settings.json')
+    daemons = []
+    def daemon(**settings):
+        with open(config_file, 'w') as f:
+            json.dump({ 's': dict({ 'path': root, 'file_pattern': '*.log' }, **settings) }, f)
+        daemon = Daemon(config_file=config_file, system='s', age='1d', size='0B', workers=2)
+        [traversal] = daemon.traversals
+        daemon._inotify = Watches()
+        daemon._watches[1] = (traversal, traversal.root, traversal.states)
+        daemons.append(daemon)
+        return daemon
+    daemon.root = root
+    yield daemon
+    for x in daemons:
+        x.__exit__(None, None, None)
+
+def test_files_are_scheduled_at_their_mtime_plus_age(daemon):
+    gardener = daemon()
+    mtime = time.time() - 3600
+    path = write(daemon.root, 'a.log', mtime=mtime)
+    write(daemon.root, 'a.txt', mtime=mtime)
+    gardener._handle(1, IN_CLOSE_WRITE, 0, 'a.log')
+    gardener._handle(1, IN_CLOSE_WRITE, 0, 'a.txt')
+    assert gardener._deadlines == { ('s', path): pytest.approx(mtime + DAY) }
+
+def test_new_directories_are_scanned(daemon):
+    gardener = daemon()
+    path = write(daemon.root, 'sub/deeper/a.log')
+    gardener._handle(1, IN_CREATE | IN_ISDIR, 0, 'sub')
+    assert list(gardener._deadlines) == [('s', path)]
+    assert sorted(gardener._inotify.directories) == [os.path.join(daemon.root, 'sub'), os.path.join(daemon.root, 'sub', 'deeper')]
+
+def test_expired_files_are_deleted(daemon):
+    gardener = daemon()
+    expired = write(daemon.root, 'a.log', mtime=time.time() - 2 * DAY)
+    young = write(daemon.root, 'b.log', mtime=time.time() - 3600)
+    for name in ('a.log', 'b.log'):
+        gardener._handle(1, IN_CLOSE_WRITE, 0, name)
+    gardener._expire()
+    assert not os.path.exists(expired)
+    assert os.path.exists(young)
+    assert list(gardener._deadlines) == [('s', young)]
+
+def test_files_written_since_scheduled_are_rescheduled(daemon):
+    gardener = daemon()
+    path = write(daemon.root, 'a.log', mtime=time.time() - 2 * DAY)
+    gardener._handle(1, IN_CLOSE_WRITE, 0, 'a.log')
+    # Written again, the earlier expiry is kept until it comes
+    os.utime(path, None)
+    gardener._handle(1, IN_CLOSE_WRITE, 0, 'a.log')
+    assert gardener._deadlines[('s', path)] < time.time()
+    gardener._expire()
+    assert os.path.exists(path)
+    assert gardener._deadlines[('s', path)] == pytest.approx(os.stat(path).st_mtime + DAY)
+
+def test_files_below_min_size_are_kept(daemon):
+    gardener = daemon(min_size='10B')
+    small = write(daemon.root, 'a.log', size=5, mtime=time.time() - 2 * DAY)
+    large = write(daemon.root, 'b.log', size=20, mtime=time.time() - 2 * DAY)
+    for name in ('a.log', 'b.log'):
+        gardener._handle(1, IN_CLOSE_WRITE, 0, name)
+    gardener._expire()
+    assert os.path.exists(small)
+    assert not os.path.exists(large)
+    # Only a write can make it large enough, which resets its age
+    assert gardener._deadlines[('s', small)] == pytest.approx(time.time() + DAY, abs=60)
+
+def test_files_deleted_externally_are_dropped(daemon):
+    gardener = daemon()
+    path = write(daemon.root, 'a.log', mtime=time.time() - 2 * DAY)
+    gardener._handle(1, IN_CLOSE_WRITE, 0, 'a.log')
+    os.remove(path)
+    gardener._expire()
+    assert gardener._deadlines == {}
+    assert gardener._heap == []
+    # An event of a file deleted before it was handled is ignored
+    gardener._handle(1, IN_CLOSE_WRITE, 0, 'a.log')
+    assert gardener._deadlines == {}
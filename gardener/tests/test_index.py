@@ -0,0 +1,118 @@
+import os
+import time
+
+import pytest
+
+from libs.Index import Index, TraversalIndex
+from libs.Walker import Rule, Traversal, Walker
+
+def write(directory, relative_path, mtime=None):
+    path = os.path.join(directory, relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'w').close()
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+# Move the mtime of every directory of a tree out of the racy window
+def settle(root, mtime):
+    for directory, _, _ in os.walk(root):
+        os.utime(directory, (mtime, mtime))
+
+@pytest.fixture
+def walker():
+    walker = Walker(2)
+    yield walker
+    walker.shutdown()
+
+def walk(walker, index, traversal):
+    view = index.traversal(traversal)
+    files = sorted(path for path, stat, systems in walker.walk(traversal, index=view))
+    view.commit()
+    return view, files
+
+def test_unchanged_directories_are_not_listed_again(tmp_path, walker):
+    root = str(tmp_path / 'tree')
+    old = time.time() - 3600
+    write(root, 'a/1.log')
+    write(root, 'b/2.log')
+    settle(root, old)
+    traversal = Traversal.plan([Rule('s', root, '*.log')])[0]
+    index = Index(str(tmp_path / 'index.db'))
+    view, files = walk(walker, index, traversal)
+    assert files == [os.path.join(root, 'a', '1.log'), os.path.join(root, 'b', '2.log')]
+    # Nothing changed, every directory is only stat'ed
+    view, files = walk(walker, index, traversal)
+    assert files == []
+    assert view.scanned == set()
+    # A new file changes the mtime of its directory only
+    write(root, 'b/3.log')
+    view, files = walk(walker, index, traversal)
+    assert files == [os.path.join(root, 'b', '2.log'), os.path.join(root, 'b', '3.log')]
+    assert view.scanned == { os.path.join(root, 'b') }
+    index.close()
+
+def test_directories_modified_within_the_racy_window_are_listed_again(tmp_path, walker):
+    root = str(tmp_path / 'tree')
+    write(root, 'a/1.log')
+    traversal = Traversal.plan([Rule('s', root, '*.log')])[0]
+    index = Index(str(tmp_path / 'index.db'))
+    walk(walker, index, traversal)
+    view = index.traversal(traversal)
+    assert view.mtime(os.path.join(root, 'a')) is None
+    # Files created in the same mtime tick after the listing are still found
+    write(root, 'a/2.log')
+    view, files = walk(walker, index, traversal)
+    assert files == [os.path.join(root, 'a', '1.log'), os.path.join(root, 'a', '2.log')]
+    index.close()
+
+def test_racy_window_only_covers_recent_mtimes(tmp_path):
+    index = Index(str(tmp_path / 'index.db'))
+    view = TraversalIndex(index, '/root')
+    view.update('/root', view.started - TraversalIndex.racy_window - 1, [], [])
+    view.update('/root/recent', view.started - TraversalIndex.racy_window + 1, [], [])
+    assert view.mtime('/root') == view.started - TraversalIndex.racy_window - 1
+    assert view.mtime('/root/recent') is None
+    index.close()
+
+def test_expired_candidates_skip_listed_directories(tmp_path, walker):
+    root = str(tmp_path / 'tree')
+    old = time.time() - 3600
+    write(root, 'a/1.log', old)
+    write(root, 'b/2.log', old)
+    write(root, 'b/3.log')
+    settle(root, old)
+    traversal = Traversal.plan([Rule('s', root, '*.log')])[0]
+    index = Index(str(tmp_path / 'index.db'))
+    walk(walker, index, traversal)
+    write(root, 'b/4.log')
+    view, files = walk(walker, index, traversal)
+    # Files of 'b' were yielded by the walk, only the expired file of 'a' is left to check
+    assert view.candidates(time.time() - 60) == { os.path.join(root, 'a', '1.log'): ('s',) }
+    index.close()
+
+def test_removed_directories_are_forgotten(tmp_path, walker):
+    root = str(tmp_path / 'tree')
+    old = time.time() - 3600
+    write(root, 'a/sub/1.log', old)
+    settle(root, old)
+    traversal = Traversal.plan([Rule('s', root, '*.log')])[0]
+    index = Index(str(tmp_path / 'index.db'))
+    walk(walker, index, traversal)
+    os.remove(os.path.join(root, 'a', 'sub', '1.log'))
+    os.rmdir(os.path.join(root, 'a', 'sub'))
+    view, files = walk(walker, index, traversal)
+    assert view.children(os.path.join(root, 'a')) == []
+    assert view.candidates(time.time()) == {}
+    index.close()
+
+def test_changed_systems_rebuild_the_index(tmp_path, walker):
+    root = str(tmp_path / 'tree')
+    old = time.time() - 3600
+    write(root, 'a/1.log', old)
+    write(root, 'a/2.txt', old)
+    settle(root, old)
+    index = Index(str(tmp_path / 'index.db'))
+    walk(walker, index, Traversal.plan([Rule('s', root, '*.log')])[0])
+    view, files = walk(walker, index, Traversal.plan([Rule('s', root, '*.txt')])[0])
+    assert files == [os.path.join(root, 'a', '2.txt')]
+    index.close()
@@ -0,0 +1,113 @@
+import collections
+import json
+import os
+import random
+import time
+
+import pytest
+
+from libs import Quota as quota_module
+from libs.Garden import Garden
+from libs.Quota import Budget, Oldest, Quota
+
+Stat = collections.namedtuple('Stat', 'st_mtime st_size')
+
+# Files as (path, mtime, size) in a random order
+def files(count, seed=0):
+    rng = random.Random(seed)
+    files = [('f{n:03d}'.format(n=n), float(n), rng.randint(1, 100)) for n in range(count)]
+    rng.shuffle(files)
+    return files
+
+def test_oldest_selects_the_fewest_oldest_files_covering_the_amount():
+    for amount in (1, 50, 500, 2000, 10 ** 6):
+        oldest = Oldest(amount)
+        for path, mtime, size in files(100):
+            oldest.add(path, Stat(mtime, size))
+        selected = oldest.files()
+        # Expected: the oldest files, in order, until their sizes add up to the amount
+        expected, total = [], 0
+        for path, mtime, size in sorted(files(100), key=lambda x: x[1]):
+            if total >= amount:
+                break
+            expected.append((path, size))
+            total += size
+        assert selected == expected, amount
+        assert oldest.total == total
+
+def test_budget_drops_the_oldest_files_past_the_budget():
+    for budget in (0, 50, 500, 2000, 10 ** 6):
+        kept = Budget(budget)
+        dropped = []
+        for path, mtime, size in files(100):
+            dropped.extend(kept.add(path, Stat(mtime, size)))
+        # Expected: the youngest files, in order, while their sizes fit in the budget
+        expected_kept, total = set(), 0
+        for path, mtime, size in sorted(files(100), key=lambda x: -x[1]):
+            if total + size > budget:
+                break
+            expected_kept.add(path)
+            total += size
+        assert set(x[0] for x in dropped) == set(x[0] for x in files(100)).difference(expected_kept), budget
+        assert kept.total == total
+
+def test_budget_never_drops_a_file_younger_than_a_kept_one():
+    kept = Budget(300)
+    dropped = set()
+    for path, mtime, size in files(100, seed=1):
+        dropped.update(x[0] for x in kept.add(path, Stat(mtime, size)))
+    mtimes = { path: mtime for path, mtime, size in files(100, seed=1) }
+    assert max(mtimes[x] for x in dropped) < min(mtimes[x] for x in mtimes if x not in dropped)
+
+def test_quota_deficit(monkeypatch):
+    Usage = collections.namedtuple('Usage', 'total used free')
+    monkeypatch.setattr(quota_module.shutil, 'disk_usage', lambda path: Usage(1000, 900, 100))
+    assert Quota('/', free_bytes=150).deficit() == 50
+    assert Quota('/', free_percent=25).deficit() == 150
+    assert Quota('/', free_bytes=150, free_percent=25).deficit() == 150
+    assert Quota('/', free_bytes=50).deficit() == 0
+    assert Quota('/', max_bytes=10).deficit() == 0
+
+def write(root, relative_path, size, mtime):
+    path = os.path.join(root, relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'\0' * size)
+    os.utime(path, (mtime, mtime))
+
+@pytest.fixture
+def garden(tmp_path):
+    root = str(tmp_path / 'tree')
+    now = time.time()
+    # Files of 100 bytes, 'f0' the oldest, spread over two directories
+    for n in range(10):
+        write(root, os.path.join('d' + str(n % 2), 'f{n}.log'.format(n=n)), 100, now - 3600 * (10 - n))
+    write(root, 'old.txt', 100, now - 10 ** 6)
+    config_file = str(tmp_path / 'settings.json')
+    def garden(**settings):
+        with open(config_file, 'w') as f:
+            json.dump({ 's': dict({ 'path': root, 'file_pattern': '*.log' }, **settings) }, f)
+        return Garden(config_file, 's', '1000w', '0B', workers=2)
+    garden.root = root
+    return garden
+
+def remaining(root):
+    return sorted(name for _, _, names in os.walk(root) for name in names)
+
+def test_max_bytes_keeps_the_youngest_files(garden):
+    gardener = garden(max_bytes='450B')
+    gardener.tend()
+    gardener.__exit__(None, None, None)
+    assert remaining(garden.root) == ['f6.log', 'f7.log', 'f8.log', 'f9.log', 'old.txt']
+
+def test_free_space_target_deletes_the_oldest_files(garden, monkeypatch):
+    Usage = collections.namedtuple('Usage', 'total used free')
+    # 250 bytes free, plus the bytes of the files deleted
+    def disk_usage(path):
+        free = 250 + 100 * (11 - len(remaining(garden.root)))
+        return Usage(10000, 10000 - free, free)
+    monkeypatch.setattr(quota_module.shutil, 'disk_usage', disk_usage)
+    gardener = garden(free_bytes='500B')
+    gardener.tend()
+    gardener.__exit__(None, None, None)
+    assert remaining(garden.root) == ['f3.log', 'f4.log', 'f5.log', 'f6.log', 'f7.log', 'f8.log', 'f9.log', 'old.txt']
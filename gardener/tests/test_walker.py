@@ -0,0 +1,110 @@
+import glob
+import os
+
+import pytest
+
+from libs.Walker import Pattern, Rule, Traversal, Walker
+
+def write(directory, relative_path):
+    path = os.path.join(directory, relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'w').close()
+
+@pytest.fixture
+def walker():
+    walker = Walker(2)
+    yield walker
+    walker.shutdown()
+
+def components(relative_path):
+    parts = relative_path.split('/')
+    return tuple(parts[:-1]), parts[-1]
+
+@pytest.mark.parametrize('pattern, relative_path, matched', [
+    ('*.log', 'a.log', True),
+    ('*.log', 'sub/deep/a.log', True),
+    ('*.log', 'a.txt', False),
+    ('*.log', '.a.log', False),
+    ('.*.log', '.a.log', True),
+    ('logs/*.log', 'logs/a.log', True),
+    ('logs/*.log', 'x/logs/a.log', True),
+    ('logs/*.log', 'a.log', False),
+    ('logs/*.log', 'other/a.log', False),
+    ('logs/*.log', '.hidden/logs/a.log', False),
+    ('.cache/*.log', '.cache/a.log', True),
+    ('*/*.log', '.cache/a.log', False),
+    ('*/*.log', 'sub/a.log', True)
+])
+def test_pattern_matches_like_glob(pattern, relative_path, matched):
+    assert Pattern(pattern).match(*components(relative_path)) is matched
+
+def test_walk_finds_the_files_glob_finds(tmp_path, walker):
+    root = str(tmp_path)
+    for path in ('a.log', 'b.txt', '.c.log', 'sub/d.log', 'sub/logs/e.log', 'logs/f.log', '.hidden/g.log',
+                 '.hidden/logs/h.log', '.cache/i.log', 'sub/.cache/j.log', 'deep/er/still/k.log'):
+        write(root, path)
+    for pattern in ('*.log', '.*.log', 'logs/*.log', '*/*.log', '.cache/*.log', '*'):
+        traversal = Traversal.plan([Rule('s', root, pattern)])[0]
+        walked = sorted(path for path, stat, systems in walker.walk(traversal))
+        globbed = sorted(x for x in glob.glob(os.path.join(root, '**', pattern), recursive=True) if os.path.isfile(x))
+        assert walked == globbed, pattern
+
+def test_walk_yields_stat_results(tmp_path, walker):
+    write(str(tmp_path), 'sub/a.log')
+    traversal = Traversal.plan([Rule('s', str(tmp_path), '*.log')])[0]
+    [(path, stat, systems)] = list(walker.walk(traversal))
+    assert path == os.path.join(str(tmp_path), 'sub', 'a.log')
+    assert stat.st_size == 0
+    assert systems == ('s',)
+
+def test_walk_does_not_follow_directory_links(tmp_path, walker):
+    write(str(tmp_path / 'outside'), 'a.log')
+    os.makedirs(str(tmp_path / 'root'))
+    os.symlink(str(tmp_path / 'outside'), str(tmp_path / 'root' / 'link'))
+    traversal = Traversal.plan([Rule('s', str(tmp_path / 'root'), '*.log')])[0]
+    assert list(walker.walk(traversal)) == []
+
+def test_plan_merges_shared_and_nested_paths(tmp_path):
+    for name in ('logs/app', 'logs-other', 'data'):
+        os.makedirs(str(tmp_path / name))
+    logs, app, other, data = (str(tmp_path / x) for x in ('logs', 'logs/app', 'logs-other', 'data'))
+    traversals = Traversal.plan([Rule('app', app, '*.log'), Rule('logs', logs, '*.log'), Rule('shared', logs, '*.txt'),
+                                 Rule('other', other, '*.log'), Rule('data', data, '*.dat')])
+    assert sorted((x.root, sorted(x.systems)) for x in traversals) == sorted([
+        (logs, ['app', 'logs', 'shared']),
+        (other, ['other']),
+        (data, ['data'])
+    ])
+
+def test_traversal_matches_every_system_of_a_file(tmp_path, walker):
+    root = str(tmp_path)
+    for path in ('a.log', 'a.txt', 'app/b.log', 'app/sub/c.log', 'app/d.txt', 'other/e.log', '.hidden/app/f.log'):
+        write(root, path)
+    rules = [Rule('root', root, '*.log'), Rule('text', root, '*.txt'), Rule('app', os.path.join(root, 'app'), '*.log'),
+             Rule('sub', os.path.join(root, 'app', 'sub'), 'sub/*.log')]
+    [traversal] = Traversal.plan(rules)
+    walked = { os.path.relpath(path, root): sorted(systems) for path, stat, systems in walker.walk(traversal) }
+    assert walked == {
+        'a.log': ['root'],
+        'a.txt': ['text'],
+        os.path.join('app', 'b.log'): ['app', 'root'],
+        os.path.join('app', 'sub', 'c.log'): ['app', 'root'],
+        os.path.join('app', 'd.txt'): ['text'],
+        os.path.join('other', 'e.log'): ['root']
+    }
+
+def test_traversal_walks_down_to_a_nested_path_under_a_hidden_directory(tmp_path, walker):
+    root = str(tmp_path)
+    for path in ('a.log', '.hidden/b.log', '.hidden/app/c.log'):
+        write(root, path)
+    rules = [Rule('root', root, '*.log'), Rule('app', os.path.join(root, '.hidden', 'app'), '*.log')]
+    [traversal] = Traversal.plan(rules)
+    walked = { os.path.relpath(path, root): systems for path, stat, systems in walker.walk(traversal) }
+    assert walked == { 'a.log': ('root',), os.path.join('.hidden', 'app', 'c.log'): ('app',) }
+
+def test_signature_changes_with_the_rules(tmp_path):
+    root = str(tmp_path)
+    signature = Traversal.plan([Rule('s', root, '*.log')])[0].signature()
+    assert Traversal.plan([Rule('s', root, '*.log')])[0].signature() == signature
+    assert Traversal.plan([Rule('s', root, '*.txt')])[0].signature() != signature
+    assert Traversal.plan([Rule('t', root, '*.log')])[0].signature() != signature